@@ -0,0 +1,80 @@
+'''Compares the throughput and accuracy of the answer modes (--answer-mode free, constrained and reasoning).
+
+Every mode runs qa_rag.py on the same questions with the LLM cache disabled. A first warm-up run
+downloads and indexes the pages, so the modes only differ in how the answers are generated.
+
+    python other/benchmark_answer_modes.py --dataset data/train_data.csv -- --num-samples 50 --vector-store numpy
+
+Without --ollama-url, the local fake Ollama and Wikipedia servers are used (see fake_servers.py).
+Its answers don't depend on the mode, so only the throughput, token and parse failure columns are
+meaningful there; run it against a real Ollama to compare accuracy.
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(__file__))
+from benchmark_pipeline import run_qa_rag
+from fake_servers import add_server_args, start_fake_servers
+
+MODES = ['free', 'constrained', 'reasoning']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark answer modes", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset", default='data/train_data.csv', help="Dataset to run")
+    parser.add_argument("--modes", nargs='+', default=MODES, choices=MODES, help="Answer modes to compare")
+    parser.add_argument("--reasoning-tokens", nargs='+', type=int, default=[512], help="Reasoning caps of the 'reasoning' mode, one run each")
+    parser.add_argument("--ollama-url", default=None, help="Benchmark a real Ollama instead of the fake one")
+    parser.add_argument("--wiki-url", default=None, help="Wikipedia host used with --ollama-url. Defaults to https://en.wikipedia.org")
+    parser.add_argument("--work-dir", default=None, help="Directory for downloads, indexes and reports. A temporary one if not set.")
+    add_server_args(parser)
+    parser.add_argument("qa_args", nargs=argparse.REMAINDER, help="Arguments after -- are passed to qa_rag.py")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    qa_args = args.qa_args[1:] if args.qa_args[:1] == ['--'] else args.qa_args
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='qa_rag_answer_modes_')
+    os.makedirs(work_dir, exist_ok=True)
+    servers = []
+    if args.ollama_url is None:
+        servers = start_fake_servers(args)
+        ollama_url = f'http://127.0.0.1:{servers[0].server_port}'
+        wiki_url = f'http://127.0.0.1:{servers[1].server_port}'
+    else:
+        ollama_url, wiki_url = args.ollama_url, args.wiki_url
+    print(f"Work dir: {work_dir}")
+
+    # Download and index once, so the modes only differ in the answer stage
+    run_qa_rag(work_dir, args.dataset, 'batch', ollama_url, wiki_url, qa_args + ['--stop-after', 'index'])
+
+    configs = []
+    for mode in args.modes:
+        if mode == 'reasoning':
+            configs += [(f'reasoning<={tokens}', ['--answer-mode', mode, '--reasoning-tokens', str(tokens)]) for tokens in args.reasoning_tokens]
+        else:
+            configs.append((mode, ['--answer-mode', mode]))
+
+    print(f"{'mode':16s} {'accuracy':>9s} {'parse fail':>10s} {'answer time':>11s} {'answers/s':>10s} {'out tokens':>10s} {'in tokens':>10s}")
+    for name, mode_args in configs:
+        report = run_qa_rag(work_dir, args.dataset, 'batch', ollama_url, wiki_url, qa_args + mode_args + ['--no-cache'])
+        stages = report['stages']
+        answer = stages.get('answer', {})
+        num_questions = max(1, report['num_questions'])
+        # The 'reasoning' mode records its two turns as answer_reasoning and answer_final, the other modes as answer
+        turns = [summary for stage, summary in stages.items() if stage in ('answer_reasoning', 'answer_final')] or [answer]
+        completion_tokens = sum(summary.get('completion_tokens', 0) for summary in turns) / num_questions
+        prompt_tokens = sum(summary.get('prompt_tokens', 0) for summary in turns) / num_questions
+        accuracy = f"{report['accuracy']:.1%}" if report.get('accuracy') is not None else '-'
+        print(f"{name:16s} {accuracy:>9s} {report.get('parse_failures', 0):10d} {answer.get('wall_time', 0):10.2f}s {answer.get('items_per_sec', 0):10.2f} "
+              f"{completion_tokens:10.1f} {prompt_tokens:10.0f}")
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
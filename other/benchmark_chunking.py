@@ -0,0 +1,88 @@
+'''Compares the speed and memory of langchain's RecursiveCharacterTextSplitter and the span-based chunker.
+
+Every config chunks all pages of --doc-dir and keeps the result, like an indexer that chunks a
+corpus before embedding it: the langchain splitter keeps the chunk strings, the span chunker
+only (start, end) offsets into the page texts. Each config runs in a fresh process, so the peak
+RSS of one doesn't hide the others' (pool workers are not included, they only hold a few
+batches of pages each). The chunks of the 'recursive' span chunker are checked to be
+identical to langchain's.
+
+    python other/benchmark_chunking.py --doc-dir search_results --processes 4
+'''
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.chunking import iter_chunk_spans
+from src.corpus import open_corpus
+from src.rag import chunk_document
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark chunkers", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--doc-dir", default='search_results', help="Directory of downloaded pages (text files or a corpus pack)")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--chunk-overlap", type=int, default=500)
+    parser.add_argument("--processes", type=int, default=max(1, os.cpu_count() or 1), help="Worker processes of the parallel configs")
+    parser.add_argument("--config", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def get_configs(processes: int):
+    # name -> (chunker, processes); chunker None is langchain's splitter
+    configs = {'langchain': (None, 1), 'spans': ('recursive', 1), 'spans-sentence': ('sentence', 1)}
+    if processes > 1:
+        configs[f'spans x{processes}'] = ('recursive', processes)
+    return configs
+
+
+def run_config(args) -> dict:
+    '''Chunks the corpus with one config in this process.'''
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    chunker, processes = get_configs(args.processes)[args.config]
+    corpus = open_corpus(args.doc_dir)
+    documents = list(corpus.iter_documents())
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start_time = time.perf_counter()
+    if chunker is None:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+        chunks = [splitter.split_text(document) for _, document in documents]
+        num_chunks = sum(len(document_chunks) for document_chunks in chunks)
+    else:
+        spans = [document_spans for _, _, document_spans in iter_chunk_spans(documents, args.chunk_size, args.chunk_overlap, chunker, processes=processes)]
+        num_chunks = sum(len(document_spans) for document_spans in spans)
+    elapsed = time.perf_counter() - start_time
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'documents': len(documents), 'chunks': num_chunks, 'seconds': elapsed, 'peak_rss_mb': rss / 1024, 'chunk_rss_mb': (rss - baseline_rss) / 1024}
+
+
+def main():
+    args = parse_args()
+    if args.config is not None:
+        print(json.dumps(run_config(args)))
+        return
+
+    documents = list(open_corpus(args.doc_dir).iter_documents())
+    text_mb = sum(len(document) for _, document in documents) / 1e6
+    print(f"{len(documents)} pages ({text_mb:.1f}M characters), chunk size {args.chunk_size}, overlap {args.chunk_overlap}")
+    print(f"{'config':16s} {'chunks':>8s} {'seconds':>8s} {'chunks/s':>9s} {'peak RSS':>9s} {'chunk RSS':>10s}")
+    for name in get_configs(args.processes):
+        command = [sys.executable, os.path.abspath(__file__), '--doc-dir', args.doc_dir, '--chunk-size', str(args.chunk_size), '--chunk-overlap', str(args.chunk_overlap),
+                   '--processes', str(args.processes), '--config', name]
+        result = json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip().splitlines()[-1])
+        print(f"{name:16s} {result['chunks']:8d} {result['seconds']:7.2f}s {result['chunks'] / result['seconds']:9.0f} {result['peak_rss_mb']:7.0f}MB {result['chunk_rss_mb']:8.0f}MB")
+
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    identical = sum(chunk_document(document, args.chunk_size, args.chunk_overlap) == splitter.split_text(document) for _, document in documents)
+    print(f"'recursive' chunks identical to langchain's for {identical}/{len(documents)} pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+'''Runs qa_rag.py end-to-end against local fake Ollama and Wikipedia servers and reports per-stage throughput.
+
+No GPU or network is needed, so the numbers measure the pipeline's own overhead (concurrency,
+caching, indexing) under a simulated model and network speed. Datasets are scaled to the requested
+sizes by repeating their questions with a variant suffix, so every question stays distinct.
+
+    python other/benchmark_pipeline.py --sizes 50 1000 --pipelines batch streaming --repeat 2 -- --answer-concurrency 4
+
+Arguments after `--` are passed to qa_rag.py. With --repeat 2 the second run of every config reuses
+the downloaded pages, the index and the LLM cache of the first one (a warm run).
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_servers import add_server_args, start_fake_servers
+
+QA_RAG_PATH = os.path.join(os.path.dirname(__file__), '..', 'qa_rag.py')
+STAGES = ['keywords', 'fetch', 'chunk', 'embed', 'store', 'lexical_index', 'retrieve', 'pack', 'answer', 'extract']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline with fake Ollama and Wikipedia servers", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--datasets", nargs='+', default=['data/train_data.csv', 'data/test_data.csv'], help="Datasets to scale and run")
+    parser.add_argument("--sizes", nargs='+', type=int, default=[50, 200, 1000], help="Number of questions per run (up to 10k)")
+    parser.add_argument("--pipelines", nargs='+', default=['batch'], choices=['batch', 'streaming'], help="Pipeline modes to run")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per config in the same work directory. Later runs are warm.")
+    parser.add_argument("--work-dir", default=None, help="Directory for scaled datasets, downloads, indexes and reports. A temporary one if not set.")
+    parser.add_argument("--out", default=None, help="Also write all reports to this JSON file")
+    add_server_args(parser)
+    parser.add_argument("qa_args", nargs=argparse.REMAINDER, help="Arguments after -- are passed to qa_rag.py")
+    return parser.parse_args()
+
+
+def scale_dataset(dataset_path: str, size: int, out_path: str) -> None:
+    '''Writes the first `size` questions of the dataset, repeating it with numbered variants if it is smaller.'''
+    df = pd.read_csv(dataset_path)
+    parts = []
+    for repeat in range((size + len(df) - 1) // len(df)):
+        part = df.copy()
+        if repeat > 0:
+            part['prompt'] = part['prompt'] + f' (variant {repeat})'
+        parts.append(part)
+    pd.concat(parts, ignore_index=True).head(size).to_csv(out_path, index=False)
+
+
+def run_qa_rag(run_dir: str, dataset_path: str, pipeline: str, ollama_url: str, wiki_url: str, qa_args) -> dict:
+    for sub_dir in ('data/prompts', 'data/responses'):
+        os.makedirs(os.path.join(run_dir, sub_dir), exist_ok=True)
+    report_path = os.path.join(run_dir, f'report_{time.time_ns()}.json')
+    command = [sys.executable, os.path.abspath(QA_RAG_PATH), '--dataset', os.path.abspath(dataset_path), '--pipeline', pipeline,
+               '--wiki-url', wiki_url, '--report', report_path] + list(qa_args)
+    with open(os.path.join(run_dir, 'qa_rag.log'), 'a', encoding='utf-8') as log:
+        subprocess.run(command, cwd=run_dir, env=dict(os.environ, OLLAMA_HOST=ollama_url), stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(report_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def print_row(columns):
+    print(' '.join(f'{column:>10s}' if i >= 4 else f'{column:<14s}' if i == 0 else f'{column:>9s}' for i, column in enumerate(columns)))
+
+
+def main():
+    args = parse_args()
+    qa_args = args.qa_args[1:] if args.qa_args[:1] == ['--'] else args.qa_args
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='qa_rag_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    ollama_server, wiki_server = start_fake_servers(args)
+    ollama_url = f'http://127.0.0.1:{ollama_server.server_port}'
+    wiki_url = f'http://127.0.0.1:{wiki_server.server_port}'
+    print(f"Work dir: {work_dir}")
+    print("Items/sec per stage (total is questions/sec over the whole run):")
+    print_row(['dataset', 'questions', 'pipeline', 'run', 'total'] + STAGES)
+
+    results = []
+    for dataset_path in args.datasets:
+        dataset_name = os.path.splitext(os.path.basename(dataset_path))[0]
+        for size in args.sizes:
+            scaled_path = os.path.join(work_dir, f'{dataset_name}_{size}.csv')
+            scale_dataset(dataset_path, size, scaled_path)
+            for pipeline in args.pipelines:
+                run_dir = os.path.join(work_dir, f'{dataset_name}_{size}_{pipeline}')
+                for repeat in range(args.repeat):
+                    report = run_qa_rag(run_dir, scaled_path, pipeline, ollama_url, wiki_url, qa_args)
+                    report.update({'dataset': dataset_name, 'size': size, 'pipeline': pipeline, 'run': repeat + 1})
+                    results.append(report)
+                    stages = report['stages']
+                    print_row([dataset_name, str(size), pipeline, str(repeat + 1), f"{size / report['total_wall_time']:.1f}"]
+                              + [f"{stages[stage]['items_per_sec']:.1f}" if stage in stages else '-' for stage in STAGES])
+
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    ollama_server.shutdown()
+    wiki_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
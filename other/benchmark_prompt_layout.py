@@ -0,0 +1,92 @@
+'''Measures model cold-start and per-question prefill time with and without prefix-stable prompts and model preloading.
+
+Every config runs qa_rag.py on the same questions with the LLM cache disabled, after unloading
+the models, so each run starts cold. A first warm-up run downloads and indexes the pages, so the
+configs only differ in how the models are loaded and prompted.
+
+    python other/benchmark_prompt_layout.py --dataset data/train_data.csv -- --num-samples 50 --vector-store numpy
+
+Without --ollama-url, the local fake Ollama and Wikipedia servers are used (see fake_servers.py),
+which simulate model loading and the KV cache reuse of prompts that share a prefix. With a real
+Ollama, the numbers are the ones it reports.
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+import ollama
+
+sys.path.insert(0, os.path.dirname(__file__))
+from benchmark_pipeline import run_qa_rag
+from fake_servers import add_server_args, start_fake_servers
+
+# name -> qa_rag.py arguments
+CONFIGS = {
+    'inline': ['--prompt-layout', 'inline', '--no-preload'],
+    'inline+preload': ['--prompt-layout', 'inline'],
+    'prefix': ['--prompt-layout', 'prefix', '--no-preload'],
+    'prefix+preload': ['--prompt-layout', 'prefix'],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark prompt layouts and model preloading", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset", default='data/train_data.csv', help="Dataset to run")
+    parser.add_argument("--configs", nargs='+', default=list(CONFIGS), choices=list(CONFIGS), help="Configs to compare")
+    parser.add_argument("--models", nargs='+', default=['gemma3:1b', 'nomic-embed-text'], help="Models unloaded before every run (the keyword, answer and embedding models of the run)")
+    parser.add_argument("--ollama-url", default=None, help="Benchmark a real Ollama instead of the fake one")
+    parser.add_argument("--wiki-url", default=None, help="Wikipedia host used with --ollama-url. Defaults to https://en.wikipedia.org")
+    parser.add_argument("--work-dir", default=None, help="Directory for downloads, indexes and reports. A temporary one if not set.")
+    add_server_args(parser)
+    parser.add_argument("qa_args", nargs=argparse.REMAINDER, help="Arguments after -- are passed to qa_rag.py")
+    return parser.parse_args()
+
+
+def unload_models(ollama_url: str, models) -> None:
+    client = ollama.Client(host=ollama_url)
+    for model in models:
+        try:
+            # keep_alive 0 unloads the model right away. Embedding models can't generate, so they are unloaded with an empty embed request.
+            client.generate(model=model, keep_alive=0)
+        except ollama.ResponseError:
+            client.embed(model=model, input='', keep_alive=0)
+
+
+def main():
+    args = parse_args()
+    qa_args = args.qa_args[1:] if args.qa_args[:1] == ['--'] else args.qa_args
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='qa_rag_layout_')
+    os.makedirs(work_dir, exist_ok=True)
+    servers = []
+    if args.ollama_url is None:
+        servers = start_fake_servers(args)
+        ollama_url = f'http://127.0.0.1:{servers[0].server_port}'
+        wiki_url = f'http://127.0.0.1:{servers[1].server_port}'
+    else:
+        ollama_url, wiki_url = args.ollama_url, args.wiki_url
+    print(f"Work dir: {work_dir}")
+
+    # Download and index once, so the configs only differ in the LLM stages
+    run_qa_rag(work_dir, args.dataset, 'batch', ollama_url, wiki_url, qa_args)
+
+    print(f"{'config':16s} {'total':>8s} {'preload':>8s} {'stage load':>10s} {'kw prefill':>11s} {'ans prefill':>11s} {'ans tokens':>10s} {'answers/s':>10s}")
+    for name in args.configs:
+        unload_models(ollama_url, args.models)
+        report = run_qa_rag(work_dir, args.dataset, 'batch', ollama_url, wiki_url, qa_args + CONFIGS[name] + ['--no-cache'])
+        stages = report['stages']
+        preload = stages.get('preload', {})
+        # Cold starts the stages waited for: time spent loading a model inside keyword and answer requests
+        stage_load = sum(summary.get('load_seconds', 0) for stage, summary in stages.items() if stage != 'preload')
+        keywords = stages.get('keywords', {})
+        answer = stages.get('answer', {})
+        print(f"{name:16s} {report['total_wall_time']:7.2f}s {preload.get('wall_time', 0):7.2f}s {stage_load:9.2f}s "
+              f"{keywords.get('prefill_seconds_per_response', 0) * 1000:9.1f}ms {answer.get('prefill_seconds_per_response', 0) * 1000:9.1f}ms "
+              f"{answer.get('prompt_tokens_per_response', 0):10.0f} {answer.get('items_per_sec', 0):10.2f}")
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+'''Compares the query latency and answer coverage of the vector, BM25 and hybrid retrieval modes.
+
+Indexes the downloaded pages in --doc-dir (incrementally, like qa_rag.py), then retrieves context
+for every question of the dataset in each mode. A question counts as covered if at least
+--coverage of the words of its correct choice appear in the retrieved chunks, which is a cheap
+proxy for answer accuracy that needs no answer model. Run qa_rag.py with --retrieval to measure
+the end-to-end accuracy of a mode.
+
+    python other/benchmark_retrieval.py --dataset data/train_data.csv -k 3
+'''
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.rag import RETRIEVAL_MODES, VECTOR_STORE_BACKENDS, Retriever, index_documents, retrieve_scored_chunks_batch, tokenize
+from src.utils import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval modes", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset", default='data/train_data.csv', help="CSV dataset with an answer column")
+    parser.add_argument("--doc-dir", default='search_results', help="Directory of downloaded pages")
+    parser.add_argument("--embed-model", default='nomic-embed-text')
+    parser.add_argument("--vector-store", default='chroma', choices=VECTOR_STORE_BACKENDS)
+    parser.add_argument("--db-path", default='rag_db')
+    parser.add_argument("--embedding-cache-dir", default='cache/embeddings', help="Embedding cache shared with qa_rag.py. Empty string disables it.")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--chunk-overlap", type=int, default=500)
+    parser.add_argument("-k", type=int, default=3, help="Chunks retrieved per question")
+    parser.add_argument("--modes", nargs='+', default=RETRIEVAL_MODES, choices=RETRIEVAL_MODES)
+    parser.add_argument("--coverage", type=float, default=0.8, help="Fraction of the correct choice's words that must appear in the context")
+    return parser.parse_args()
+
+
+def get_coverage(choice: str, context_tokens: set) -> float:
+    tokens = set(tokenize(str(choice)))
+    if not tokens:
+        return 0.0
+    return len(tokens & context_tokens) / len(tokens)
+
+
+def main():
+    args = parse_args()
+    df = pd.read_csv(args.dataset)
+    questions = df['prompt'].tolist()
+    retriever = Retriever(embedding_model_name=args.embed_model, persist_directory=args.db_path, backend=args.vector_store, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                          embedding_cache_dir=args.embedding_cache_dir or None)
+    stats = index_documents(doc_dir=args.doc_dir, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, retriever=retriever)
+    print(f"Index: {retriever.vector_store.count()} chunks ({stats['indexed']} docs indexed now), {len(questions)} questions")
+
+    print(f"{'mode':8s} {'batch':>10s} {'q p50':>9s} {'q p95':>9s} {'covered':>8s} {'correct>distractors':>20s}")
+    for mode in args.modes:
+        # Warm up lazily loaded indexes and the embedding model
+        retrieve_scored_chunks_batch(questions[:1], k=args.k, retriever=retriever, mode=mode)
+
+        start = time.perf_counter()
+        results = retrieve_scored_chunks_batch(questions, k=args.k, retriever=retriever, mode=mode)
+        batch_time = time.perf_counter() - start
+
+        latencies = []
+        for question in questions:
+            start = time.perf_counter()
+            retrieve_scored_chunks_batch([question], k=args.k, retriever=retriever, mode=mode)
+            latencies.append(time.perf_counter() - start)
+
+        covered, discriminative = 0, 0
+        for (_, row), chunks in zip(df.iterrows(), results):
+            context_tokens = set(tokenize(' '.join(chunk for chunk, *_ in chunks)))
+            coverages = {choice: get_coverage(row[choice], context_tokens) for choice in 'ABCDE'}
+            correct = coverages[row['answer']]
+            covered += correct >= args.coverage
+            discriminative += all(correct > coverage for choice, coverage in coverages.items() if choice != row['answer'])
+
+        print(f"{mode:8s} {batch_time * 1000:8.1f}ms {percentile(latencies, 50) * 1000:7.2f}ms {percentile(latencies, 95) * 1000:7.2f}ms "
+              f"{covered / len(questions):8.1%} {discriminative / len(questions):20.1%}")
+
+
+if __name__ == "__main__":
+    main()
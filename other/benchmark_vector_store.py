@@ -0,0 +1,79 @@
+'''Compares the latency and recall of the Chroma and NumPy vector store backends.
+
+Uses random normalized vectors, so no Ollama is needed. The NumPy store is exact and is used as
+ground truth for Chroma's recall@k.
+
+    python other/benchmark_vector_store.py --num-chunks 5000 --num-queries 150
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.rag import ChromaVectorStore, NumpyVectorStore
+from src.utils import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark vector store backends", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num-chunks", type=int, default=5000, help="Number of vectors in the index")
+    parser.add_argument("--num-queries", type=int, default=150, help="Number of query vectors")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension (nomic-embed-text is 768)")
+    parser.add_argument("-k", type=int, default=3, help="Number of results per query")
+    parser.add_argument("--batch-size", type=int, default=512, help="Vectors added per call while building")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def benchmark(name, store, ids, texts, vectors, queries, k, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(ids), batch_size):
+        store.add(ids[i:i + batch_size], texts[i:i + batch_size], vectors[i:i + batch_size].tolist())
+    store.persist()
+    build_time = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        store.query(query.tolist(), k)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    results = store.query_batch(queries.tolist(), k)
+    batch_time = time.perf_counter() - start
+
+    print(f"{name:8s} build={build_time:7.2f}s  query p50={percentile(latencies, 50) * 1000:7.2f}ms p95={percentile(latencies, 95) * 1000:7.2f}ms  batch({len(queries)})={batch_time * 1000:8.2f}ms")
+    return [[text for text, *_ in result] for result in results]
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    vectors = rng.standard_normal((args.num_chunks, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.standard_normal((args.num_queries, args.dim)).astype(np.float32)
+    ids = [f'chunk-{i}' for i in range(args.num_chunks)]
+    texts = ids
+
+    tmp_dir = tempfile.mkdtemp(prefix='vector_store_bench_')
+    try:
+        chroma_results = benchmark('chroma', ChromaVectorStore(os.path.join(tmp_dir, 'chroma'), 'bench'), ids, texts, vectors, queries, args.k, args.batch_size)
+        numpy_results = benchmark('numpy', NumpyVectorStore(os.path.join(tmp_dir, 'numpy')), ids, texts, vectors, queries, args.k, args.batch_size)
+
+        # Reload from disk to make sure the memory-mapped index gives the same answers
+        reloaded = NumpyVectorStore(os.path.join(tmp_dir, 'numpy'))
+        assert [[text for text, *_ in r] for r in reloaded.query_batch(queries.tolist(), args.k)] == numpy_results
+
+        recall = np.mean([len(set(c) & set(n)) / len(n) for c, n in zip(chroma_results, numpy_results)])
+        print(f"chroma recall@{args.k} vs exact: {recall:.3f}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+'''Local stand-ins for Ollama and the Wikipedia API, used to benchmark the pipeline offline.
+
+The fake Ollama answers /api/chat and /api/embed with deterministic text and vectors after a
+configurable delay (fixed latency + prompt tokens / prefill speed + completion tokens / decode
+speed), and reports the same token counts and durations as a real server. Like Ollama, it loads a
+model on first use, again after its keep_alive expired or when num_ctx changes (costing
+--load-latency), accepts load-only /api/generate requests, and only evaluates the part of a prompt
+that doesn't share a prefix with one of the last prompts it served (the KV cache of a slot).
+Point qa_rag.py at it with OLLAMA_HOST=http://127.0.0.1:<port>.
+
+The fake Wikipedia serves the MediaWiki query API (formatversion=2, revisions with wikitext,
+extracts with one whole-page extract per response like the real TextExtracts, normalization,
+redirects, continuation) for pages in a fixture directory (<title>.txt files plus an optional
+redirects.json), or synthesizes pages (and their wikitext) for any title. Point qa_rag.py at it with --wiki-url.
+
+    python other/fake_servers.py --ollama-port 11434 --wiki-port 18081 --chat-latency 0.05
+
+--write-dump writes the synthesized pages of the keywords the fake model generates for a dataset
+as a MediaWiki XML dump instead, with wiki markup, redirects and non-article pages, to try
+other/ingest_wiki_dump.py and qa_rag.py --wiki-dump offline.
+
+    python other/fake_servers.py --write-dump /tmp/fake-pages-articles.xml.bz2 --dump-dataset data/train_data.csv
+'''
+import argparse
+import bz2
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import deque
+from typing import Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+WORDS = ('energy mass field wave particle orbit light charge atom star galaxy force spin quantum electron photon '
+         'gravity entropy matter plasma crystal molecule reaction velocity pressure theory equation model spectrum').split()
+
+
+def stable_hash(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def get_fake_keyword(prompt: str) -> str:
+    '''The keyword the fake model answers to a keyword prompt: the longest word of the question, capitalized.'''
+    match = re.search(r'here is the question: (.*)', prompt)
+    question = match.group(1) if match else prompt
+    words = sorted(re.findall(r'[A-Za-z]{4,}', question), key=lambda word: (-len(word), word))
+    return words[0].capitalize() if words else 'Science'
+
+
+def get_fake_answer(prompt: str, options: Optional[dict] = None) -> str:
+    '''The choice the fake model answers. With a temperature above 0, a temperature / 2 fraction of the answers depends on the seed too.'''
+    options = options or {}
+    temperature = options.get('temperature') or 0.0
+    seed = options.get('seed')
+    if temperature > 0 and stable_hash(f'{seed}\x00{prompt}') % 1000 < min(1.0, temperature / 2) * 1000:
+        return 'ABCDE'[stable_hash(f'{prompt}\x00{seed}') % 5]
+    return 'ABCDE'[stable_hash(prompt) % 5]
+
+
+def make_fake_page(title: str, num_chars: int) -> str:
+    '''Deterministic pseudo text for a title, split into paragraphs.'''
+    rng = random.Random(stable_hash(title))
+    paragraphs, length = [], 0
+    while length < num_chars:
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+            words.insert(rng.randrange(len(words)), title)
+            sentences.append(' '.join(words).capitalize() + '.')
+        paragraphs.append(' '.join(sentences))
+        length += len(paragraphs[-1])
+    return '\n\n'.join(paragraphs)
+
+
+def make_fake_wikitext(title: str, num_chars: int) -> str:
+    '''make_fake_page with the markup of a wikipedia article around it: templates, references, links, headings, a table and categories.'''
+    rng = random.Random(stable_hash('wikitext:' + title))
+    paragraphs = []
+    for i, paragraph in enumerate(make_fake_page(title, num_chars).split('\n\n')):
+        paragraph = paragraph.replace(title, f"'''{title}'''" if i == 0 else f'[[{title}]]', 1)
+        word = rng.choice(WORDS)
+        paragraph = re.sub(rf'\b{word}\b', f'[[{word.capitalize()} (physics)|{word}]]', paragraph, count=1)
+        paragraph = paragraph.replace('. ', f'.<ref name="r{i}">{{{{cite web|title={word}}}}}</ref> ', 1)
+        if i > 0:
+            paragraph = f'== Section {i} ==\n{paragraph}'
+        paragraphs.append(paragraph)
+    infobox = f'{{{{Infobox science|name={title}|image=[[File:{title}.png|thumb|{{{{small|figure}}}}]]}}}}'
+    table = '{| class="wikitable"\n|-\n| cell || cell\n|}'
+    return '\n'.join([infobox] + paragraphs[:1] + [table] + paragraphs[1:] + ['[[Category:Science]]'])
+
+
+def write_fake_dump(path: str, titles, page_chars: int = 20000, missing_rate: float = 0.1) -> int:
+    '''Writes the synthesized pages of titles as a (bz2 compressed if path ends with .bz2) MediaWiki XML dump.
+
+    Like FakeWikipedia, a deterministic missing_rate fraction of the titles has no page. Every page
+    gets a redirect from its plural, and a talk page that must not be ingested.
+
+    Returns:
+        int: Number of articles written.
+    '''
+    opener = bz2.open if path.endswith('.bz2') else open
+    num_articles = 0
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">\n')
+        f.write('  <siteinfo><sitename>Fakepedia</sitename></siteinfo>\n')
+
+        def write_page(title: str, namespace: int, text: str, redirect=None) -> None:
+            f.write(f'  <page>\n    <title>{escape(title)}</title>\n    <ns>{namespace}</ns>\n    <id>{stable_hash(title) % 10 ** 8}</id>\n')
+            if redirect is not None:
+                f.write(f'    <redirect title="{escape(redirect, {chr(34): "&quot;"})}" />\n')
+            f.write(f'    <revision>\n      <text xml:space="preserve">{escape(text)}</text>\n    </revision>\n  </page>\n')
+
+        for title in dict.fromkeys(titles):
+            if stable_hash('missing:' + title) % 1000 < missing_rate * 1000:
+                continue
+            write_page(title, 0, make_fake_wikitext(title, page_chars))
+            write_page(title + 's', 0, f'#REDIRECT [[{title}]]', redirect=title)
+            write_page('Talk:' + title, 1, f'Discussion of [[{title}]].')
+            num_articles += 1
+        f.write('</mediawiki>\n')
+    return num_articles
+
+
+class FakeOllama:
+    '''Latency model and responses of the fake Ollama server.'''
+
+    def __init__(self, chat_latency: float = 0.05, prefill_tps: float = 2000.0, decode_tps: float = 50.0, completion_tokens: int = 40,
+                 embed_latency: float = 0.01, embed_item_latency: float = 0.001, embed_dim: int = 768, parallel: int = 1, load_latency: float = 2.0, time_scale: float = 1.0):
+        self.chat_latency = chat_latency
+        self.prefill_tps = prefill_tps
+        self.decode_tps = decode_tps
+        self.completion_tokens = completion_tokens
+        self.embed_latency = embed_latency
+        self.embed_item_latency = embed_item_latency
+        self.embed_dim = embed_dim
+        # Like OLLAMA_NUM_PARALLEL: requests beyond this many wait for a free slot
+        self.slots = threading.Semaphore(max(1, parallel))
+        self.load_latency = load_latency
+        self.time_scale = time_scale
+        # model -> (num_ctx, expiry time) of the loaded models, and the last prompts of each model's slots
+        self.loaded = {}
+        self.cached_prompts = {}
+        self.parallel = max(1, parallel)
+        self.models_lock = threading.Lock()
+        # Different models load at the same time, requests for a model that is loading wait for it
+        self.load_locks = {}
+
+    def sleep(self, seconds: float) -> None:
+        if seconds * self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    @staticmethod
+    def parse_keep_alive(keep_alive) -> float:
+        '''Seconds from an Ollama keep_alive value (seconds, or a duration like "5m"). Ollama's default is 5 minutes.'''
+        if keep_alive is None:
+            return 300.0
+        if isinstance(keep_alive, str):
+            match = re.fullmatch(r'(-?[\d.]+)([smh]?)', keep_alive.strip())
+            if match is None:
+                return 300.0
+            keep_alive = float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+        return float('inf') if keep_alive < 0 else float(keep_alive)
+
+    def load(self, body: dict) -> float:
+        '''Loads the model of a request unless it is loaded with the same num_ctx, and renews its keep_alive. Returns the load time.'''
+        model = body.get('model')
+        num_ctx = (body.get('options') or {}).get('num_ctx')
+        with self.models_lock:
+            load_lock = self.load_locks.setdefault(model, threading.Lock())
+        with load_lock:
+            loaded = self.loaded.get(model)
+            load_seconds = 0.0
+            if loaded is None or loaded[0] != num_ctx or loaded[1] < time.monotonic():
+                load_seconds = self.load_latency
+                self.sleep(load_seconds)
+                with self.models_lock:
+                    self.cached_prompts[model] = deque(maxlen=self.parallel)
+            # Simulated keep_alive expires at the same scale as the other delays
+            self.loaded[model] = (num_ctx, time.monotonic() + self.parse_keep_alive(body.get('keep_alive')) * (self.time_scale or 1.0))
+        return load_seconds
+
+    def get_cached_tokens(self, model: str, prompt: str) -> int:
+        '''Tokens at the start of the prompt that are still in the KV cache of a slot, and remembers the prompt.'''
+        with self.models_lock:
+            cached = self.cached_prompts.setdefault(model, deque(maxlen=self.parallel))
+            shared = max((len(os.path.commonprefix([prompt, cached_prompt])) for cached_prompt in cached), default=0)
+            cached.append(prompt)
+        return count_tokens(prompt[:shared])
+
+    def generate(self, body: dict) -> dict:
+        '''Load-only generate request (no prompt), as used to preload a model.'''
+        load_seconds = self.load(body)
+        return {'model': body.get('model'), 'created_at': '2025-01-01T00:00:00Z', 'response': '', 'done': True, 'done_reason': 'load',
+                'total_duration': int(load_seconds * 1e9), 'load_duration': int(load_seconds * 1e9)}
+
+    def chat(self, body: dict) -> dict:
+        prompt = '\n'.join(message.get('content', '') for message in body.get('messages', []))
+        if 'what keyword' in prompt:
+            content = get_fake_keyword(prompt)
+        elif body.get('format'):
+            content = json.dumps({'answer': get_fake_answer(prompt, body.get('options'))})
+        else:
+            content = 'The context mentions the relevant facts.\nAnswer: ' + get_fake_answer(prompt, body.get('options'))
+
+        load_seconds = self.load(body)
+        # Like Ollama, prompt_eval_count only counts the tokens that were not in the KV cache
+        prompt_tokens = max(1, count_tokens(prompt) - self.get_cached_tokens(body.get('model'), prompt))
+        # A JSON answer is a few tokens long. Free text is completion_tokens long and loses its last ('Answer: X') line when num_predict cuts it off.
+        completion_tokens = count_tokens(content) if body.get('format') else self.completion_tokens
+        num_predict = body.get('options', {}).get('num_predict')
+        if num_predict is not None and num_predict < completion_tokens:
+            completion_tokens = num_predict
+            content = content[:num_predict * 4] if body.get('format') else content.split('\n')[0]
+        prefill = prompt_tokens / self.prefill_tps
+        decode = completion_tokens / self.decode_tps
+        with self.slots:
+            self.sleep(self.chat_latency + prefill + decode)
+        return {
+            'model': body.get('model'), 'created_at': '2025-01-01T00:00:00Z', 'message': {'role': 'assistant', 'content': content},
+            'done': True, 'done_reason': 'stop', 'total_duration': int((load_seconds + self.chat_latency + prefill + decode) * 1e9), 'load_duration': int(load_seconds * 1e9),
+            'prompt_eval_count': prompt_tokens, 'prompt_eval_duration': int(prefill * 1e9),
+            'eval_count': completion_tokens, 'eval_duration': int(decode * 1e9),
+        }
+
+    def embed(self, body: dict) -> dict:
+        inputs = body.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs] if inputs else []
+        load_seconds = self.load(body)
+        with self.slots:
+            self.sleep(self.embed_latency + self.embed_item_latency * len(inputs))
+        embeddings = []
+        for text in inputs:
+            vector = np.random.default_rng(stable_hash(text)).standard_normal(self.embed_dim)
+            embeddings.append((vector / np.linalg.norm(vector)).round(6).tolist())
+        return {'model': body.get('model'), 'embeddings': embeddings, 'load_duration': int(load_seconds * 1e9)}
+
+
+class FakeWikipedia:
+    '''Pages and latency of the fake MediaWiki server.'''
+
+    def __init__(self, pages_dir: str = None, page_chars: int = 20000, missing_rate: float = 0.1, latency: float = 0.05, extracts_per_response: int = 1,
+                 max_result_bytes: int = 8 * 1024 * 1024, time_scale: float = 1.0):
+        self.pages = {}
+        self.redirects = {}
+        if pages_dir is not None:
+            for file_name in os.listdir(pages_dir):
+                if file_name.endswith('.txt'):
+                    with open(os.path.join(pages_dir, file_name), 'r', encoding='utf-8') as f:
+                        self.pages[file_name[:-len('.txt')]] = f.read()
+            if os.path.exists(os.path.join(pages_dir, 'redirects.json')):
+                with open(os.path.join(pages_dir, 'redirects.json'), 'r', encoding='utf-8') as f:
+                    self.redirects = json.load(f)
+        # Without a fixture directory every title exists, except a deterministic missing_rate fraction
+        self.synthesize = pages_dir is None
+        self.page_chars = page_chars
+        self.missing_rate = missing_rate
+        self.latency = latency
+        self.extracts_per_response = extracts_per_response
+        self.max_result_bytes = max_result_bytes
+        self.time_scale = time_scale
+
+    def get_page(self, title: str):
+        if title in self.pages:
+            return self.pages[title]
+        if self.synthesize and stable_hash('missing:' + title) % 1000 >= self.missing_rate * 1000:
+            return make_fake_page(title, self.page_chars)
+        return None
+
+    def get_wikitext(self, title: str):
+        if title in self.pages:
+            return self.pages[title]
+        if self.get_page(title) is not None:
+            return make_fake_wikitext(title, self.page_chars)
+        return None
+
+    def query(self, params: dict) -> dict:
+        time.sleep(self.latency * self.time_scale)
+        normalized, redirects, pages = [], [], []
+        for title in params.get('titles', '').split('|'):
+            if title == '':
+                continue
+            name = title.replace('_', ' ').strip()
+            name = name[:1].upper() + name[1:]
+            if name != title:
+                normalized.append({'from': title, 'to': name})
+            if name in self.redirects:
+                redirects.append({'from': name, 'to': self.redirects[name]})
+                name = self.redirects[name]
+            content = self.get_wikitext(name) if params.get('prop') == 'revisions' else self.get_page(name)
+            if content is None:
+                pages.append({'ns': 0, 'title': name, 'missing': True})
+            else:
+                pages.append({'pageid': stable_hash(name) % 10 ** 8, 'ns': 0, 'title': name, 'content': content})
+
+        body = {'batchcomplete': True, 'query': {'normalized': normalized, 'redirects': redirects, 'pages': pages}}
+        found = [page for page in pages if 'content' in page]
+        if params.get('prop') == 'revisions':
+            # Like the revisions API, return the content of every page until the result size limit and continue with rvcontinue
+            start = int(params.get('rvcontinue', 0))
+            size = 0
+            for i, page in enumerate(found):
+                content = page.pop('content')
+                if i < start:
+                    continue
+                if size > 0 and size + len(content.encode('utf-8')) > self.max_result_bytes:
+                    body['continue'] = {'rvcontinue': str(i), 'continue': '||'}
+                    break
+                size += len(content.encode('utf-8'))
+                page['revisions'] = [{'slots': {'main': {'contentmodel': 'wikitext', 'contentformat': 'text/x-wiki', 'content': content}}}]
+            for page in found:
+                page.pop('content', None)
+            return body
+
+        # Like TextExtracts, hand out a limited number of extracts per response (one whole-page extract without exintro) and continue with excontinue
+        start = int(params.get('excontinue', 0))
+        for i, page in enumerate(found):
+            content = page.pop('content')
+            if start <= i < start + self.extracts_per_response:
+                page['extract'] = content
+        if start + self.extracts_per_response < len(found):
+            body['continue'] = {'excontinue': start + self.extracts_per_response, 'continue': '||'}
+        return body
+
+
+def make_ollama_handler(ollama: FakeOllama):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, body: bytes, content_type: str = 'application/json'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/api/version':
+                self.send_json(b'{"version": "0.0.0-fake"}')
+            else:
+                self.send_json(b'{"models": []}')
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/api/chat':
+                response = ollama.chat(body)
+                if body.get('stream', True):
+                    # One content chunk, then the final message with the statistics
+                    chunk = dict(response, done=False, message=response['message'])
+                    final = dict(response, message={'role': 'assistant', 'content': ''})
+                    for key in ('done_reason', 'total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration'):
+                        chunk.pop(key)
+                    self.send_json((json.dumps(chunk) + '\n' + json.dumps(final) + '\n').encode(), 'application/x-ndjson')
+                else:
+                    self.send_json(json.dumps(response).encode())
+            elif self.path == '/api/generate':
+                self.send_json(json.dumps(ollama.generate(body)).encode())
+            elif self.path == '/api/embed':
+                self.send_json(json.dumps(ollama.embed(body)).encode())
+            else:
+                self.send_json(b'{}')
+    return Handler
+
+
+def make_wikipedia_handler(wikipedia: FakeWikipedia):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != '/w/api.php':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = json.dumps(wikipedia.query(dict(urllib.parse.parse_qsl(url.query)))).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+
+def start_server(handler, port: int) -> ThreadingHTTPServer:
+    '''Serves handler on 127.0.0.1:port (0 picks a free port) in a daemon thread.'''
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_server_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--chat-latency", type=float, default=0.05, help="Fixed seconds per chat request")
+    parser.add_argument("--prefill-tps", type=float, default=2000.0, help="Prompt tokens processed per second")
+    parser.add_argument("--decode-tps", type=float, default=50.0, help="Completion tokens generated per second")
+    parser.add_argument("--completion-tokens", type=int, default=40, help="Completion tokens per answer")
+    parser.add_argument("--embed-latency", type=float, default=0.01, help="Fixed seconds per embedding request")
+    parser.add_argument("--embed-item-latency", type=float, default=0.001, help="Seconds per embedded text")
+    parser.add_argument("--embed-dim", type=int, default=768, help="Embedding dimension")
+    parser.add_argument("--load-latency", type=float, default=2.0, help="Seconds to load a model into the fake Ollama")
+    parser.add_argument("--ollama-parallel", type=int, default=1, help="Requests the fake Ollama processes at the same time (like OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--pages-dir", default=None, help="Fixture directory with <title>.txt pages (and optional redirects.json). Pages are synthesized if not set.")
+    parser.add_argument("--page-chars", type=int, default=20000, help="Length of synthesized pages")
+    parser.add_argument("--missing-rate", type=float, default=0.1, help="Fraction of titles that have no synthesized page")
+    parser.add_argument("--wiki-latency", type=float, default=0.05, help="Seconds per wikipedia request")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplies every simulated delay. 0 disables them.")
+
+
+def start_fake_servers(args, ollama_port: int = 0, wiki_port: int = 0):
+    '''Starts both fake servers from parsed add_server_args() arguments.
+
+    Returns:
+        Tuple[ThreadingHTTPServer, ThreadingHTTPServer]: The Ollama and Wikipedia servers.
+    '''
+    ollama = FakeOllama(chat_latency=args.chat_latency, prefill_tps=args.prefill_tps, decode_tps=args.decode_tps, completion_tokens=args.completion_tokens,
+                        embed_latency=args.embed_latency, embed_item_latency=args.embed_item_latency, embed_dim=args.embed_dim,
+                        parallel=args.ollama_parallel, load_latency=args.load_latency, time_scale=args.time_scale)
+    wikipedia = FakeWikipedia(pages_dir=args.pages_dir, page_chars=args.page_chars, missing_rate=args.missing_rate, latency=args.wiki_latency, time_scale=args.time_scale)
+    return start_server(make_ollama_handler(ollama), ollama_port), start_server(make_wikipedia_handler(wikipedia), wiki_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Ollama and a fake Wikipedia server", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--ollama-port", type=int, default=11434)
+    parser.add_argument("--wiki-port", type=int, default=18081)
+    parser.add_argument("--write-dump", default=None, help="Write a fake wikipedia dump to this path and exit instead of starting the servers")
+    parser.add_argument("--dump-dataset", default='data/train_data.csv', help="Dataset whose keywords (as the fake model generates them) get a page in the dump")
+    add_server_args(parser)
+    args = parser.parse_args()
+    if args.write_dump is not None:
+        import pandas as pd
+        titles = [get_fake_keyword(question) for question in pd.read_csv(args.dump_dataset)['prompt']]
+        num_articles = write_fake_dump(args.write_dump, titles, page_chars=args.page_chars, missing_rate=args.missing_rate)
+        print(f"Wrote {num_articles} articles to {args.write_dump}")
+        return
+    ollama_server, wiki_server = start_fake_servers(args, args.ollama_port, args.wiki_port)
+    print(f"Fake Ollama on http://127.0.0.1:{ollama_server.server_port}, fake Wikipedia on http://127.0.0.1:{wiki_server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+'''Ingests a MediaWiki XML dump into a local page store, so qa_rag.py can look pages up offline.
+
+Streams the dump (constant memory, .bz2 is decompressed on the fly), converts the wiki markup of
+every article to plain text and stores the articles and redirects in a single SQLite file.
+Download a dump (or a subset of one, e.g. exported science categories) from
+https://dumps.wikimedia.org/enwiki/ and run:
+
+    python other/ingest_wiki_dump.py --dump enwiki-latest-pages-articles.xml.bz2 --out wiki/enwiki.sqlite --processes 8
+    python qa_rag.py --wiki-dump wiki/enwiki.sqlite
+
+other/fake_servers.py --write-dump writes a small fixture dump to try it with.
+'''
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from src.wikidump import build_dump_store, open_wiki_dump
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingest a wikipedia dump for qa_rag.py --wiki-dump", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dump", required=True, help="MediaWiki XML dump (pages-articles.xml or .xml.bz2)")
+    parser.add_argument("--out", default='wiki/enwiki.sqlite', help="Page store to write. Ingesting into an existing store adds to it.")
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 1) - 1), help="Worker processes converting wiki markup to text")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Pages converted and written per batch")
+    parser.add_argument("--limit", type=int, default=None, help="Only ingest this many pages")
+    parser.add_argument("--lookup", nargs='*', default=[], help="Titles to look up in the store afterwards, to check it")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    args = parse_args()
+    stats = build_dump_store(args.dump, args.out, processes=args.processes, batch_size=args.batch_size, limit=args.limit)
+    print(f"Ingested {stats['articles']} articles and {stats['redirects']} redirects ({stats['skipped']} pages skipped) "
+          f"in {stats['seconds']:.1f}s ({stats['pages_per_sec']:.0f} pages/s) into {args.out} ({os.path.getsize(args.out) / 1e6:.1f} MB)")
+
+    if args.lookup:
+        pages = open_wiki_dump(args.out).fetch_pages_batch(args.lookup)
+        for keyword, page in pages.items():
+            print(f"{keyword} -> {page[0] + ': ' + page[1][:80] if page else 'not found'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+'''Runs qa_rag.py over a grid of configs, computing the stages that configs share only once.
+
+The grid is the cartesian product of the --grid values. Every config is split into a DAG of
+qa_rag.py runs:
+
+    keywords + download   one per keyword config (--kw-model, --kw-from-choices)
+      -> index            one per index config (--embed-model, --chunk-size, --chunk-overlap, --vector-store)
+        -> answer         one per config, started with --from-run on its index run
+
+Each keyword run has its own page directory and each index run its own vector db, so runs that
+don't depend on each other never write to the same files and are executed in parallel, up to
+--concurrency at a time. The LLM response and embedding caches are shared by all runs.
+
+    python other/sweep.py --dataset data/train_data.csv --grid chunk-size=1000,2000 answer-model=gemma3:1b,gemma3:4b max-context=1000,1500 -- --num-samples 50
+
+Arguments after `--` are passed to every qa_rag.py run. The results table (accuracy and the wall
+time of every stage per config) is printed as markdown and saved to results.md and results.json in
+--work-dir.
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+QA_RAG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'qa_rag.py'))
+# qa_rag.py flags each shared stage depends on. All other flags only affect the answer stage.
+KEYWORD_FLAGS = ['kw-model', 'kw-from-choices']
+INDEX_FLAGS = ['embed-model', 'chunk-size', 'chunk-overlap', 'chunker', 'vector-store']
+# Stages shown in the results table, with the run of the DAG they are taken from
+TABLE_STAGES = [('keywords', 'keywords'), ('fetch', 'keywords'), ('embed', 'index'), ('retrieve', 'answer'), ('answer', 'answer')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run qa_rag.py over a grid of configs, sharing identical upstream stages", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--dataset", required=True, help="Path to CSV dataset")
+    parser.add_argument("--grid", nargs='+', default=[], metavar='FLAG=V1,V2', help="qa_rag.py flag (without --) and the comma-separated values to sweep. Use true/false for switches.")
+    parser.add_argument("--concurrency", type=int, default=2, help="Maximum number of qa_rag.py runs at the same time.")
+    parser.add_argument("--work-dir", default='sweeps/sweep', help="Directory of the pages, indexes, runs and results of the sweep. Finished runs in it are reused.")
+    parser.add_argument("--cache-path", default='cache/llm_cache.sqlite', help="LLM response cache shared by all runs.")
+    parser.add_argument("--embedding-cache-dir", default='cache/embeddings', help="Embedding cache shared by all runs.")
+    parser.add_argument("--rerun", action="store_true", help="Run every node again, even if it finished in an earlier sweep.")
+    parser.add_argument("qa_args", nargs=argparse.REMAINDER, help="Arguments after -- are passed to every qa_rag.py run")
+    return parser.parse_args()
+
+
+def parse_grid(grid: List[str]) -> List[Dict[str, str]]:
+    '''Expands FLAG=V1,V2 specs into the list of all combinations.'''
+    axes = []
+    for spec in grid:
+        if '=' not in spec:
+            raise ValueError(f"Invalid grid spec: {spec}. Expected FLAG=V1,V2")
+        flag, values = spec.split('=', 1)
+        axes.append([(flag.lstrip('-'), value) for value in values.split(',')])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def to_cli_args(params: Dict[str, str]) -> List[str]:
+    cli_args = []
+    for flag, value in params.items():
+        if value.lower() == 'true':
+            cli_args.append(f'--{flag}')
+        elif value.lower() != 'false':
+            cli_args += [f'--{flag}', value]
+    return cli_args
+
+
+def get_node_name(params: Dict[str, str], common_args: List[str]) -> str:
+    '''Readable directory name of a node.
+
+    The short hash covers the arguments shared by all runs too, so a later sweep with other
+    arguments (e.g. another --num-samples) never reuses the runs of this one.
+    '''
+    readable = '_'.join(re.sub(r'[^\w.-]', '-', f'{flag}={value}') for flag, value in sorted(params.items())) or 'default'
+    digest = hashlib.sha256(json.dumps([params, common_args], sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    return f'{readable[:80]}_{digest}'
+
+
+class Node:
+    '''One qa_rag.py run of the sweep DAG.'''
+
+    def __init__(self, stage: str, params: Dict[str, str], node_dir: str, cli_args: List[str], parent: Optional['Node'] = None):
+        self.stage = stage
+        self.params = params
+        self.node_dir = node_dir
+        self.run_dir = os.path.join(node_dir, 'run')
+        self.report_path = os.path.join(node_dir, 'report.json')
+        self.cli_args = cli_args
+        self.parent = parent
+        self.status = 'pending'
+        self.report: Optional[Dict] = None
+
+    def is_finished(self) -> bool:
+        return os.path.exists(self.report_path)
+
+
+def build_dag(configs: List[Dict[str, str]], work_dir: str, common_args: List[str], dataset_path: str) -> Tuple[List[Node], List[Node]]:
+    '''Builds the DAG of the grid, sharing keyword and index runs between configs.
+
+    Returns:
+        Tuple[List[Node], List[Node]]: All nodes in dependency order, and the answer node of every config.
+    '''
+    common_args = ['--dataset', dataset_path] + common_args
+    nodes: Dict[Tuple[str, str], Node] = {}
+    leaves = []
+    for params in configs:
+        kw_params = {flag: value for flag, value in params.items() if flag in KEYWORD_FLAGS}
+        index_params = {flag: value for flag, value in params.items() if flag in INDEX_FLAGS}
+
+        kw_dir = os.path.join(work_dir, 'keywords', get_node_name(kw_params, common_args))
+        doc_dir = os.path.join(kw_dir, 'search_results')
+        kw_key = ('keywords', kw_dir)
+        if kw_key not in nodes:
+            nodes[kw_key] = Node('keywords', kw_params, kw_dir, to_cli_args(kw_params) + ['--doc-dir', doc_dir, '--stop-after', 'download'])
+        kw_node = nodes[kw_key]
+
+        index_dir = os.path.join(kw_dir, 'index', get_node_name(index_params, common_args))
+        db_path = os.path.join(index_dir, 'rag_db')
+        index_key = ('index', index_dir)
+        if index_key not in nodes:
+            nodes[index_key] = Node('index', index_params, index_dir, to_cli_args({**kw_params, **index_params})
+                                    + ['--doc-dir', doc_dir, '--db-path', db_path, '--stop-after', 'index', '--from-run', kw_node.run_dir], parent=kw_node)
+        index_node = nodes[index_key]
+
+        leaf = Node('answer', params, os.path.join(work_dir, 'runs', get_node_name(params, common_args)), to_cli_args(params)
+                    + ['--doc-dir', doc_dir, '--db-path', db_path, '--from-run', index_node.run_dir], parent=index_node)
+        leaves.append(leaf)
+
+    all_nodes = [node for node in nodes.values() if node.stage == 'keywords'] + [node for node in nodes.values() if node.stage == 'index'] + leaves
+    for node in all_nodes:
+        node.cli_args = common_args + node.cli_args
+    return all_nodes, leaves
+
+
+def run_node(node: Node) -> None:
+    # Runs start in the sweep's own working directory, so relative paths in the qa_rag.py arguments resolve as given.
+    # Every run writes its debug files (keywords, prompts, responses, ypred) to its node directory.
+    os.makedirs(node.node_dir, exist_ok=True)
+    command = [sys.executable, QA_RAG_PATH, '--run-dir', node.run_dir, '--report', node.report_path + '.tmp', '--output-dir', node.node_dir] + node.cli_args
+    with open(os.path.join(node.node_dir, 'qa_rag.log'), 'w', encoding='utf-8') as log:
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True)
+    # The report marks the node as finished, so it is only written once the run succeeded
+    os.replace(node.report_path + '.tmp', node.report_path)
+
+
+def run_dag(nodes: List[Node], concurrency: int, rerun: bool) -> None:
+    '''Runs every node once its parent finished, keeping up to `concurrency` runs in flight.'''
+    print_lock = threading.Lock()
+
+    def log(message: str) -> None:
+        with print_lock:
+            print(f'{time.strftime("%H:%M:%S")} {message}', flush=True)
+
+    if not rerun:
+        for node in nodes:
+            if node.is_finished():
+                node.status = 'done'
+                log(f'Reusing {node.stage} run {node.node_dir}')
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        running = {}
+        while True:
+            for node in nodes:
+                if node.status != 'pending':
+                    continue
+                if node.parent is not None and node.parent.status == 'failed':
+                    node.status = 'failed'
+                    log(f'Skipping {node.stage} run {node.node_dir}, its {node.parent.stage} run failed')
+                elif node.parent is None or node.parent.status == 'done':
+                    node.status = 'running'
+                    log(f'Starting {node.stage} run {node.node_dir}')
+                    running[executor.submit(run_node, node)] = node
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    future.result()
+                    node.status = 'done'
+                    log(f'Finished {node.stage} run {node.node_dir}')
+                except subprocess.CalledProcessError:
+                    node.status = 'failed'
+                    log(f'{node.stage} run failed, see {os.path.join(node.node_dir, "qa_rag.log")}')
+
+    for node in nodes:
+        if node.status == 'done':
+            with open(node.report_path, 'r', encoding='utf-8') as f:
+                node.report = json.load(f)
+
+
+def get_stage_time(node: Node, stage: str) -> Optional[float]:
+    if node.report is None or stage not in node.report['stages']:
+        return None
+    return node.report['stages'][stage]['wall_time']
+
+
+def make_results(leaves: List[Node], grid_flags: List[str]) -> List[Dict]:
+    results = []
+    for leaf in leaves:
+        runs = {'answer': leaf, 'index': leaf.parent, 'keywords': leaf.parent.parent}
+        row = {flag: leaf.params.get(flag) for flag in grid_flags}
+        row['status'] = leaf.status
+        row['accuracy'] = leaf.report['accuracy'] if leaf.report is not None else None
+        for stage, run in TABLE_STAGES:
+            row[f'{stage}_time'] = get_stage_time(runs[run], stage)
+        row['answer_run_time'] = leaf.report['total_wall_time'] if leaf.report is not None else None
+        results.append(row)
+    return results
+
+
+def format_table(results: List[Dict]) -> str:
+    '''Formats the results as a markdown table like the one in the README, best accuracy first.'''
+    def format_value(column: str, value) -> str:
+        if value is None:
+            return '-'
+        if column == 'accuracy':
+            return f'{value:.0%}'
+        if column.endswith('_time'):
+            return f'{value:.1f}s'
+        return str(value)
+
+    columns = list(results[0])
+    rows = [[format_value(column, row[column]) for column in columns]
+            for row in sorted(results, key=lambda row: -1 if row['accuracy'] is None else row['accuracy'], reverse=True)]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    lines = ['| ' + ' | '.join(column.ljust(width) for column, width in zip(columns, widths)) + ' |',
+             '| ' + ' | '.join('-' * width for width in widths) + ' |']
+    lines += ['| ' + ' | '.join(value.ljust(width) for value, width in zip(row, widths)) + ' |' for row in rows]
+    return '\n'.join(lines)
+
+
+def main():
+    args = parse_args()
+    qa_args = args.qa_args[1:] if args.qa_args[:1] == ['--'] else args.qa_args
+    work_dir = os.path.abspath(args.work_dir)
+    configs = parse_grid(args.grid)
+    grid_flags = list(dict.fromkeys(flag for config in configs for flag in config))
+    common_args = ['--cache-path', os.path.abspath(args.cache_path), '--embedding-cache-dir', os.path.abspath(args.embedding_cache_dir)] + qa_args
+
+    nodes, leaves = build_dag(configs, work_dir, common_args, os.path.abspath(args.dataset))
+    num_shared = sum(node.stage != 'answer' for node in nodes)
+    print(f'{len(configs)} configs -> {len(nodes)} runs ({num_shared} shared keyword/index runs), concurrency {args.concurrency}')
+    run_dag(nodes, args.concurrency, args.rerun)
+
+    results = make_results(leaves, grid_flags)
+    table = format_table(results)
+    print()
+    print(table)
+    with open(os.path.join(work_dir, 'results.md'), 'w', encoding='utf-8') as f:
+        f.write(table + '\n')
+    with open(os.path.join(work_dir, 'results.json'), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved results to {os.path.join(work_dir, "results.md")}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,28 @@
 import argparse
 import logging
+import os
 import sys
 from os import makedirs
 import time
 
-from typing import List
+from typing import Dict, List, Optional, Tuple
 import pandas as pd
 
 print("Initializing Langchain...")
-from src.prompts import get_keyword_generation_prompt, get_answer_prompt
-from src.llm import generate_keywords 
-from src.web import download_web_pages_by_keywords
-from src.rag import load_documents, chunk_document, store_chunks_in_db, retrieve_relevant_chunks
-from src.llm import generate_answers
+from src.prompts import get_keyword_generation_prompt, get_answer_prompt, get_keyword_system_prompt, get_answer_system_prompt, PROMPT_LAYOUTS, ANSWER_MODES
+from src.llm import generate_keywords_batch
+from src.web import download_web_pages_by_keywords, get_keyword_file_name
+from src.corpus import open_corpus
+from src.rag import Retriever, index_documents, retrieve_scored_chunks_batch, RETRIEVAL_MODES, VECTOR_STORE_BACKENDS
+from src.context import make_token_counter, pack_context
+from src.chunking import CHUNKERS
+from src.pipeline import run_streaming_pipeline
+from src.llm import generate_answer_trials, generate_answers, preload_models
+from src.cache import LLMCache
+from src.checkpoint import REPORT_FILE_NAME, RunState, get_answer_stage, merge_runs
+from src.metrics import metrics, save_report
 from src.utils import extract_choice_from_response
-from src.eval import evaluate_answer_list
+from src.eval import evaluate_answer_list, evaluate_trials
 
 
 def setup_logging(verbose: bool):
@@ -38,131 +46,398 @@ def setup_logging(verbose: bool):
 def parse_args():
     parser = argparse.ArgumentParser(description="Answer Multiple Choice Scientific Questions using RAG and Internet Search", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--dataset", required=True, help="Path to CSV dataset")
+    parser.add_argument("--pipeline", default='batch', choices=['batch', 'streaming'], help="'batch' runs each stage for all questions before the next one. 'streaming' moves every question through keyword -> fetch -> index/retrieve -> answer as soon as it is ready.")
     parser.add_argument("--num-samples", default=-1, type=int, help="Limit the number of questions for faster debugging. Set to -1 to use all questions.")
+    parser.add_argument("--start", type=int, default=0, help="Index of the first question to answer. With --end, splits a dataset into shards that can run separately.")
+    parser.add_argument("--end", type=int, default=None, help="Index after the last question to answer. Defaults to the end of the dataset.")
+    parser.add_argument("--run-dir", default=None, help="State directory of the run (finished stages and per-question results). Defaults to runs/<dataset>_<answer-model>_<start>-<end>.")
+    parser.add_argument("--resume", action="store_true", help="Continue the run in --run-dir, skipping questions that were already answered. Otherwise --run-dir is cleared.")
+    parser.add_argument("--output-dir", default='.', help="Directory the review files (data/keywords, data/prompts, data/responses and the ypred file) are written to.")
+    parser.add_argument("--report", default=None, help="Path of the JSON run report (per-stage timings, throughput, cache hit rates, token counts and accuracy). Defaults to report.json in --run-dir.")
+    parser.add_argument("--from-run", default=None, metavar='RUN_DIR', help="Reuse the keywords and the finished download and index stages of another run (with the same --doc-dir, --db-path and chunk config).")
+    parser.add_argument("--stop-after", default=None, choices=['keywords', 'download', 'index'], help="Stop the batch pipeline after this stage, e.g. to prepare the shared stages of a sweep.")
+    parser.add_argument("--merge-runs", nargs='+', default=None, metavar='RUN_DIR', help="Merge the results of finished (sharded) runs into --run-dir and evaluate them instead of running the pipeline.")
     parser.add_argument("--kw-model", default='gemma3:1b', help="Model used for keyword extraction")
     parser.add_argument("--answer-model", default='gemma3:1b', help="Model used to generate answers")
     parser.add_argument("--embed-model", default='nomic-embed-text', help="Model used for embedding")
+    parser.add_argument("--kw-concurrency", type=int, default=4, help="Maximum number of keyword requests sent to Ollama at the same time.")
     parser.add_argument("--kw-from-choices", action="store_true", help="Extract keywords from the choices too (if false, only extract from the question)")
+    parser.add_argument("--fetch-concurrency", type=int, default=4, help="Number of wikipedia pages downloaded at the same time.")
+    parser.add_argument("--wiki-rps", type=float, default=2.0, help="Maximum wikipedia requests per second, shared by all download workers.")
+    parser.add_argument("--wiki-batch-size", type=int, default=50, help="Number of keywords resolved per wikipedia query (max 50).")
+    parser.add_argument("--wiki-url", default=None, help="Base url of the wikipedia host (e.g. a local stub server). Defaults to https://en.wikipedia.org")
+    parser.add_argument("--wiki-dump", default=None, help="Read the pages from a local wikipedia dump store (built with other/ingest_wiki_dump.py) instead of requesting them from wikipedia.")
+    parser.add_argument("--doc-dir", default='search_results', help="Directory the downloaded wikipedia pages are saved in and indexed from.")
+    parser.add_argument("--pack-corpus", action="store_true", help="Keep the pages compressed in a single pack file (doc-dir/corpus.pack) instead of one text file per keyword. Existing text files are migrated once. A doc-dir that has a pack is always read from it.")
     parser.add_argument("--chunk-size", type=int, default=2000, help="Size of chunks for retrieval")
     parser.add_argument("--chunk-overlap", type=int, default=500, help="Overlap between chunks")
+    parser.add_argument("--chunker", default='recursive', choices=CHUNKERS, help="'recursive' cuts chunks at paragraphs, lines and words like langchain's RecursiveCharacterTextSplitter. 'sentence' cuts long paragraphs after a sentence instead of mid-sentence.")
+    parser.add_argument("--chunk-processes", type=int, default=1, help="Worker processes computing chunk boundaries while indexing (batch pipeline).")
+    parser.add_argument("--vector-store", default='chroma', choices=VECTOR_STORE_BACKENDS, help="Vector store backend. 'numpy' is an exact in-process index, fast for small corpora.")
+    parser.add_argument("--db-path", default='rag_db', help="Directory the vector stores are persisted in.")
+    parser.add_argument("--collection", default=None, help="Vector store collection name. Defaults to one derived from --embed-model, --chunk-size, --chunk-overlap and --chunker, so different configs don't share an index.")
+    parser.add_argument("--embed-batch-size", type=int, default=512, help="Number of chunks embedded and written to the vector db per request.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose logging")
     parser.add_argument("--load-kw", action="store_true", help="If set, load keywords from file.")
-    parser.add_argument("--max-context", type=int, default=5000, help="Maximum context length per question. set based on your answer generation model's context length.")
-    return parser.parse_args()
+    parser.add_argument("--max-context", type=int, default=1500, help="Maximum number of context tokens per question. set based on your answer generation model's context length.")
+    parser.add_argument("--retrieve-k", type=int, default=3, help="Number of chunks retrieved per question before packing them into the context budget.")
+    parser.add_argument("--retrieval", default='vector', choices=RETRIEVAL_MODES, help="'vector' ranks chunks by embedding similarity, 'bm25' by the lexical index only (no embedding call per question), 'hybrid' fuses both with reciprocal rank fusion.")
+    parser.add_argument("--retrieval-scope", default='keywords', choices=['keywords', 'global'], help="'keywords' searches only the pages fetched for the question's own keywords (falling back to everything if they have too few chunks), 'global' searches every indexed page.")
+    parser.add_argument("--min-scope-chunks", type=int, default=None, help="Fall back to a global search when the question's own pages have fewer chunks than this. Defaults to --retrieve-k.")
+    parser.add_argument("--rrf-k", type=int, default=60, help="Rank offset used by reciprocal rank fusion in --retrieval hybrid.")
+    parser.add_argument("--tokenizer", default=None, help="Path to the answer model's HuggingFace tokenizer.json for exact token counts. Uses --chars-per-token if not set.")
+    parser.add_argument("--chars-per-token", type=float, default=4.0, help="Characters per token used to estimate token counts when no --tokenizer is given.")
+    parser.add_argument("--answer-concurrency", type=int, default=1, help="Maximum number of answer requests sent to Ollama at the same time.")
+    parser.add_argument("--answer-timeout", type=float, default=None, help="Timeout in seconds for a single answer request. No timeout by default.")
+    parser.add_argument("--trials", type=int, default=1, help="Answer every question this many times with seeds --seed, --seed+1, ... and report the mean accuracy with a bootstrap confidence interval, the parse failure rate and the agreement between trials. Retrieval and prompts are computed once and shared. Use with --temperature above 0.")
+    parser.add_argument("--seed", type=int, default=None, help="Sampling seed of the answer model. Defaults to 0 with --trials > 1, else Ollama's default (unseeded).")
+    parser.add_argument("--temperature", type=float, default=None, help="Sampling temperature of the answer model. Defaults to the model's own.")
+    parser.add_argument("--prompt-layout", default='inline', choices=PROMPT_LAYOUTS, help="'prefix' sends the static instructions of the keyword and answer prompts as a system message before the question, so every prompt starts with the same tokens and Ollama reuses their KV cache. 'inline' interleaves them with the question.")
+    parser.add_argument("--answer-mode", default='free', choices=ANSWER_MODES, help="'free' lets the answer model reason without a limit and parses the 'Answer: X' of its last line. 'constrained' asks for the letter only, restricted to A-E by a JSON schema (Ollama structured outputs) and a few generated tokens. 'reasoning' caps the step-by-step reasoning at --reasoning-tokens, then asks for the letter in a second, constrained turn.")
+    parser.add_argument("--reasoning-tokens", type=int, default=512, help="Maximum number of reasoning tokens of an answer with --answer-mode reasoning.")
+    parser.add_argument("--keep-alive", type=int, default=1800, help="Seconds Ollama keeps the models loaded after each request (-1: until Ollama stops). Sent with every request so models stay loaded between stages.")
+    parser.add_argument("--num-ctx", type=int, default=None, help="Context size the keyword and answer models are loaded with. Sent with every request, so the model is never reloaded with another size. Defaults to the model's own.")
+    parser.add_argument("--no-preload", action="store_true", help="Don't load the keyword, answer and embedding models concurrently at startup.")
+    parser.add_argument("--answer-retries", type=int, default=3, help="How many times a failed answer request is retried (with exponential backoff).")
+    parser.add_argument("--cache-path", default='cache/llm_cache.sqlite', help="SQLite file used to cache LLM responses between runs.")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the LLM response cache.")
+    parser.add_argument("--cache-max-entries", type=int, default=None, help="Maximum number of cached LLM responses (least recently used are evicted). Unlimited by default.")
+    parser.add_argument("--embedding-cache-dir", default='cache/embeddings', help="Directory of the embedding cache, keyed by embedding model and text hash and shared by all chunk configs and runs.")
+    parser.add_argument("--no-embedding-cache", action="store_true", help="Disable the embedding cache.")
+    parser.add_argument("--cache-max-age-days", type=float, default=None, help="Evict cached LLM responses older than this many days. Never expire by default.")
+    args = parser.parse_args()
+    if args.stop_after is not None and args.pipeline != 'batch':
+        parser.error('--stop-after only works with --pipeline batch')
+    if args.wiki_rps <= 0:
+        parser.error('--wiki-rps must be above 0')
+    if args.trials > 1 and args.seed is None:
+        args.seed = 0
+    return args
 
-def main():
-    args = parse_args()
-    setup_logging(args.verbose)
+def make_answer_prompt(row: pd.Series, context: str, layout: str = 'inline', answer_mode: str = 'free') -> str:
+    choices = [row['A'], row['B'], row['C'], row['D'], row['E']]
+    return get_answer_prompt(row['prompt'], choices, context, layout, answer_mode)
 
-    # Load dataset
-    logging.info('Loading dataset...')
-    df = pd.read_csv(args.dataset)
-    if args.num_samples != -1:
-        df = df.head(args.num_samples)
-    logging.info(f'Loaded {len(df)} questions')
-    if args.verbose:
-        df.info()
-    print()
+KEYWORDS_FILE = 'data/keywords/keywords_train.txt'
 
+def load_keywords(output_dir: str = '.') -> Dict[int, List[str]]:
+    '''Reads the keywords saved by save_keywords in output_dir: question id -> keywords.
 
-    # Create kw prompt for each question
-    logging.info('Creating keyword prompts from questions...')
-    kw_prompts = []
-    for _, row in df.iterrows():
-        question = row['prompt']
-        choices : List[str] = [row['A'], row['B'], row['C'], row['D'], row['E']]
-        if args.kw_from_choices:
-            kw_prompts.append(get_keyword_generation_prompt(question, choices))
-        else:
-            kw_prompts.append(get_keyword_generation_prompt(question))
-    logging.info(f'Successfully created {len(kw_prompts)} keyword prompts')
-    logging.debug(f'Keyword prompt 1: {kw_prompts[0]}')
-    print()
+    Files of older versions have no question ids, one line per question of the whole dataset in order.
+    '''
+    keywords = {}
+    with open(os.path.join(output_dir, KEYWORDS_FILE), 'r', encoding='utf-8') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip() != '']
+    for position, line in enumerate(lines):
+        question_id, separator, keyword_line = line.partition('\t')
+        if separator == '':
+            question_id, keyword_line = position, line
+        keywords[int(question_id)] = [keyword.strip() for keyword in keyword_line.split(',') if keyword.strip() != '']
+    return keywords
+
+def save_keywords(question_ids: List[int], keywords: List[List[str]], output_dir: str = '.'):
+    # save keywords for fast debugging, merged with the questions of earlier (resumed or sharded) runs
+    path = os.path.join(output_dir, KEYWORDS_FILE)
+    makedirs(os.path.dirname(path), exist_ok=True)
+    saved = load_keywords(output_dir) if os.path.exists(path) else {}
+    saved.update(zip(question_ids, keywords))
+    with open(path, 'w', encoding='utf-8') as f:
+        for question_id in sorted(saved):
+            f.write(f'{question_id}\t{", ".join(saved[question_id])}\n')
+
+def save_answer_prompts(answer_model: str, answer_prompts: List[str], system_prompt: Optional[str] = None, output_dir: str = '.'):
+    # Save answer prompts to file for review
+    makedirs(os.path.join(output_dir, 'data/prompts'), exist_ok=True)
+    file_name = os.path.join(output_dir, f"data/prompts/{answer_model.replace(':', '_')}_prompts.txt")
+    with open(file_name, 'w', encoding='utf-8') as f:
+        if system_prompt is not None:
+            f.write(f'System message of every prompt:\n{system_prompt}\n')
+            f.write("= "*40)
+            f.write('\n')
+        for prompt in answer_prompts:
+            f.write(prompt)
+            f.write('\n')
+            f.write("- "*40)
+            f.write('\n')
+    logging.info(f'Saved answer prompts to "{file_name}"')
+
+def record_answer(run_state: RunState, question_id: int, prompt: str, response: str, trial: int = 0):
+    with metrics.timer('extract'):
+        choice = extract_choice_from_response(response)
+    run_state.record_answer(question_id, prompt, response, choice, trial)
+
+def get_default_run_dir(args) -> str:
+    dataset_name = os.path.splitext(os.path.basename(args.dataset))[0]
+    if args.merge_runs is not None:
+        return f"runs/{dataset_name}_{args.answer_model.replace(':', '_')}_merged"
+    end = args.end if args.end is not None else 'end'
+    return f"runs/{dataset_name}_{args.answer_model.replace(':', '_')}_{args.start}-{end}"
+
+def write_report(args, run_dir: str, num_questions: int, accuracy: Optional[float], **fields):
+    metrics.log_summary()
+    report = metrics.report()
+    report.update({'config': vars(args), 'num_questions': num_questions, 'accuracy': accuracy, **fields})
+    report_path = args.report if args.report is not None else os.path.join(run_dir, REPORT_FILE_NAME)
+    save_report(report, report_path)
+    logging.info(f'Saved run report to "{report_path}"')
+
+def run_batch_pipeline(args, df: pd.DataFrame, kw_prompts: List[str], keywords: Optional[List[List[str]]], retriever: Retriever, count_tokens, llm_cache: Optional[LLMCache], run_state: RunState) -> Tuple[List[List[str]], List[str], List[str]]:
+    '''Runs every stage for all questions before moving on to the next stage.'''
+    question_ids = df.index.tolist()
 
     # Genrate keywords for each question 
-    keywords = []
-    if args.load_kw:
-        logging.info(f'Loading keywords from file...')
-        with open("data/keywords/keywords_train.txt", "r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip() != '':
-                    keywords.append(line.strip().split(","))
-        logging.info(f'Successfully loaded keywords for {len(keywords)} questions')
-        if args.verbose:
-            print(keywords)
-    else:
+    if keywords is None:
         logging.info(f'Generating keywords using "{args.kw_model}"...')
-        for i, kw_prompt in enumerate(kw_prompts):
-            keywords.append(generate_keywords(args.kw_model, kw_prompt))
-            print(f'Keywords for question {i}: {", ".join(keywords[i])}')
+        keywords = [[] for _ in kw_prompts]
+        for i, keyword_list in generate_keywords_batch(args.kw_model, kw_prompts, concurrency=args.kw_concurrency, cache=llm_cache,
+                                                       system_prompt=get_keyword_system_prompt(args.prompt_layout), keep_alive=args.keep_alive, num_ctx=args.num_ctx):
+            keywords[i] = keyword_list
+            run_state.record_keywords(question_ids[i], keyword_list)
+            print(f'Keywords for question {i}: {", ".join(keyword_list)}')
         logging.info(f'Successfully generated keywords for {len(keywords)} questions')
+        if llm_cache is not None:
+            llm_cache.log_stats('keywords')
+    run_state.mark_stage_done('keywords')
     print()
 
-    # save keywords for fast debugging
-    makedirs('data/keywords', exist_ok=True)
-    with open(f'data/keywords/keywords_train.txt', 'w', encoding='utf-8') as f:
-        for keyword_list in keywords:
-            f.write(f'{", ".join(keyword_list)}\n')
+    save_keywords(question_ids, keywords, args.output_dir)
+    if args.stop_after == 'keywords':
+        return keywords, [], []
 
     # Download docs from wikipedia for each kw
-    logging.info("Downloading docs for each kw from wikipedia...")
-    makedirs('search_results', exist_ok=True)
-    for keyword_list in keywords:
-        download_web_pages_by_keywords(keywords=keyword_list, out_dir=f'search_results')
-    logging.info(f'Successfully downloaded docs for {len(keywords)} questions')
+    if run_state.is_stage_done('download'):
+        logging.info("Skipping download, already done in this run")
+    else:
+        logging.info("Downloading docs for each kw from wikipedia...")
+        all_keywords = [keyword for keyword_list in keywords for keyword in keyword_list]
+        download_web_pages_by_keywords(keywords=all_keywords, out_dir=args.doc_dir, concurrency=args.fetch_concurrency, requests_per_second=args.wiki_rps, base_url=args.wiki_url, batch_size=args.wiki_batch_size, wiki_dump=args.wiki_dump)
+        logging.info(f'Successfully downloaded docs for {len(keywords)} questions')
+        run_state.mark_stage_done('download')
     print()
+    if args.stop_after == 'download':
+        return keywords, [], []
 
     # Chunk docs and store them in vector db 
-    logging.info("Chunking docs and storing them in vector db...")
-    retrieved_docs = load_documents(doc_dir='search_results')
-    for document in retrieved_docs:
-        chunks = chunk_document(document=document, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
-        store_chunks_in_db(chunks=chunks)
-    logging.info(f'Successfully chunked docs and stored them in vector db for')
+    if run_state.is_stage_done('index'):
+        logging.info("Skipping indexing, already done in this run")
+    else:
+        logging.info("Chunking docs and storing them in vector db...")
+        index_stats = index_documents(doc_dir=args.doc_dir, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, chunker=args.chunker, chunk_processes=args.chunk_processes, batch_size=args.embed_batch_size, retriever=retriever)
+        logging.info(f'Successfully indexed {index_stats["indexed"]} docs ({index_stats["chunks"]} chunks), {index_stats["unchanged"]} unchanged, {index_stats["removed"]} removed')
+        if index_stats['chunks'] > 0:
+            logging.info(f'Indexing throughput: {index_stats["chunks_per_sec"]:.1f} chunks/sec, embedding latency per batch p50={index_stats["embed_p50"]:.2f}s p95={index_stats["embed_p95"]:.2f}s p99={index_stats["embed_p99"]:.2f}s')
+        run_state.mark_stage_done('index')
     print()
+    if args.stop_after == 'index':
+        return keywords, [], []
 
     # Retrieve relevant context for each question
     logging.info(f"Retrieving relevant context for each question(total: {len(df)})...")
-    contexts = []
-    for _, row in df.iterrows():
-        contexts.append(retrieve_relevant_chunks(question=row['prompt']))
-    logging.info(f'Successfully retrieved relevant context for {len(contexts)} questions')
+    sources = [[get_keyword_file_name(keyword) for keyword in keyword_list] for keyword_list in keywords] if args.retrieval_scope == 'keywords' else None
+    scored_contexts = retrieve_scored_chunks_batch(questions=df['prompt'].tolist(), k=args.retrieve_k, retriever=retriever, mode=args.retrieval, rrf_k=args.rrf_k,
+                                                   sources=sources, min_scope_chunks=args.min_scope_chunks)
+    for question_id, scored_chunks in zip(question_ids, scored_contexts):
+        run_state.record_context(question_id, scored_chunks)
+    logging.info(f'Successfully retrieved relevant context for {len(scored_contexts)} questions')
     print()
 
-    # Limit context length
-    logging.info(f"Limiting context length to {args.max_context} characters...")
-    contexts = [context[:args.max_context] for context in contexts]
-    logging.info(f'Successfully limited context length for {len(contexts)} questions')
+    # Pack the retrieved chunks into the context token budget
+    logging.info(f"Packing context into {args.max_context} tokens per question...")
+    contexts = []
+    context_tokens = []
+    for i, scored_chunks in enumerate(scored_contexts):
+        with metrics.timer('pack'):
+            context, num_tokens = pack_context(scored_chunks, args.max_context, count_tokens)
+        contexts.append(context)
+        context_tokens.append(num_tokens)
+        logging.debug(f'Context for question {i}: {num_tokens} tokens')
+    if len(context_tokens) > 0:
+        logging.info(f'Successfully packed context for {len(contexts)} questions (tokens per question: mean {sum(context_tokens) / len(context_tokens):.0f}, max {max(context_tokens)})')
     print()
 
     # Create answering prompts
     logging.info("Creating answering prompts...")
     answer_prompts = []
-    for i, row in df.iterrows():
-        question = row['prompt']
-        context = contexts[i]
-        choices = [row['A'], row['B'], row['C'], row['D'], row['E']]
-        answer_prompts.append(get_answer_prompt(question, choices, context))
+    for i, (_, row) in enumerate(df.iterrows()):
+        answer_prompts.append(make_answer_prompt(row, contexts[i], args.prompt_layout, args.answer_mode))
     logging.info(f'Successfully created {len(answer_prompts)} answering prompts')
-
-    # Save answer prompts to file for review
-    file_name = f"data/prompts/{args.answer_model.replace(':', '_')}_prompts.txt"
-    with open(file_name, 'w', encoding='utf-8') as f:
-        for prompt in answer_prompts:
-            f.write(prompt)
-            f.write('\n')
-            f.write("- "*40)
-            f.write('\n')
-    logging.info(f'Saved answer prompts to "{file_name}"')
     print()
 
 
     # Generate responses using llm
-    logging.info(f"Generating answers for {len(answer_prompts)} prompts...")
-    answer_responses = generate_answers(args.answer_model, answer_prompts)
+    logging.info(f"Generating answers for {len(answer_prompts)} prompts (concurrency: {args.answer_concurrency})...")
+    answer_responses = generate_answers(args.answer_model, answer_prompts, concurrency=args.answer_concurrency, timeout=args.answer_timeout, max_retries=args.answer_retries, cache=llm_cache,
+                                        seed=args.seed, temperature=args.temperature, system_prompt=get_answer_system_prompt(args.prompt_layout, args.answer_mode), keep_alive=args.keep_alive, num_ctx=args.num_ctx,
+                                        answer_mode=args.answer_mode, reasoning_tokens=args.reasoning_tokens, on_answer=lambda i, response: record_answer(run_state, question_ids[i], answer_prompts[i], response))
     logging.info(f'Successfully generated {len(answer_responses)} answers')
+    if llm_cache is not None:
+        llm_cache.log_stats('answers')
+
+    return keywords, answer_prompts, answer_responses
+
+def run_pending_questions(args, df: pd.DataFrame, keywords: Optional[List[List[str]]], llm_cache: Optional[LLMCache], run_state: RunState):
+    '''Runs the selected pipeline for the questions in df. Results are recorded in run_state.'''
+    # Create kw prompt for each question
+    logging.info('Creating keyword prompts from questions...')
+    kw_prompts = []
+    for _, row in df.iterrows():
+        question = row['prompt']
+        choices : List[str] = [row['A'], row['B'], row['C'], row['D'], row['E']]
+        if args.kw_from_choices:
+            kw_prompts.append(get_keyword_generation_prompt(question, choices, layout=args.prompt_layout))
+        else:
+            kw_prompts.append(get_keyword_generation_prompt(question, layout=args.prompt_layout))
+    logging.info(f'Successfully created {len(kw_prompts)} keyword prompts')
+    logging.debug(f'Keyword prompt 1: {kw_prompts[0]}')
+    print()
+
+    retriever = Retriever(embedding_model_name=args.embed_model, persist_directory=args.db_path, collection_name=args.collection, backend=args.vector_store, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, chunker=args.chunker,
+                          embedding_cache_dir=None if args.no_embedding_cache else args.embedding_cache_dir, keep_alive=args.keep_alive)
+    logging.info(f'Using {args.vector_store} collection "{retriever.collection_name}" in "{args.db_path}"')
+    count_tokens = make_token_counter(args.tokenizer, args.chars_per_token)
+    makedirs(args.doc_dir, exist_ok=True)
+    if args.pack_corpus:
+        open_corpus(args.doc_dir, pack=True)
+
+    if not args.no_preload:
+        # Load all models at once instead of one after the other when each stage first needs them
+        chat_models = ([args.kw_model] if keywords is None else []) + ([args.answer_model] if args.stop_after is None else [])
+        logging.info(f'Preloading {", ".join(chat_models + [args.embed_model])} (keep alive: {args.keep_alive}s, num_ctx: {args.num_ctx or "default"})...')
+        preload_models(chat_models, [args.embed_model], keep_alive=args.keep_alive, num_ctx=args.num_ctx)
+        print()
+
+    if args.pipeline == 'streaming':
+        logging.info(f'Running streaming pipeline for {len(df)} questions...')
+        rows = [row for _, row in df.iterrows()]
+        question_ids = df.index.tolist()
+        keywords, _, answer_responses = run_streaming_pipeline(
+            questions=df['prompt'].tolist(), kw_prompts=kw_prompts, make_answer_prompt=lambda i, context: make_answer_prompt(rows[i], context, args.prompt_layout, args.answer_mode),
+            retriever=retriever, count_tokens=count_tokens, kw_model=args.kw_model, answer_model=args.answer_model, keywords=keywords,
+            doc_dir=args.doc_dir, max_context_tokens=args.max_context, k=args.retrieve_k, retrieval_mode=args.retrieval, rrf_k=args.rrf_k,
+            scope_to_keywords=args.retrieval_scope == 'keywords', min_scope_chunks=args.min_scope_chunks, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, chunker=args.chunker,
+            embed_batch_size=args.embed_batch_size, kw_concurrency=args.kw_concurrency, fetch_concurrency=args.fetch_concurrency,
+            answer_concurrency=args.answer_concurrency, requests_per_second=args.wiki_rps, wiki_url=args.wiki_url, wiki_batch_size=args.wiki_batch_size, wiki_dump=args.wiki_dump,
+            answer_timeout=args.answer_timeout, answer_retries=args.answer_retries, answer_seed=args.seed, answer_temperature=args.temperature,
+            kw_system_prompt=get_keyword_system_prompt(args.prompt_layout), answer_system_prompt=get_answer_system_prompt(args.prompt_layout, args.answer_mode),
+            keep_alive=args.keep_alive, num_ctx=args.num_ctx, answer_mode=args.answer_mode, reasoning_tokens=args.reasoning_tokens, llm_cache=llm_cache,
+            on_keywords=lambda i, keyword_list: run_state.record_keywords(question_ids[i], keyword_list),
+            on_context=lambda i, scored_chunks: run_state.record_context(question_ids[i], scored_chunks),
+            on_answer=lambda i, prompt, response: record_answer(run_state, question_ids[i], prompt, response))
+        logging.info(f'Successfully generated {len(answer_responses)} answers')
+        if llm_cache is not None:
+            llm_cache.log_stats('keywords + answers')
+        save_keywords(question_ids, keywords, args.output_dir)
+        print()
+    else:
+        run_batch_pipeline(args, df, kw_prompts, keywords, retriever, count_tokens, llm_cache, run_state)
+
+def run_trials(args, df: pd.DataFrame, run_state: RunState):
+    '''Answers the prompts of the first trial again in trials 1 .. --trials - 1, skipping answers recorded before a resume.'''
+    answer_records = run_state.get_records('answer')
+    answer_prompts = [answer_records[question_id]['prompt'] for question_id in df.index]
+    jobs = [(trial, i) for trial in range(1, args.trials) for i, question_id in enumerate(df.index) if question_id not in run_state.get_records(get_answer_stage(trial))]
+    if len(jobs) == 0:
+        return
+    llm_cache = None
+    if not args.no_cache:
+        llm_cache = LLMCache(args.cache_path, max_entries=args.cache_max_entries, max_age_days=args.cache_max_age_days)
+
+    logging.info(f"Generating {len(jobs)} answers for trials 1-{args.trials - 1} (seeds {args.seed + 1}-{args.seed + args.trials - 1}, concurrency: {args.answer_concurrency})...")
+    generate_answer_trials(args.answer_model, answer_prompts, jobs, seed=args.seed, temperature=args.temperature, concurrency=args.answer_concurrency, timeout=args.answer_timeout,
+                           max_retries=args.answer_retries, cache=llm_cache, system_prompt=get_answer_system_prompt(args.prompt_layout, args.answer_mode), keep_alive=args.keep_alive, num_ctx=args.num_ctx,
+                           answer_mode=args.answer_mode, reasoning_tokens=args.reasoning_tokens, on_answer=lambda trial, i, response: record_answer(run_state, df.index[i], answer_prompts[i], response, trial))
+    if llm_cache is not None:
+        llm_cache.log_stats('trials')
+        llm_cache.close()
+    print()
+
+def main():
+    args = parse_args()
+    setup_logging(args.verbose)
+
+    # Load dataset
+    logging.info('Loading dataset...')
+    df = pd.read_csv(args.dataset)
+    if args.num_samples != -1:
+        df = df.head(args.num_samples)
+    df = df.iloc[args.start:args.end]
+    logging.info(f'Loaded {len(df)} questions')
+    if args.verbose:
+        df.info()
+    print()
+
+    run_dir = args.run_dir if args.run_dir is not None else get_default_run_dir(args)
+    if args.merge_runs is not None:
+        # Evaluate the questions answered by any of the merged runs
+        merged = merge_runs(args.merge_runs, run_dir)
+        answered_ids = sorted(merged.get('answer', {}))
+        logging.info(f'Merged {len(answered_ids)} answered questions from {len(args.merge_runs)} runs into "{run_dir}"')
+        df = df.loc[df.index.intersection(answered_ids)]
+        run_state = RunState(run_dir, resume=True)
+    else:
+        run_state = RunState(run_dir, resume=args.resume, config=vars(args))
+        logging.info(f'Run state in "{run_dir}"')
+        if args.from_run is not None:
+            run_state.inherit(args.from_run)
+            logging.info(f'Reusing the keywords and finished stages ({", ".join(run_state.stages) or "none"}) of "{args.from_run}"')
+
+        # Skip questions that were answered before the run was interrupted
+        answered = run_state.get_records('answer')
+        pending_df = df[~df.index.isin(list(answered))]
+        if args.resume:
+            logging.info(f'Resuming: {len(df) - len(pending_df)} of {len(df)} questions already answered')
+
+        if len(pending_df) > 0:
+            # Open the LLM response cache
+            llm_cache = None
+            if not args.no_cache:
+                llm_cache = LLMCache(args.cache_path, max_entries=args.cache_max_entries, max_age_days=args.cache_max_age_days)
+                logging.info(f'Using LLM cache "{args.cache_path}" ({len(llm_cache)} entries)')
+
+            # Load keywords from file if requested, else reuse the keywords recorded by the interrupted run
+            keywords = None
+            keyword_records = run_state.get_records('keywords')
+            if args.load_kw:
+                logging.info(f'Loading keywords from file...')
+                saved_keywords = load_keywords(args.output_dir)
+                logging.info(f'Successfully loaded keywords for {len(saved_keywords)} questions')
+                missing_ids = [question_id for question_id in pending_df.index if question_id not in saved_keywords]
+                if missing_ids:
+                    raise ValueError(f"{os.path.join(args.output_dir, KEYWORDS_FILE)} has no keywords for {len(missing_ids)} questions (e.g. question {missing_ids[0]}). Run without --load-kw to generate them.")
+                keywords = [saved_keywords[question_id] for question_id in pending_df.index]
+                if args.verbose:
+                    print(keywords)
+                print()
+            elif all(question_id in keyword_records for question_id in pending_df.index):
+                keywords = [keyword_records[question_id]['keywords'] for question_id in pending_df.index]
+                logging.info(f'Reusing the recorded keywords of {len(keywords)} questions')
+
+            run_pending_questions(args, pending_df, keywords, llm_cache, run_state)
+            if llm_cache is not None:
+                # Writes the access times of this run's cache hits
+                llm_cache.close()
+        if args.stop_after is not None:
+            run_state.close()
+            logging.info(f'Stopped after the {args.stop_after} stage')
+            write_report(args, run_dir, len(df), None)
+            return
+        run_state.mark_stage_done('answers')
+        if args.trials > 1:
+            run_trials(args, df, run_state)
+
+    # Collect the results of every question, including the ones answered before a resume
+    answer_records = run_state.get_records('answer')
+    answer_prompts = [answer_records[question_id]['prompt'] for question_id in df.index]
+    answer_responses = [answer_records[question_id]['response'] for question_id in df.index]
+    # Trials every question has an answer of (all of them, unless merging runs that had fewer trials)
+    trial_records = [run_state.get_records(get_answer_stage(trial)) for trial in range(args.trials)]
+    trial_records = [records for records in trial_records if all(question_id in records for question_id in df.index)]
+    run_state.close()
+    save_answer_prompts(args.answer_model, answer_prompts, get_answer_system_prompt(args.prompt_layout, args.answer_mode), args.output_dir)
+
     # Save raw responses to txt file for review
-    file_name = f"data/responses/{args.answer_model.replace(':', '_')}_responses.txt"
+    makedirs(os.path.join(args.output_dir, 'data/responses'), exist_ok=True)
+    file_name = os.path.join(args.output_dir, f"data/responses/{args.answer_model.replace(':', '_')}_responses.txt")
     with open(file_name, 'w', encoding='utf-8') as f:
         for response in answer_responses:
             f.write(response)
@@ -182,30 +457,41 @@ def main():
         if choice not in "ABCDE":
             raise ValueError(f"Invalid choice in dataset: {choice}")
     
-    # Extract choices from raw responses
-    logging.info("Extracting choices from raw responses...")
-    choices = []
-    for answer_response in answer_responses:
-        choices.append(extract_choice_from_response(answer_response))
+    # Choices were extracted from the raw responses as soon as they arrived
+    choices = [answer_records[question_id]['choice'] for question_id in df.index]
     print(f"Y_pred: {choices}")
     if len(choices) == len(ground_truth_choices):
         print(f"Y_true: {ground_truth_choices}")
 
-    logging.info(f'Successfully extracted choices for {len(choices)} responses')
+    parse_failures = sum(choice is None for choice in choices)
+    logging.info(f'Successfully extracted choices for {len(choices) - parse_failures} of {len(choices)} responses')
 
     # Save responses to txt file
-    file_name = f"{args.answer_model.replace(':', '_')}_ypred.txt"
+    file_name = os.path.join(args.output_dir, f"{args.answer_model.replace(':', '_')}_ypred.txt")
     with open(file_name, 'w', encoding="utf8") as f:
         for choice in choices:
-            f.write(choice + ', ')
+            f.write((choice or '-') + ', ')
     logging.info(f"Wrote prediction choices to {file_name}")
     print()
 
     # Calculate accuracy
+    accuracy = None
+    trials = None
     if len(choices) == len(ground_truth_choices):
         accuracy = evaluate_answer_list(choices, ground_truth_choices)
         print(f"Accuracy for {args.answer_model}: {accuracy}")
+        if len(trial_records) > 1:
+            choices_per_trial = [[records[question_id]['choice'] for question_id in df.index] for records in trial_records]
+            trials = evaluate_trials(choices_per_trial, ground_truth_choices, seed=args.seed)
+            print(f"Mean accuracy over {trials['trials']} trials: {trials['mean_accuracy']:.1%} "
+                  f"({trials['confidence']:.0%} CI {trials['ci_low']:.1%}-{trials['ci_high']:.1%}, min {trials['min_accuracy']:.1%}, max {trials['max_accuracy']:.1%})")
+            print(f"Parse failures: {trials['parse_failure_rate']:.1%}, mean agreement between trials: {trials['mean_agreement']:.1%}, "
+                  f"unanimous questions: {trials['unanimous_rate']:.1%}, majority vote accuracy: {trials['majority_vote_accuracy']:.1%}")
+            # The mean over the trials is the accuracy of the run
+            accuracy = trials['mean_accuracy']
     print()
 
+    write_report(args, run_dir, len(df), accuracy, parse_failures=parse_failures, trials=trials)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,300 @@
+from typing import Any, Dict, List, Optional
+
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from .metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LLMCache:
+    '''Persistent, content-addressed cache for LLM responses stored in a SQLite file.
+
+    Entries are keyed by sha256(model name, prompt, generation options), so changing any of them
+    results in a new request. Old entries are evicted by age and the cache is trimmed to
+    `max_entries` least recently used rows. Hits don't write to the database: their access times are
+    kept in memory and written with the next put(), evict() or close().
+    '''
+
+    def __init__(self, path: str = 'cache/llm_cache.sqlite', max_entries: Optional[int] = None, max_age_days: Optional[float] = None):
+        '''
+        Args:
+            path (str, optional): Path of the SQLite file. The parent directory is created if needed.
+            max_entries (int, optional): Maximum number of cached responses. None means unlimited.
+            max_age_days (float, optional): Entries older than this are evicted. None means they never expire.
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        # key -> time of the last hit, not written to the database yet
+        self._last_used: Dict[str, float] = {}
+
+        # The cache is shared by the worker threads of generate_answers / generate_keywords_batch
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL
+        )''')
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str, options: Dict[str, Any]) -> str:
+        '''Hashes the model name, prompt and generation options into a cache key.'''
+        payload = json.dumps({'model': model_name, 'prompt': prompt, 'options': options}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, model_name: str, prompt: str, options: Dict[str, Any]) -> Optional[str]:
+        '''Returns the cached response or None if the request has not been seen before.'''
+        key = self.make_key(model_name, prompt, options)
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._last_used[key] = time.time()
+            return row[0]
+
+    def _write_last_used(self) -> None:
+        '''Writes the buffered access times of hits. Called with the lock held; the caller commits.'''
+        if self._last_used:
+            self._conn.executemany('UPDATE responses SET last_used = ? WHERE key = ?', [(last_used, key) for key, last_used in self._last_used.items()])
+            self._last_used = {}
+
+    def put(self, model_name: str, prompt: str, options: Dict[str, Any], response: str) -> None:
+        '''Stores a response in the cache.'''
+        key = self.make_key(model_name, prompt, options)
+        now = time.time()
+        with self._lock:
+            self._last_used.pop(key, None)
+            self._write_last_used()
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, model_name, response, now, now))
+            self._conn.commit()
+
+    def evict(self) -> int:
+        '''Removes expired entries and trims the cache to max_entries.
+
+        Returns:
+            int: The number of removed entries.
+        '''
+        removed = 0
+        with self._lock:
+            # Trim by the current access times
+            self._write_last_used()
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 24 * 3600
+                removed += self._conn.execute('DELETE FROM responses WHERE created < ?', (cutoff,)).rowcount
+            if self.max_entries is not None:
+                removed += self._conn.execute(
+                    'DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)',
+                    (self.max_entries,)
+                ).rowcount
+            self._conn.commit()
+        if removed:
+            logging.info(f'Evicted {removed} entries from LLM cache "{self.path}"')
+        return removed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def log_stats(self, stage: str) -> None:
+        '''Logs the hit/miss counters and resets them for the next stage.'''
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        logging.info(f'LLM cache ({stage}): {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), {len(self)} entries')
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        '''Writes the buffered access times and closes the database.'''
+        with self._lock:
+            self._write_last_used()
+            self._conn.commit()
+            self._conn.close()
+
+
+class EmbeddingCache:
+    '''Persistent embedding cache keyed by (embedding model, sha256(text)).
+
+    Every model gets its own directory with a memory-mapped float32 matrix (`vectors.f32`, one row
+    per text) and the sha256 digests of the texts in row order (`keys.bin`, 32 bytes per row),
+    from which the hash -> row index is rebuilt on load. Rows are only appended: vectors are written
+    and flushed before their digests, so a run killed mid-write never leaves a digest pointing at an
+    unwritten row. The matrix file grows by doubling.
+
+    Appends from several processes are serialized with a lock file, and rows appended by another
+    process are picked up before writing, so parallel runs can share a cache directory.
+    '''
+
+    def __init__(self, cache_dir: str, model_name: str, initial_capacity: int = 4096):
+        '''
+        Args:
+            cache_dir (str): Root directory of the cache. Each model is stored in a subdirectory.
+            model_name (str): Name of the embedding model. Vectors of different models are never mixed.
+            initial_capacity (int, optional): Number of rows the matrix file is created with.
+        '''
+        self.model_name = model_name
+        self.directory = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self._vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self._keys_path = os.path.join(self.directory, 'keys.bin')
+        self._meta_path = os.path.join(self.directory, 'meta.json')
+        self._lock_path = os.path.join(self.directory, 'lock')
+        self.initial_capacity = initial_capacity
+
+        self._lock = threading.Lock()
+        self._index: Dict[bytes, int] = {}
+        self._dim: Optional[int] = None
+        self._vectors: Optional[np.memmap] = None
+        with self._lock, self._file_lock():
+            self._refresh()
+
+    @staticmethod
+    def make_key(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    @contextmanager
+    def _file_lock(self):
+        '''Holds an exclusive lock on the cache directory across processes (POSIX only).'''
+        with open(self._lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open_vectors(self) -> None:
+        '''Maps the vectors file, whose size is always a whole number of rows.'''
+        rows = os.path.getsize(self._vectors_path) // (self._dim * 4)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(rows, self._dim))
+
+    def _refresh(self) -> None:
+        '''Loads the rows appended to the files since the last call, including by other processes.'''
+        if self._dim is None:
+            if not os.path.exists(self._meta_path):
+                return
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                self._dim = json.load(f)['dim']
+        if not os.path.exists(self._vectors_path):
+            return
+        with open(self._keys_path, 'rb') as f:
+            f.seek(len(self._index) * 32)
+            new_keys = f.read()
+        # A partially written digest of an interrupted run is ignored and overwritten by the next append
+        num_new = len(new_keys) // 32
+        if num_new == 0 and self._vectors is not None:
+            return
+        for i in range(num_new):
+            self._index.setdefault(new_keys[i * 32:(i + 1) * 32], len(self._index))
+        self._open_vectors()
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if self._vectors is not None and self._vectors.shape[0] >= rows:
+            return
+        capacity = max(self.initial_capacity, rows, 2 * (self._vectors.shape[0] if self._vectors is not None else 0))
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._vectors_path, 'ab') as f:
+            f.truncate(capacity * self._dim * 4)
+        self._open_vectors()
+
+    def get(self, texts: List[str]) -> List[Optional[List[float]]]:
+        '''Returns the cached embedding of every text, or None for texts that are not cached.'''
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                # Pick up rows other processes appended in the meantime. Their vectors are always written before the digests.
+                self._refresh()
+            rows = [self._index.get(key) for key in keys]
+            found = [row for row in rows if row is not None]
+            vectors = iter(np.asarray(self._vectors[found]).tolist() if found else [])
+            return [next(vectors) if row is not None else None for row in rows]
+
+    def put(self, texts: List[str], embeddings: List[List[float]]) -> None:
+        '''Appends the embeddings of texts that are not cached yet.'''
+        if not texts:
+            return
+        with self._lock, self._file_lock():
+            if self._dim is None:
+                self._dim = len(embeddings[0])
+                with open(self._meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'model': self.model_name, 'dim': self._dim}, f)
+                open(self._keys_path, 'ab').close()
+            self._refresh()
+
+            new_keys, new_vectors = [], []
+            for text, embedding in zip(texts, embeddings):
+                key = self.make_key(text)
+                if key not in self._index:
+                    self._index[key] = len(self._index)
+                    new_keys.append(key)
+                    new_vectors.append(embedding)
+            if not new_keys:
+                return
+            start = len(self._index) - len(new_keys)
+            self._ensure_capacity(len(self._index))
+            self._vectors[start:start + len(new_keys)] = np.asarray(new_vectors, dtype=np.float32)
+            self._vectors.flush()
+            with open(self._keys_path, 'r+b') as f:
+                f.seek(start * 32)
+                f.write(b''.join(new_keys))
+                f.truncate()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+
+class CachedEmbeddings:
+    '''Wraps an embedding model (e.g. OllamaEmbeddings) so that only texts missing from an EmbeddingCache are sent to it.
+
+    Duplicate texts within a call are embedded once. Used for both chunk and question embeddings, with
+    one wrapper each, so that cache hits and misses are counted under the stage that times the calls.
+    '''
+
+    def __init__(self, embedding_model, cache: EmbeddingCache, stage: str = 'embed'):
+        self.embedding_model = embedding_model
+        self.cache = cache
+        self.stage = stage
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self.cache.get(texts)
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        metrics.add(self.stage, 'cache_hits', len(texts) - len(missing))
+        metrics.add(self.stage, 'cache_misses', len(missing))
+        if missing:
+            new_embeddings = self.embedding_model.embed_documents(missing)
+            self.cache.put(missing, new_embeddings)
+            new_by_text = dict(zip(missing, new_embeddings))
+            embeddings = [embedding if embedding is not None else new_by_text[text] for text, embedding in zip(texts, embeddings)]
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,179 @@
+from typing import Dict, Iterator, List, Optional
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+RESULTS_FILE_NAME = 'results.jsonl'
+STAGES_FILE_NAME = 'stages.json'
+CONFIG_FILE_NAME = 'config.json'
+REPORT_FILE_NAME = 'report.json'
+# Files a run writes to its state directory. Starting a run over only removes these.
+RUN_FILE_NAMES = [STAGES_FILE_NAME, STAGES_FILE_NAME + '.tmp', RESULTS_FILE_NAME, CONFIG_FILE_NAME, REPORT_FILE_NAME]
+
+
+def hash_prompt(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def get_answer_stage(trial: int = 0) -> str:
+    '''Stage name of the answer records of a trial. The first trial is the regular 'answer' stage.'''
+    return 'answer' if trial == 0 else f'answer_trial{trial}'
+
+
+def clear_run_dir(run_dir: str) -> None:
+    '''Removes the state files of an earlier run (RUN_FILE_NAMES) from run_dir. Other files are left alone.
+
+    Raises:
+        ValueError: If run_dir has other content but no stages.json, i.e. it doesn't look like a run directory.
+    '''
+    if not os.path.isdir(run_dir):
+        return
+    entries = os.listdir(run_dir)
+    if STAGES_FILE_NAME not in entries and any(entry not in RUN_FILE_NAMES for entry in entries):
+        raise ValueError(f'"{run_dir}" is not empty and is not a run directory (no {STAGES_FILE_NAME}). Pass another --run-dir, or --resume to continue a run in it.')
+    for entry in entries:
+        if entry in RUN_FILE_NAMES:
+            os.remove(os.path.join(run_dir, entry))
+
+
+class RunState:
+    '''Per-run state directory used to checkpoint and resume long runs.
+
+    Completed stages are kept in stages.json. Per-question results (keywords, retrieved chunk ids,
+    answers) are appended to results.jsonl as soon as they are ready and fsynced, so a crash
+    loses at most the requests that were in flight. Records are keyed by the row index of the
+    question in the dataset, so runs over different --start/--end ranges can be merged.
+    '''
+
+    def __init__(self, run_dir: str, resume: bool = False, config: Optional[Dict] = None):
+        '''
+        Args:
+            run_dir (str): The state directory of the run.
+            resume (bool, optional): Keep the existing state. Otherwise the state files of an earlier run are removed (see clear_run_dir).
+            config (Dict, optional): Run config saved to config.json for reference.
+        '''
+        self.run_dir = run_dir
+        if not resume:
+            clear_run_dir(run_dir)
+        os.makedirs(run_dir, exist_ok=True)
+        self.results_path = os.path.join(run_dir, RESULTS_FILE_NAME)
+        self.stages_path = os.path.join(run_dir, STAGES_FILE_NAME)
+
+        self.stages: List[str] = []
+        if os.path.exists(self.stages_path):
+            with open(self.stages_path, 'r', encoding='utf-8') as f:
+                self.stages = json.load(f)
+        self.records: Dict[str, Dict[int, Dict]] = {}
+        for record in read_records(self.results_path):
+            self.records.setdefault(record['stage'], {})[record['id']] = record
+
+        config_path = os.path.join(run_dir, CONFIG_FILE_NAME)
+        if config is not None and os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                old_config = json.load(f)
+            changed = sorted(key for key in set(config) | set(old_config) if key != 'resume' and config.get(key) != old_config.get(key))
+            if changed:
+                logging.warning(f'Resuming "{run_dir}" with a different config ({", ".join(changed)}), finished results are kept as they are')
+        if config is not None:
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=1)
+
+        self._lock = threading.Lock()
+        self._results_file = open(self.results_path, 'a', encoding='utf-8')
+
+    def record(self, stage: str, question_id: int, **fields) -> None:
+        '''Appends a per-question result and flushes it to disk.'''
+        record = {'stage': stage, 'id': int(question_id), **fields}
+        with self._lock:
+            self.records.setdefault(stage, {})[record['id']] = record
+            self._results_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._results_file.flush()
+            os.fsync(self._results_file.fileno())
+
+    def record_keywords(self, question_id: int, keywords: List[str]) -> None:
+        self.record('keywords', question_id, keywords=keywords)
+
+    def record_context(self, question_id: int, scored_chunks) -> None:
+        '''Records the ids and scores of the chunks retrieved for a question (ScoredChunk tuples).'''
+        self.record('context', question_id, chunk_ids=[chunk.id for chunk in scored_chunks], scores=[round(chunk.score, 4) for chunk in scored_chunks])
+
+    def record_answer(self, question_id: int, prompt: str, response: str, choice: Optional[str], trial: int = 0) -> None:
+        self.record(get_answer_stage(trial), question_id, prompt_hash=hash_prompt(prompt), prompt=prompt, response=response, choice=choice)
+
+    def get_records(self, stage: str) -> Dict[int, Dict]:
+        '''Returns the records of a stage, keyed by question id.'''
+        return self.records.get(stage, {})
+
+    def is_stage_done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def mark_stage_done(self, stage: str) -> None:
+        with self._lock:
+            if stage not in self.stages:
+                self.stages.append(stage)
+            tmp_path = self.stages_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.stages, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.stages_path)
+
+    def inherit(self, run_dir: str, stages: List[str] = ('keywords', 'download', 'index')) -> None:
+        '''Takes over the keyword records and the finished shared stages of another run.
+
+        Used to start a run from the stages another run already computed, e.g. the shared upstream
+        stages of a parameter sweep. Records this run already has are kept.
+
+        Args:
+            run_dir (str): The state directory of the other run.
+            stages (List[str], optional): Stages marked as done here if they are done in the other run.
+        '''
+        for record in read_records(os.path.join(run_dir, RESULTS_FILE_NAME)):
+            if record['stage'] == 'keywords' and record['id'] not in self.get_records('keywords'):
+                self.record_keywords(record['id'], record['keywords'])
+        stages_path = os.path.join(run_dir, STAGES_FILE_NAME)
+        if os.path.exists(stages_path):
+            with open(stages_path, 'r', encoding='utf-8') as f:
+                done = json.load(f)
+            for stage in stages:
+                if stage in done:
+                    self.mark_stage_done(stage)
+
+    def close(self) -> None:
+        self._results_file.close()
+
+
+def read_records(results_path: str) -> Iterator[Dict]:
+    '''Reads the records of a results.jsonl file. A truncated last line (crash mid-write) is ignored.'''
+    if not os.path.exists(results_path):
+        return
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def merge_runs(run_dirs: List[str], out_dir: str) -> Dict[str, Dict[int, Dict]]:
+    '''Merges the results of several (sharded) runs into out_dir/results.jsonl.
+
+    When two runs have a record for the same stage and question, the one from the later run_dir wins.
+
+    Returns:
+        Dict[str, Dict[int, Dict]]: The merged records, stage -> question id -> record.
+    '''
+    merged: Dict[str, Dict[int, Dict]] = {}
+    for run_dir in run_dirs:
+        for record in read_records(os.path.join(run_dir, RESULTS_FILE_NAME)):
+            merged.setdefault(record['stage'], {})[record['id']] = record
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, RESULTS_FILE_NAME), 'w', encoding='utf-8') as f:
+        for stage in merged:
+            for question_id in sorted(merged[stage]):
+                f.write(json.dumps(merged[stage][question_id], ensure_ascii=False) + '\n')
+    return merged
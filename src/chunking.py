@@ -0,0 +1,159 @@
+from typing import Iterable, Iterator, List, Tuple
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import re
+
+# 'recursive': the boundaries of langchain's RecursiveCharacterTextSplitter (paragraphs, lines, words)
+# 'sentence': lines, then sentences before words, so long paragraphs are cut after a sentence
+CHUNKERS = ['recursive', 'sentence']
+
+# (separator regexes tried in order, whether a piece starts with its separator ('start') or ends with it ('end'))
+CHUNKER_SEPARATORS = {
+    'recursive': ([re.escape('\n\n'), re.escape('\n'), re.escape(' '), ''], 'start'),
+    'sentence': ([r'\n\n', r'\n', r'[.!?]\s+', r' ', ''], 'end'),
+}
+
+Span = Tuple[int, int]
+
+
+def _split_spans(text: str, start: int, end: int, separator: str, keep_separator: str) -> List[Span]:
+    '''The non-empty pieces of text[start:end] cut at every match of separator, as (start, end) spans.'''
+    if separator == '':
+        return [(i, i + 1) for i in range(start, end)]
+    cuts = [start]
+    for match in re.compile(separator).finditer(text, start, end):
+        cuts.append(match.start() if keep_separator == 'start' else match.end())
+    cuts.append(end)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _strip_span(text: str, start: int, end: int) -> Span:
+    '''The span of text[start:end].strip().'''
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _merge_spans(text: str, pieces: List[Span], chunk_size: int, chunk_overlap: int, chunks: List[Span]) -> None:
+    '''Merges consecutive pieces into chunks of up to chunk_size characters that overlap by up to chunk_overlap (TextSplitter._merge_splits).'''
+    current: deque = deque()
+    total = 0
+    for piece in pieces:
+        length = piece[1] - piece[0]
+        if total + length > chunk_size and current:
+            chunk = _strip_span(text, current[0][0], current[-1][1])
+            if chunk[1] > chunk[0]:
+                chunks.append(chunk)
+            # Drop pieces from the front until the rest fits in the overlap and leaves room for this piece
+            while total > chunk_overlap or (total + length > chunk_size and total > 0):
+                first = current.popleft()
+                total -= first[1] - first[0]
+        current.append(piece)
+        total += length
+    if current:
+        chunk = _strip_span(text, current[0][0], current[-1][1])
+        if chunk[1] > chunk[0]:
+            chunks.append(chunk)
+
+
+def _chunk_spans(text: str, start: int, end: int, separators: List[str], keep_separator: str, chunk_size: int, chunk_overlap: int, chunks: List[Span]) -> None:
+    '''Recursively splits text[start:end] with the first separator it contains, like RecursiveCharacterTextSplitter._split_text.'''
+    separator, remaining = separators[-1], []
+    for i, candidate in enumerate(separators):
+        if candidate == '':
+            separator = candidate
+            break
+        if re.compile(candidate).search(text, start, end):
+            separator, remaining = candidate, separators[i + 1:]
+            break
+
+    good: List[Span] = []
+    for piece in _split_spans(text, start, end, separator, keep_separator):
+        if piece[1] - piece[0] < chunk_size:
+            good.append(piece)
+            continue
+        if good:
+            _merge_spans(text, good, chunk_size, chunk_overlap, chunks)
+            good = []
+        if remaining:
+            _chunk_spans(text, piece[0], piece[1], remaining, keep_separator, chunk_size, chunk_overlap, chunks)
+        else:
+            chunks.append(piece)
+    if good:
+        _merge_spans(text, good, chunk_size, chunk_overlap, chunks)
+
+
+def get_chunk_spans(text: str, chunk_size: int = 1000, chunk_overlap: int = 200, chunker: str = 'recursive') -> List[Span]:
+    '''Splits a document into overlapping chunks, returned as (start, end) offsets instead of strings.
+
+    With the 'recursive' chunker, text[start:end] are exactly the chunks of langchain's
+    RecursiveCharacterTextSplitter with the same chunk_size and chunk_overlap, but no substring is
+    copied until the caller slices it.
+
+    Args:
+        text (str): The document.
+        chunk_size (int, optional): Maximum length of a chunk in characters (unless a single word is longer).
+        chunk_overlap (int, optional): Maximum number of characters a chunk shares with the previous one.
+        chunker (str, optional): One of CHUNKERS.
+
+    Returns:
+        List[Tuple[int, int]]: The chunk spans, in document order.
+    '''
+    if chunker not in CHUNKER_SEPARATORS:
+        raise ValueError(f"Unknown chunker: {chunker}. Choose from {CHUNKERS}")
+    if chunk_overlap > chunk_size:
+        raise ValueError(f"Got a larger chunk overlap ({chunk_overlap}) than chunk size ({chunk_size}), should be smaller.")
+    separators, keep_separator = CHUNKER_SEPARATORS[chunker]
+    chunks: List[Span] = []
+    _chunk_spans(text, 0, len(text), separators, keep_separator, chunk_size, chunk_overlap, chunks)
+    return chunks
+
+
+def _get_chunk_spans_batch(texts: List[str], chunk_size: int, chunk_overlap: int, chunker: str) -> List[List[Span]]:
+    return [get_chunk_spans(text, chunk_size, chunk_overlap, chunker) for text in texts]
+
+
+def iter_chunk_spans(documents: Iterable[Tuple[str, str]], chunk_size: int = 1000, chunk_overlap: int = 200, chunker: str = 'recursive',
+                     processes: int = 1, batch_size: int = 32) -> Iterator[Tuple[str, str, List[Span]]]:
+    '''Chunks a stream of documents, in a pool of worker processes if processes > 1.
+
+    Workers only send the spans back, not the chunk texts. Batches of batch_size documents are
+    handed to the pool while later ones are read, with at most 2 * processes batches in flight.
+
+    Args:
+        documents (Iterable[Tuple[str, str]]): (document id, text) pairs.
+        chunk_size, chunk_overlap, chunker: See get_chunk_spans.
+        processes (int, optional): Number of worker processes.
+        batch_size (int, optional): Documents sent to a worker at once.
+
+    Yields:
+        Tuple[str, str, List[Tuple[int, int]]]: (document id, text, chunk spans) in input order.
+    '''
+    if processes <= 1:
+        for doc_id, text in documents:
+            yield doc_id, text, get_chunk_spans(text, chunk_size, chunk_overlap, chunker)
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight: deque = deque()
+
+        def finish_oldest():
+            batch, future = in_flight.popleft()
+            for (doc_id, text), spans in zip(batch, future.result()):
+                yield doc_id, text, spans
+
+        batch: List[Tuple[str, str]] = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                in_flight.append((batch, executor.submit(_get_chunk_spans_batch, [text for _, text in batch], chunk_size, chunk_overlap, chunker)))
+                batch = []
+                if len(in_flight) >= 2 * processes:
+                    yield from finish_oldest()
+        if batch:
+            in_flight.append((batch, executor.submit(_get_chunk_spans_batch, [text for _, text in batch], chunk_size, chunk_overlap, chunker)))
+        while in_flight:
+            yield from finish_oldest()
@@ -0,0 +1,98 @@
+from typing import Callable, List, Optional, Set, Tuple
+
+import math
+import re
+
+
+def make_token_counter(tokenizer_path: Optional[str] = None, chars_per_token: float = 4.0) -> Callable[[str], int]:
+    '''Returns a function that counts the tokens of a text.
+
+    Args:
+        tokenizer_path (str, optional): Path to a HuggingFace tokenizer.json of the answer model. Needs the `tokenizers` package.
+        chars_per_token (float, optional): Used when no tokenizer is given. About 4 for English text with gemma/llama tokenizers.
+
+    Returns:
+        Callable[[str], int]: The token counter.
+    '''
+    if tokenizer_path is not None:
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+    return lambda text: math.ceil(len(text) / chars_per_token)
+
+
+def get_shingles(text: str, size: int = 5) -> Set[Tuple[str, ...]]:
+    '''Returns the set of `size`-word shingles of a text, used to detect near-duplicate chunks.'''
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def truncate_to_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    '''Cuts text to at most max_tokens, preferring to end on a sentence or line boundary.'''
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Binary search the longest prefix that fits
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = text[:low]
+    boundary = max(prefix.rfind('. '), prefix.rfind('\n'))
+    if boundary > len(prefix) // 2:
+        prefix = prefix[:boundary + 1]
+    return prefix.strip()
+
+
+def pack_context(scored_chunks: List[Tuple[str, float]], max_tokens: int, count_tokens: Callable[[str], int], duplicate_threshold: float = 0.8, min_tokens: int = 32) -> Tuple[str, int]:
+    '''Greedily fills a token budget with the best retrieved chunks.
+
+    Chunks are taken in score order. A chunk whose shingles are mostly contained in an already
+    selected chunk (overlapping splits, the same passage fetched for two keywords) is dropped. The
+    last chunk that does not fit is truncated if at least min_tokens are left.
+
+    Args:
+        scored_chunks (List[Tuple[str, float]]): (chunk, similarity score, ...) tuples, e.g. ScoredChunk.
+        max_tokens (int): Token budget of the packed context.
+        count_tokens (Callable[[str], int]): Token counter, see make_token_counter.
+        duplicate_threshold (float, optional): Fraction of shared shingles above which a chunk counts as a duplicate.
+        min_tokens (int, optional): Smallest truncated chunk worth adding.
+
+    Returns:
+        Tuple[str, int]: The selected chunks joined by blank lines, and its token count.
+    '''
+    selected: List[str] = []
+    selected_shingles: List[Set[Tuple[str, ...]]] = []
+    used_tokens = 0
+    separator_tokens = count_tokens('\n\n')
+
+    for chunk, *_ in sorted(scored_chunks, key=lambda item: item[1], reverse=True):
+        chunk = chunk.strip()
+        if chunk == '':
+            continue
+        shingles = get_shingles(chunk)
+        if any(len(shingles & other) >= duplicate_threshold * min(len(shingles), len(other)) for other in selected_shingles if shingles and other):
+            continue
+
+        remaining = max_tokens - used_tokens - (separator_tokens if selected else 0)
+        if remaining < min_tokens:
+            break
+        chunk_tokens = count_tokens(chunk)
+        if chunk_tokens > remaining:
+            chunk = truncate_to_tokens(chunk, remaining, count_tokens)
+            chunk_tokens = count_tokens(chunk)
+            if chunk == '':
+                break
+
+        if selected:
+            used_tokens += separator_tokens
+        selected.append(chunk)
+        selected_shingles.append(shingles)
+        used_tokens += chunk_tokens
+
+    return '\n\n'.join(selected), used_tokens
@@ -0,0 +1,358 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from abc import ABC, abstractmethod
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PACK_FILE_NAME = 'corpus.pack'
+NOT_FOUND_FILE_NAME = '.not_found'
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+
+
+def hash_document(document: str) -> str:
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+def compress_text(text: str, codec: int = CODEC_ZLIB, level: int = 6) -> bytes:
+    data = text.encode('utf-8')
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def decompress_text(codec: int, data: bytes) -> str:
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError('Reading zstd compressed text requires the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+def get_default_codec() -> int:
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+def get_document_title(document: str) -> str:
+    '''Pages are saved as `title\n\ncontent`, so the title is the first line.'''
+    return document.split('\n', 1)[0].strip()
+
+
+class Corpus(ABC):
+    '''Interface of the stores the downloaded pages are kept in.
+
+    Documents are keyed by name, the file name form of the keyword they were fetched for
+    (see web.get_keyword_file_name), which is also the 'source' of their chunks. The keywords
+    that had no page are remembered alongside the documents.
+    '''
+
+    @abstractmethod
+    def names(self) -> List[str]:
+        '''Returns the names of all documents, sorted.'''
+
+    @abstractmethod
+    def __contains__(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def read(self, name: str) -> Optional[str]:
+        '''Returns a document, or None if there is no document with this name.'''
+
+    @abstractmethod
+    def write(self, name: str, document: str) -> None:
+        '''Adds or replaces a document.'''
+
+    @abstractmethod
+    def get_mtime(self, name: str) -> float:
+        '''Returns when a document was last written.'''
+
+    @abstractmethod
+    def get_hash(self, name: str) -> str:
+        '''Returns the sha256 hex digest of a document.'''
+
+    def iter_documents(self, names: Optional[List[str]] = None) -> Iterator[Tuple[str, str]]:
+        '''Lazily reads documents.
+
+        Args:
+            names (List[str], optional): The documents to read, in this order. Defaults to all of them. Missing ones are skipped.
+
+        Yields:
+            Tuple[str, str]: (name, document)
+        '''
+        for name in (self.names() if names is None else names):
+            document = self.read(name)
+            if document is not None:
+                yield name, document
+
+    @abstractmethod
+    def load_not_found(self) -> Set[str]:
+        '''Loads the negative cache of keywords that previously returned 404 from wikipedia.'''
+
+    @abstractmethod
+    def add_not_found(self, keywords: List[str]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class DirectoryCorpus(Corpus):
+    '''One `<name>` text file per document in a directory, with the missing keywords in `.not_found`.'''
+
+    def __init__(self, doc_dir: str):
+        self.doc_dir = doc_dir
+        os.makedirs(doc_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def names(self):
+        return sorted(filename for filename in os.listdir(self.doc_dir) if filename.endswith('.txt') and not filename.startswith('.'))
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.doc_dir, name))
+
+    def read(self, name):
+        path = os.path.join(self.doc_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write(self, name, document):
+        # Write to a hidden temporary file and rename it, so a reader (e.g. the streaming indexer) never sees a partial page
+        path = os.path.join(self.doc_dir, name)
+        tmp_path = os.path.join(self.doc_dir, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write(document)
+        os.replace(tmp_path, path)
+
+    def get_mtime(self, name):
+        return os.path.getmtime(os.path.join(self.doc_dir, name))
+
+    def get_hash(self, name):
+        return hash_document(self.read(name))
+
+    def load_not_found(self):
+        path = os.path.join(self.doc_dir, NOT_FOUND_FILE_NAME)
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'r', encoding='utf8') as f:
+            return {line.strip() for line in f if line.strip() != ''}
+
+    def add_not_found(self, keywords):
+        with self._lock:
+            with open(os.path.join(self.doc_dir, NOT_FOUND_FILE_NAME), 'a', encoding='utf8') as f:
+                for keyword in keywords:
+                    f.write(keyword + '\n')
+
+
+class PackCorpus(Corpus):
+    '''All documents compressed in one SQLite file.
+
+    Every document is one row keyed by name, holding its title, sha256 and zlib (or zstd, if the
+    `zstandard` package is installed) compressed text. Thousands of pages become a single file,
+    a lookup is one primary-key read, and checking whether a document changed only reads its
+    stored hash. The file is memory-mapped for reads and uses WAL, so other processes can read
+    it while a run appends to it.
+    '''
+
+    def __init__(self, path: str, compression: Optional[str] = None, level: int = 6, mmap_size: int = 1 << 30):
+        '''
+        Args:
+            path (str): Path of the pack file. The parent directory is created if needed.
+            compression (str, optional): 'zlib' or 'zstd' for new documents. Defaults to zstd if installed, else zlib. Documents of either codec can always be read (zstd ones if installed).
+            level (int, optional): Compression level.
+            mmap_size (int, optional): Bytes of the file SQLite may memory-map for reads.
+        '''
+        if compression is None:
+            compression = 'zstd' if get_default_codec() == CODEC_ZSTD else 'zlib'
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        if compression not in ('zlib', 'zstd'):
+            raise ValueError(f'Unknown compression "{compression}"')
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.codec = CODEC_ZSTD if compression == 'zstd' else CODEC_ZLIB
+        self.level = level
+
+        # Shared by the fetch workers, which write, and the indexer, which reads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS documents (
+            name TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            codec INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )''')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS not_found (keyword TEXT PRIMARY KEY)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+    def names(self):
+        with self._lock:
+            return [name for name, in self._conn.execute('SELECT name FROM documents ORDER BY name')]
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM documents WHERE name = ?', (name,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def read(self, name):
+        with self._lock:
+            row = self._conn.execute('SELECT codec, data FROM documents WHERE name = ?', (name,)).fetchone()
+        return None if row is None else decompress_text(*row)
+
+    def write(self, name, document, mtime: Optional[float] = None):
+        self.write_many([(name, document)], mtimes=None if mtime is None else [mtime])
+
+    def write_many(self, documents: List[Tuple[str, str]], mtimes: Optional[List[float]] = None) -> None:
+        '''Adds or replaces several (name, document) pairs in one transaction.'''
+        now = time.time()
+        rows = [(name, get_document_title(document), hash_document(document), len(document), now if mtimes is None else mtimes[i], self.codec, compress_text(document, self.codec, self.level))
+                for i, (name, document) in enumerate(documents)]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO documents (name, title, hash, size, mtime, codec, data) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    def _get_column(self, name: str, column: str):
+        with self._lock:
+            row = self._conn.execute(f'SELECT {column} FROM documents WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def get_mtime(self, name):
+        return self._get_column(name, 'mtime')
+
+    def get_hash(self, name):
+        return self._get_column(name, 'hash')
+
+    def get_title(self, name: str) -> str:
+        return self._get_column(name, 'title')
+
+    def iter_documents(self, names=None, batch_size: int = 256):
+        # Rows are fetched in batches, so only one batch of compressed documents is in memory
+        # and the lock isn't held while the caller works on them
+        if names is None:
+            names = self.names()
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            with self._lock:
+                rows = self._conn.execute(f'SELECT name, codec, data FROM documents WHERE name IN ({", ".join("?" * len(batch))})', batch).fetchall()
+            documents = {name: (codec, data) for name, codec, data in rows}
+            for name in batch:
+                if name in documents:
+                    yield name, decompress_text(*documents[name])
+
+    def load_not_found(self):
+        with self._lock:
+            return {keyword for keyword, in self._conn.execute('SELECT keyword FROM not_found')}
+
+    def add_not_found(self, keywords):
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO not_found (keyword) VALUES (?)', [(keyword,) for keyword in keywords])
+            self._conn.commit()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_directory(doc_dir: str, pack: PackCorpus, batch_size: int = 256) -> int:
+    '''Copies the text files and the missing keywords of a directory corpus into a pack.
+
+    The modification times of the files are kept, so documents that are already indexed stay
+    unchanged for index_documents. The files are left in place. A pack is only migrated into once.
+
+    Args:
+        doc_dir (str): The directory of text files.
+        pack (PackCorpus): The pack to copy them into.
+        batch_size (int, optional): Documents written per transaction.
+
+    Returns:
+        int: Number of documents copied.
+    '''
+    if pack.get_meta('migrated_from') is not None:
+        return 0
+    directory = DirectoryCorpus(doc_dir)
+    names = directory.names()
+    copied = 0
+    for start in range(0, len(names), batch_size):
+        documents, mtimes = [], []
+        for name in names[start:start + batch_size]:
+            # Read every document together with its own mtime, skipping files removed since names() was listed
+            try:
+                document = directory.read(name)
+                mtime = directory.get_mtime(name)
+            except FileNotFoundError:
+                continue
+            if document is not None:
+                documents.append((name, document))
+                mtimes.append(mtime)
+        pack.write_many(documents, mtimes=mtimes)
+        copied += len(documents)
+    pack.add_not_found(sorted(directory.load_not_found()))
+    pack.set_meta('migrated_from', os.path.abspath(doc_dir))
+    return copied
+
+
+_corpora: Dict[str, Corpus] = {}
+_corpora_lock = threading.Lock()
+
+
+def open_corpus(doc_dir: str, pack: bool = False) -> Corpus:
+    '''Returns the corpus of a document directory, shared by every caller in the process.
+
+    A directory with a pack file (doc_dir/corpus.pack) is read from and written to the pack,
+    otherwise pages are kept as one text file per keyword.
+
+    Args:
+        doc_dir (str): The document directory.
+        pack (bool, optional): Create the pack if the directory doesn't have one yet. Existing text files are migrated into it.
+
+    Returns:
+        Corpus: The corpus.
+    '''
+    key = os.path.abspath(doc_dir)
+    pack_path = os.path.join(doc_dir, PACK_FILE_NAME)
+    with _corpora_lock:
+        corpus = _corpora.get(key)
+        if corpus is None or (isinstance(corpus, DirectoryCorpus) and (pack or os.path.exists(pack_path))):
+            if pack or os.path.exists(pack_path):
+                corpus = PackCorpus(pack_path)
+                num_migrated = migrate_directory(doc_dir, corpus) if os.path.isdir(doc_dir) else 0
+                if num_migrated:
+                    logging.info(f'Migrated {num_migrated} documents of "{doc_dir}" into {pack_path}')
+            else:
+                corpus = DirectoryCorpus(doc_dir)
+            _corpora[key] = corpus
+        return corpus
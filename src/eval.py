@@ -1,4 +1,8 @@
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from collections import Counter
+
+import numpy as np
 
 
 def evaluate_answer_list(answer_list: List[str], correct_answers: List[str]) -> float:
@@ -22,6 +26,79 @@ def evaluate_answer_list(answer_list: List[str], correct_answers: List[str]) ->
     return correct / len(answer_list)
 
 
+def bootstrap_confidence_interval(correct: np.ndarray, confidence: float = 0.95, num_resamples: int = 2000, seed: int = 0) -> Tuple[float, float]:
+    '''Percentile bootstrap confidence interval of the mean accuracy.
+
+    Questions are resampled with replacement, keeping all trials of a question together, so the
+    interval covers both the choice of questions and the sampling noise between trials.
+
+    Args:
+        correct (np.ndarray): (trials, questions) matrix, 1 where a trial answered a question correctly.
+        confidence (float, optional): Confidence level of the interval.
+        num_resamples (int, optional): Number of bootstrap resamples.
+        seed (int, optional): Seed of the resampling, so the interval is reproducible.
+
+    Returns:
+        Tuple[float, float]: The lower and upper bound of the interval.
+    '''
+    per_question = correct.mean(axis=0)
+    rng = np.random.default_rng(seed)
+    means = []
+    # Resample in blocks to bound the memory of the index matrix on large datasets
+    for start in range(0, num_resamples, 256):
+        samples = rng.integers(0, len(per_question), size=(min(256, num_resamples - start), len(per_question)))
+        means.append(per_question[samples].mean(axis=1))
+    means = np.concatenate(means)
+    alpha = (1 - confidence) / 2
+    return float(np.quantile(means, alpha)), float(np.quantile(means, 1 - alpha))
+
+
+def evaluate_trials(choices_per_trial: List[List[Optional[str]]], correct_answers: List[str], confidence: float = 0.95, seed: int = 0) -> Dict:
+    '''Evaluates repeated trials over the same questions.
+
+    Args:
+        choices_per_trial (List[List[Optional[str]]]): The extracted choices of every trial, None where the response could not be parsed.
+        correct_answers (List[str]): The correct answers.
+        confidence (float, optional): Confidence level of the bootstrap interval of the mean accuracy.
+        seed (int, optional): Seed of the bootstrap resampling.
+
+    Returns:
+        Dict: trial_accuracies, mean/std/min/max accuracy, the bootstrap interval (ci_low, ci_high), parse_failure_rate,
+            the accuracy of the majority vote of the trials, the mean agreement (share of trials that gave the most common
+            answer of a question), the share of unanimous questions and the agreement of every question.
+    '''
+    correct = np.array([[choice == answer for choice, answer in zip(choices, correct_answers)] for choices in choices_per_trial], dtype=np.float64)
+    trial_accuracies = correct.mean(axis=1)
+    ci_low, ci_high = bootstrap_confidence_interval(correct, confidence=confidence, seed=seed)
+
+    agreement = []
+    majority_correct = 0
+    for question_choices, answer in zip(zip(*choices_per_trial), correct_answers):
+        counts = Counter(question_choices)
+        agreement.append(counts.most_common(1)[0][1] / len(question_choices))
+        # Parse failures don't vote. Ties go to the choice of the earliest trial.
+        votes = Counter(choice for choice in question_choices if choice is not None)
+        majority_correct += bool(votes) and votes.most_common(1)[0][0] == answer
+
+    num_answers = sum(len(choices) for choices in choices_per_trial)
+    return {
+        'trials': len(choices_per_trial),
+        'trial_accuracies': trial_accuracies.tolist(),
+        'mean_accuracy': float(trial_accuracies.mean()),
+        'std_accuracy': float(trial_accuracies.std()),
+        'min_accuracy': float(trial_accuracies.min()),
+        'max_accuracy': float(trial_accuracies.max()),
+        'confidence': confidence,
+        'ci_low': ci_low,
+        'ci_high': ci_high,
+        'parse_failure_rate': sum(choice is None for choices in choices_per_trial for choice in choices) / num_answers,
+        'majority_vote_accuracy': majority_correct / len(correct_answers),
+        'mean_agreement': float(np.mean(agreement)),
+        'unanimous_rate': float(np.mean([value == 1.0 for value in agreement])),
+        'question_agreement': agreement,
+    }
+
+
 def evaluate_ollama_model(model_name: str, dataset_file: str, num_questions: int = -1) -> Tuple[List[str], List[str], float]:
     '''Evaluates the accuracy of the answer list.
 
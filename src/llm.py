@@ -1,54 +1,333 @@
-from typing import List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import time
 from tqdm.autonotebook import tqdm
-from .prompts import get_keyword_generation_prompt, get_retrieval_prompt, get_answer_prompt
+from .prompts import get_keyword_generation_prompt, get_retrieval_prompt, get_answer_prompt, FINAL_ANSWER_PROMPT
 from .utils import extract_keywords_from_answer
+from .cache import LLMCache
+from .metrics import metrics, record_llm_usage
 from langchain_ollama import ChatOllama
-from langchain.schema import HumanMessage
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+import ollama
 import pandas as pd
 
 
-def generate_keywords(model_name: str, keyword_prompt: str) -> List[str]:
+def generate_keywords(model_name: str, keyword_prompt: str, chat_model: Optional[ChatOllama] = None, cache: Optional[LLMCache] = None) -> List[str]:
     '''Calls the LLM to generate keywords based on the keyword_prompt.
 
     Args:
         model_name (str): The name of the model to use.
-        keyword_prompt (str): The prompt to use for keyword generation.
+        keyword_prompt (str): The prompt to use for keyword generation. Should already be built with get_keyword_generation_prompt.
+        chat_model (ChatOllama, optional): An existing client to reuse. A new one is created if not given.
+        cache (LLMCache, optional): Response cache consulted before sending the prompt.
 
     Returns:
         List[str]: The keywords.
     '''
 
-    chat_model = ChatOllama(model=model_name, verbose=False)
+    if chat_model is None:
+        chat_model = ChatOllama(model=model_name, verbose=False)
 
-    full_prompt = get_keyword_generation_prompt(keyword_prompt)
-
-    response = chat_model.invoke([HumanMessage(content=full_prompt)])
+    response = invoke_with_retry(chat_model, keyword_prompt, max_retries=0, cache=cache, stage='keywords')
 
     # Extract the response content
-    keywords = extract_keywords_from_answer(response.content)
+    keywords = extract_keywords_from_answer(response)
     return keywords
 
 
-def generate_answers(model_name: str, answer_prompts: List[str]) -> List[str]:
+def generate_keywords_batch(model_name: str, keyword_prompts: List[str], concurrency: int = 4, max_retries: int = 3, retry_backoff: float = 2.0, cache: Optional[LLMCache] = None,
+                            system_prompt: Optional[str] = None, keep_alive: Optional[int] = None, num_ctx: Optional[int] = None) -> Iterator[Tuple[int, List[str]]]:
+    '''Generates keywords for a list of keyword prompts, yielding results as soon as they are ready.
+
+    One client is shared by all requests and identical prompts are only sent once, so duplicate
+    questions cost a single LLM call.
+
+    Args:
+        model_name (str): The name of the model to use.
+        keyword_prompts (List[str]): The keyword prompts, one per question.
+        concurrency (int, optional): Maximum number of requests sent to Ollama at the same time.
+        max_retries (int, optional): How many times a failed request is retried.
+        retry_backoff (float, optional): Seconds to wait before the first retry. Doubles after every failure.
+        cache (LLMCache, optional): Response cache consulted before sending a prompt.
+        system_prompt (str, optional): System message sent before every keyword prompt.
+        keep_alive (int, optional): Seconds Ollama keeps the model loaded after each request. -1 keeps it loaded.
+        num_ctx (int, optional): Context size the model is loaded with.
+
+    Yields:
+        Tuple[int, List[str]]: The index of the question in keyword_prompts and its keywords. Not in input order.
+    '''
+    chat_model = ChatOllama(model=model_name, verbose=False, keep_alive=keep_alive, num_ctx=num_ctx)
+
+    # Group question indices by prompt so each distinct prompt is sent once
+    prompt_to_indices: Dict[str, List[int]] = {}
+    for i, prompt in enumerate(keyword_prompts):
+        prompt_to_indices.setdefault(prompt, []).append(i)
+    if len(prompt_to_indices) < len(keyword_prompts):
+        logging.info(f'Collapsed {len(keyword_prompts)} keyword prompts into {len(prompt_to_indices)} distinct prompts')
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {
+            executor.submit(invoke_with_retry, chat_model, prompt, max_retries, retry_backoff, cache, 'keywords', system_prompt): prompt
+            for prompt in prompt_to_indices
+        }
+        for future in as_completed(futures):
+            keywords = extract_keywords_from_answer(future.result())
+            for i in prompt_to_indices[futures[future]]:
+                yield i, list(keywords)
+
+
+# ChatOllama fields that change the generated text and therefore belong in the cache key
+GENERATION_OPTION_FIELDS = ['temperature', 'seed', 'num_predict', 'num_ctx', 'top_k', 'top_p', 'repeat_penalty', 'repeat_last_n', 'mirostat', 'mirostat_eta', 'mirostat_tau', 'tfs_z', 'stop', 'format']
+
+
+def get_generation_options(chat_model: ChatOllama) -> Dict[str, object]:
+    '''Returns the generation options explicitly set on the chat model.'''
+    options = {}
+    for field in GENERATION_OPTION_FIELDS:
+        value = getattr(chat_model, field, None)
+        if value is not None:
+            options[field] = value
+    return options
+
+
+def invoke_with_retry(chat_model: ChatOllama, prompt: str, max_retries: int = 3, retry_backoff: float = 2.0, cache: Optional[LLMCache] = None, stage: str = 'answer', system_prompt: Optional[str] = None,
+                      history: Optional[List[Tuple[str, str]]] = None) -> str:
+    '''Sends a single prompt to the chat model, retrying with exponential backoff on failure.
+
+    Args:
+        chat_model (ChatOllama): The chat model to use.
+        prompt (str): The prompt to send.
+        max_retries (int, optional): How many times to retry after the first failed attempt.
+        retry_backoff (float, optional): Seconds to wait before the first retry. Doubles after every failure.
+        cache (LLMCache, optional): If given, the response is looked up in and saved to this cache.
+        stage (str, optional): Stage name the latency, cache hits and token counts are recorded under.
+        system_prompt (str, optional): System message sent before the prompt. Part of the cache key.
+        history (List[Tuple[str, str]], optional): Earlier (prompt, response) turns of the conversation, sent between the system message and the prompt. Part of the cache key.
+
+    Returns:
+        str: The content of the model response.
+    '''
+    start_time = time.perf_counter()
+    messages = []
+    if system_prompt is not None:
+        messages.append(SystemMessage(content=system_prompt))
+    for turn_prompt, turn_response in history or []:
+        messages += [HumanMessage(content=turn_prompt), AIMessage(content=turn_response)]
+    messages.append(HumanMessage(content=prompt))
+    if cache is not None:
+        options = get_generation_options(chat_model)
+        if system_prompt is not None:
+            options['system'] = system_prompt
+        if history:
+            options['history'] = [list(turn) for turn in history]
+        cached_response = cache.get(chat_model.model, prompt, options)
+        if cached_response is not None:
+            metrics.add(stage, 'cache_hits')
+            metrics.record(stage, time.perf_counter() - start_time)
+            return cached_response
+        metrics.add(stage, 'cache_misses')
+
+    delay = retry_backoff
+    for attempt in range(max_retries + 1):
+        try:
+            response = chat_model.invoke(messages)
+            if cache is not None:
+                cache.put(chat_model.model, prompt, options, response.content)
+            metrics.record(stage, time.perf_counter() - start_time)
+            record_llm_usage(stage, response.response_metadata)
+            return response.content
+        except Exception as e:
+            if attempt == max_retries:
+                metrics.add(stage, 'failures')
+                raise
+            metrics.add(stage, 'retries')
+            logging.warning(f'LLM request failed ({e}), retrying in {delay:.1f}s ({attempt + 1}/{max_retries})')
+            time.sleep(delay)
+            delay *= 2
+
+
+# JSON schema of constrained answers. Ollama only samples tokens that keep the output valid, so the answer is always one of the letters.
+ANSWER_SCHEMA = {'type': 'object', 'properties': {'answer': {'type': 'string', 'enum': ['A', 'B', 'C', 'D', 'E']}}, 'required': ['answer']}
+
+# Generation cap of a constrained answer. {"answer": "A"} takes about 7 tokens, so this only cuts off a model that doesn't stop.
+ANSWER_NUM_PREDICT = 16
+
+
+def get_answer_chat_model(model_name: str, timeout: Optional[float] = None, seed: Optional[int] = None, temperature: Optional[float] = None, keep_alive: Optional[int] = None, num_ctx: Optional[int] = None,
+                          num_predict: Optional[int] = None, constrained: bool = False) -> ChatOllama:
+    '''Creates the chat model used to answer questions. Ollama's defaults are used for the options that are None.
+
+    With constrained, the output follows ANSWER_SCHEMA and is capped at ANSWER_NUM_PREDICT tokens unless num_predict is given.
+    '''
+    if constrained:
+        return ChatOllama(model=model_name, client_kwargs={'timeout': timeout}, seed=seed, temperature=temperature, keep_alive=keep_alive, num_ctx=num_ctx,
+                          num_predict=num_predict or ANSWER_NUM_PREDICT, format=ANSWER_SCHEMA)
+    return ChatOllama(model=model_name, client_kwargs={'timeout': timeout}, seed=seed, temperature=temperature, keep_alive=keep_alive, num_ctx=num_ctx, num_predict=num_predict)
+
+
+def get_answer_chat_models(model_name: str, answer_mode: str = 'free', reasoning_tokens: int = 512, **kwargs) -> Tuple[ChatOllama, Optional[ChatOllama]]:
+    '''Creates the chat models of an answer mode (see prompts.ANSWER_MODES).
+
+    Args:
+        model_name (str): The name of the model to use.
+        answer_mode (str, optional): 'free', 'constrained' or 'reasoning'.
+        reasoning_tokens (int, optional): Maximum number of reasoning tokens in the 'reasoning' mode.
+        **kwargs: timeout, seed, temperature, keep_alive and num_ctx, passed to get_answer_chat_model.
+
+    Returns:
+        Tuple[ChatOllama, Optional[ChatOllama]]: The model of the answer prompt and, in the 'reasoning' mode, the constrained model of the final answer turn.
+    '''
+    if answer_mode == 'free':
+        return get_answer_chat_model(model_name, **kwargs), None
+    if answer_mode == 'constrained':
+        return get_answer_chat_model(model_name, constrained=True, **kwargs), None
+    if answer_mode == 'reasoning':
+        return get_answer_chat_model(model_name, num_predict=reasoning_tokens, **kwargs), get_answer_chat_model(model_name, constrained=True, **kwargs)
+    raise ValueError(f"Unknown answer mode: {answer_mode}")
+
+
+def answer_with_retry(chat_models: Tuple[ChatOllama, Optional[ChatOllama]], prompt: str, max_retries: int = 3, retry_backoff: float = 2.0, cache: Optional[LLMCache] = None, system_prompt: Optional[str] = None) -> str:
+    '''Answers one answer prompt with the chat models of get_answer_chat_models.
+
+    Without a final answer model this is invoke_with_retry. Otherwise the (capped) reasoning is
+    recorded under the 'answer_reasoning' stage, the final answer turn under 'answer_final' and the
+    whole question under 'answer', and the response is the reasoning followed by the JSON answer.
+
+    Returns:
+        str: The response to parse with extract_choice_from_response.
+    '''
+    chat_model, final_model = chat_models
+    if final_model is None:
+        return invoke_with_retry(chat_model, prompt, max_retries, retry_backoff, cache, 'answer', system_prompt)
+    start_time = time.perf_counter()
+    reasoning = invoke_with_retry(chat_model, prompt, max_retries, retry_backoff, cache, 'answer_reasoning', system_prompt)
+    final_answer = invoke_with_retry(final_model, FINAL_ANSWER_PROMPT, max_retries, retry_backoff, cache, 'answer_final', system_prompt, history=[(prompt, reasoning)])
+    metrics.record('answer', time.perf_counter() - start_time)
+    return f'{reasoning}\n{final_answer}'
+
+
+def preload_models(chat_models: List[str], embedding_models: List[str], keep_alive: Optional[int] = None, num_ctx: Optional[int] = None) -> Dict[str, float]:
+    '''Loads the models into Ollama concurrently, before the first request of the run needs them.
+
+    Every request of a run must use the same keep_alive and num_ctx as the preload: a request
+    without keep_alive resets the model's expiry to Ollama's default, and a different num_ctx
+    reloads the model.
+
+    Args:
+        chat_models (List[str]): Chat models, loaded with num_ctx.
+        embedding_models (List[str]): Embedding models.
+        keep_alive (int, optional): Seconds Ollama keeps the models loaded after each request. -1 keeps them loaded.
+        num_ctx (int, optional): Context size of the chat models.
+
+    Returns:
+        Dict[str, float]: Seconds it took to load every model (0 if it was already loaded), as reported by Ollama.
+    '''
+    client = ollama.Client()
+    options = {'num_ctx': num_ctx} if num_ctx is not None else None
+
+    def load(model_name: str, is_chat: bool) -> float:
+        start_time = time.perf_counter()
+        if is_chat:
+            # A generate request without a prompt only loads the model
+            response = client.generate(model=model_name, keep_alive=keep_alive, options=options)
+        else:
+            response = client.embed(model=model_name, input='', keep_alive=keep_alive)
+        metrics.record('preload', time.perf_counter() - start_time)
+        load_seconds = (response.load_duration or 0) * 1e-9
+        metrics.add('preload', 'load_seconds', load_seconds)
+        return load_seconds
+
+    models = [(model_name, True) for model_name in dict.fromkeys(chat_models)] + [(model_name, False) for model_name in dict.fromkeys(embedding_models)]
+    with ThreadPoolExecutor(max_workers=max(1, len(models))) as executor:
+        load_times = dict(zip((model_name for model_name, _ in models), executor.map(lambda model: load(*model), models)))
+    for model_name, load_seconds in load_times.items():
+        logging.info(f'Preloaded "{model_name}" in {load_seconds:.2f}s')
+    return load_times
+
+
+def generate_answers(model_name: str, answer_prompts: List[str], concurrency: int = 1, timeout: Optional[float] = None, max_retries: int = 3, retry_backoff: float = 2.0, cache: Optional[LLMCache] = None, on_answer: Optional[Callable[[int, str], None]] = None,
+                     seed: Optional[int] = None, temperature: Optional[float] = None, system_prompt: Optional[str] = None, keep_alive: Optional[int] = None, num_ctx: Optional[int] = None,
+                     answer_mode: str = 'free', reasoning_tokens: int = 512) -> List[str]:
     '''Generates answers using the specified model for each answer prompt.
 
+    Up to `concurrency` requests are kept in flight at once. The answers are always returned in the same order as `answer_prompts`.
+
     Args:
         model_name (str): The name of the model to use.
         answer_prompts (List[str]): The answer prompts to use.
+        concurrency (int, optional): Maximum number of requests sent to Ollama at the same time.
+        timeout (float, optional): Timeout in seconds for a single request. None means no timeout.
+        max_retries (int, optional): How many times a failed request is retried.
+        retry_backoff (float, optional): Seconds to wait before the first retry. Doubles after every failure.
+        cache (LLMCache, optional): Response cache consulted before sending a prompt.
+        on_answer (Callable[[int, str], None], optional): Called with (index, answer) as soon as each answer arrives, e.g. to checkpoint it.
+        seed (int, optional): Sampling seed. With a seed, the same prompt gives the same answer.
+        temperature (float, optional): Sampling temperature.
+        system_prompt (str, optional): System message sent before every answer prompt.
+        keep_alive (int, optional): Seconds Ollama keeps the model loaded after each request. -1 keeps it loaded.
+        num_ctx (int, optional): Context size the model is loaded with.
+        answer_mode (str, optional): One of prompts.ANSWER_MODES. The prompts must be built for the same mode.
+        reasoning_tokens (int, optional): Maximum number of reasoning tokens in the 'reasoning' mode.
 
     Returns:
         List[str]: The answers.
     '''
-    chat_model = ChatOllama(model=model_name)
+    chat_models = get_answer_chat_models(model_name, answer_mode, reasoning_tokens, timeout=timeout, seed=seed, temperature=temperature, keep_alive=keep_alive, num_ctx=num_ctx)
 
-    answer_list = []
-    for prompt in tqdm(answer_prompts):
-        response = chat_model.invoke([HumanMessage(content=prompt)])
-        answer_list.append(response.content)
+    answer_list = [None] * len(answer_prompts)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {
+            executor.submit(answer_with_retry, chat_models, prompt, max_retries, retry_backoff, cache, system_prompt): i
+            for i, prompt in enumerate(answer_prompts)
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            i = futures[future]
+            answer_list[i] = future.result()
+            if on_answer is not None:
+                on_answer(i, answer_list[i])
 
     return answer_list
 
 
+def generate_answer_trials(model_name: str, answer_prompts: List[str], jobs: List[Tuple[int, int]], seed: int = 0, temperature: Optional[float] = None, concurrency: int = 1, timeout: Optional[float] = None,
+                           max_retries: int = 3, retry_backoff: float = 2.0, cache: Optional[LLMCache] = None, on_answer: Optional[Callable[[int, int, str], None]] = None,
+                           system_prompt: Optional[str] = None, keep_alive: Optional[int] = None, num_ctx: Optional[int] = None, answer_mode: str = 'free', reasoning_tokens: int = 512) -> Dict[Tuple[int, int], str]:
+    '''Answers the same prompts in several seeded trials, sharing one pool of `concurrency` requests between all trials.
+
+    Trial t samples with seed `seed + t`, so every trial is reproducible and, with the cache, only
+    ever generated once.
+
+    Args:
+        model_name (str): The name of the model to use.
+        answer_prompts (List[str]): The answer prompts.
+        jobs (List[Tuple[int, int]]): The (trial, prompt index) pairs to answer.
+        seed (int, optional): Seed of trial 0.
+        temperature (float, optional): Sampling temperature. Trials only differ if it is above 0.
+        on_answer (Callable[[int, int, str], None], optional): Called with (trial, index, answer) as soon as each answer arrives.
+        Other arguments are the same as in generate_answers.
+
+    Returns:
+        Dict[Tuple[int, int], str]: The answer of every job.
+    '''
+    chat_models = {trial: get_answer_chat_models(model_name, answer_mode, reasoning_tokens, timeout=timeout, seed=seed + trial, temperature=temperature, keep_alive=keep_alive, num_ctx=num_ctx)
+                   for trial in sorted(set(trial for trial, _ in jobs))}
+
+    answers = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {
+            executor.submit(answer_with_retry, chat_models[trial], answer_prompts[i], max_retries, retry_backoff, cache, system_prompt): (trial, i)
+            for trial, i in jobs
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            trial, i = futures[future]
+            answers[trial, i] = future.result()
+            if on_answer is not None:
+                on_answer(trial, i, answers[trial, i])
+
+    return answers
+
+
 # Used during testing DO NOT USE
 def generate_answers_dataset(model_name: str, dataset_file: str, num_questions: int = -1) -> List[str]:
     '''Applies the answer_prompt to all questions in the dataset and returns the answer_list.
@@ -0,0 +1,142 @@
+from typing import Dict, Optional
+
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from .utils import percentile
+
+
+class RunMetrics:
+    '''Collects per-stage timings and counters of a run.
+
+    Every stage keeps the latency of each recorded call (one item or one batch of items), the
+    number of items processed, free-form counters (cache hits, HTTP bytes, tokens, ...) and the
+    time span from its first start to its last end. In streaming mode stages overlap, so the
+    wall times of the stages don't add up to the run time.
+
+    The collector is thread-safe. The pipeline modules record into the module-level `metrics`
+    instance, in the same way they log through the logging module.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages: Dict[str, Dict] = {}
+            self._start_time = time.perf_counter()
+
+    def _get_stage(self, stage: str) -> Dict:
+        if stage not in self._stages:
+            self._stages[stage] = {'first_start': None, 'last_end': None, 'latencies': [], 'items': 0, 'counters': {}}
+        return self._stages[stage]
+
+    def _extend_span(self, stats: Dict, start: float, end: float) -> None:
+        if stats['first_start'] is None or start < stats['first_start']:
+            stats['first_start'] = start
+        if stats['last_end'] is None or end > stats['last_end']:
+            stats['last_end'] = end
+
+    def record(self, stage: str, seconds: float, items: int = 1) -> None:
+        '''Records one call of a stage that just finished after `seconds` and processed `items` items.'''
+        end = time.perf_counter()
+        with self._lock:
+            stats = self._get_stage(stage)
+            stats['latencies'].append(seconds)
+            stats['items'] += items
+            self._extend_span(stats, end - seconds, end)
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1):
+        '''Times the enclosed call and records it with record().'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, items)
+
+    def add(self, stage: str, counter: str, value: float = 1) -> None:
+        '''Adds value to a counter of a stage.'''
+        with self._lock:
+            counters = self._get_stage(stage)['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    def report(self) -> Dict[str, Dict]:
+        '''Returns the summary of every stage.
+
+        Returns:
+            Dict[str, Dict]: stage -> wall_time, items, items_per_sec, calls, busy_time, latency_p50/p95/p99,
+                the counters and the rates derived from them (cache_hit_rate, tokens per second, prefill per response).
+        '''
+        with self._lock:
+            report = {'total_wall_time': time.perf_counter() - self._start_time, 'stages': {}}
+            for stage, stats in self._stages.items():
+                wall_time = stats['last_end'] - stats['first_start'] if stats['first_start'] is not None else 0.0
+                summary = {
+                    'wall_time': wall_time,
+                    'items': stats['items'],
+                    'items_per_sec': stats['items'] / wall_time if wall_time > 0 else 0.0,
+                    'calls': len(stats['latencies']),
+                    # Time spent inside the recorded calls; smaller than wall_time when calls are interleaved with other stages
+                    'busy_time': sum(stats['latencies']),
+                }
+                for q in (50, 95, 99):
+                    summary[f'latency_p{q}'] = percentile(stats['latencies'], q)
+                counters = dict(stats['counters'])
+                summary.update(counters)
+
+                lookups = counters.get('cache_hits', 0) + counters.get('cache_misses', 0)
+                if lookups > 0:
+                    summary['cache_hit_rate'] = counters.get('cache_hits', 0) / lookups
+                if counters.get('prompt_eval_seconds', 0) > 0:
+                    summary['prompt_tokens_per_sec'] = counters['prompt_tokens'] / counters['prompt_eval_seconds']
+                if counters.get('eval_seconds', 0) > 0:
+                    summary['completion_tokens_per_sec'] = counters['completion_tokens'] / counters['eval_seconds']
+                if counters.get('responses', 0) > 0:
+                    # Prompt tokens found in Ollama's KV cache are not evaluated, so both drop with prefix-stable prompts
+                    summary['prompt_tokens_per_response'] = counters.get('prompt_tokens', 0) / counters['responses']
+                    summary['prefill_seconds_per_response'] = counters.get('prompt_eval_seconds', 0) / counters['responses']
+                report['stages'][stage] = summary
+        return report
+
+    def log_summary(self) -> None:
+        for stage, summary in self.report()['stages'].items():
+            line = f'{stage}: {summary["items"]} items in {summary["wall_time"]:.2f}s ({summary["items_per_sec"]:.1f}/s), latency p50={summary["latency_p50"]:.3f}s p95={summary["latency_p95"]:.3f}s p99={summary["latency_p99"]:.3f}s'
+            if 'cache_hit_rate' in summary:
+                line += f', cache hit rate {summary["cache_hit_rate"]:.0%}'
+            if 'completion_tokens_per_sec' in summary:
+                line += f', {summary["completion_tokens_per_sec"]:.1f} completion tokens/s'
+            if 'prefill_seconds_per_response' in summary:
+                line += f', prefill {summary["prefill_seconds_per_response"]:.3f}s ({summary["prompt_tokens_per_response"]:.0f} tokens) per response'
+            if summary.get('load_seconds', 0) > 0:
+                line += f', {summary["load_seconds"]:.2f}s loading models'
+            if 'http_bytes' in summary:
+                line += f', {summary["http_bytes"] / 1e6:.2f} MB downloaded'
+            logging.info(line)
+
+
+def record_llm_usage(stage: str, response_metadata: Optional[Dict]) -> None:
+    '''Adds the token counts and durations that Ollama reports with every chat response.'''
+    if not response_metadata:
+        return
+    metrics.add(stage, 'responses')
+    # Durations are in nanoseconds
+    for counter, key, scale in (('prompt_tokens', 'prompt_eval_count', 1), ('completion_tokens', 'eval_count', 1),
+                                ('prompt_eval_seconds', 'prompt_eval_duration', 1e-9), ('eval_seconds', 'eval_duration', 1e-9),
+                                ('load_seconds', 'load_duration', 1e-9)):
+        value = response_metadata.get(key)
+        if value is not None:
+            metrics.add(stage, counter, value * scale)
+
+
+def save_report(report: Dict, path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+
+# Collector shared by all pipeline modules
+metrics = RunMetrics()
@@ -0,0 +1,218 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+import logging
+import queue
+import threading
+
+from .cache import LLMCache
+from .context import pack_context
+from .llm import answer_with_retry, generate_keywords_batch, get_answer_chat_models
+from .metrics import metrics
+from .rag import Retriever, ScoredChunk, count_scope_chunks, index_documents, load_index_manifest, retrieve_scored_chunks_batch
+from .web import TokenBucket, create_session, download_web_pages_by_keywords, get_keyword_file_name
+
+# Marks the end of a stage's output
+_DONE = None
+
+
+def _drain(stage_queue: queue.Queue, first, max_items: int) -> Tuple[list, bool]:
+    '''Takes whatever else is already waiting in the queue (up to max_items) without blocking.
+
+    Returns:
+        Tuple[list, bool]: The items and whether the end-of-stream marker was seen.
+    '''
+    items = [first]
+    while len(items) < max_items:
+        try:
+            item = stage_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def run_streaming_pipeline(questions: List[str], kw_prompts: List[str], make_answer_prompt: Callable[[int, str], str], retriever: Retriever, count_tokens: Callable[[str], int],
+                           kw_model: str, answer_model: str, keywords: Optional[List[List[str]]] = None, doc_dir: str = 'search_results',
+                           max_context_tokens: int = 1500, k: int = 3, retrieval_mode: str = 'vector', rrf_k: int = 60, scope_to_keywords: bool = True, min_scope_chunks: Optional[int] = None, chunk_size: int = 2000, chunk_overlap: int = 500, chunker: str = 'recursive', embed_batch_size: int = 512,
+                           kw_concurrency: int = 4, fetch_concurrency: int = 4, answer_concurrency: int = 1, requests_per_second: float = 2.0,
+                           wiki_url: Optional[str] = None, wiki_batch_size: int = 50, wiki_dump: Optional[str] = None, answer_timeout: Optional[float] = None, answer_retries: int = 3,
+                           answer_seed: Optional[int] = None, answer_temperature: Optional[float] = None, kw_system_prompt: Optional[str] = None, answer_system_prompt: Optional[str] = None,
+                           keep_alive: Optional[int] = None, num_ctx: Optional[int] = None, answer_mode: str = 'free', reasoning_tokens: int = 512, llm_cache: Optional[LLMCache] = None, queue_size: int = 8, on_keywords: Optional[Callable[[int, List[str]], None]] = None,
+                           on_context: Optional[Callable[[int, List[ScoredChunk]], None]] = None, on_answer: Optional[Callable[[int, str, str], None]] = None) -> Tuple[List[List[str]], List[str], List[str]]:
+    '''Runs keyword -> fetch -> index/retrieve -> answer for every question as soon as its inputs are ready.
+
+    Each stage runs in its own thread(s) and hands questions to the next one through a bounded
+    queue, so a slow stage applies back-pressure instead of letting work pile up. The first
+    answers arrive while later questions are still being fetched. Indexing and retrieval share one
+    thread (they both use the vector store) and process every question that is ready at once.
+
+    Retrieval for a question waits until its own documents are indexed. Only a vector search scoped
+    to the question's own documents (scope_to_keywords, with at least min_scope_chunks chunks) gives
+    the same result on a partially indexed corpus, so only those questions are retrieved right
+    away. BM25 and hybrid scores depend on the IDF and document lengths of the whole index, and a
+    global search on every indexed document, so with retrieval_mode 'bm25' or 'hybrid', without
+    scope_to_keywords, and for questions that fall back to a global search, retrieval waits until
+    every question's documents are indexed. Either way the contexts, prompts and answers are the
+    same as in batch mode, but the deferred questions are only answered after the last fetch.
+
+    The index is only kept in memory while questions stream through and is written once, after the
+    last fetch. At that point the rest of doc_dir is indexed too (and chunks of deleted files are
+    dropped), so the index ends up with the same documents as in batch mode.
+
+    Args:
+        questions (List[str]): The questions, used for retrieval.
+        kw_prompts (List[str]): The keyword prompt of each question.
+        make_answer_prompt (Callable[[int, str], str]): Builds the answer prompt of question i from its packed context.
+        retriever (Retriever): The embedding model and vector store.
+        count_tokens (Callable[[str], int]): Token counter used to pack the context.
+        kw_model (str): Model used for keyword generation.
+        answer_model (str): Model used to answer.
+        keywords (List[List[str]], optional): Pre-computed keywords. Skips the keyword stage if given.
+        on_keywords, on_context, on_answer (Callable, optional): Called with the question index and its generated keywords,
+            retrieved chunks or (answer prompt, raw answer) as soon as they are ready, e.g. to checkpoint them. They may be called from any stage thread.
+        Other arguments mirror the command line flags of qa_rag.py.
+
+    Returns:
+        Tuple[List[List[str]], List[str], List[str]]: The keywords, answer prompts and raw answers of every question, in input order.
+    '''
+    num_questions = len(questions)
+    result_keywords: List[List[str]] = [[] for _ in range(num_questions)]
+    answer_prompts: List[Optional[str]] = [None] * num_questions
+    answer_responses: List[Optional[str]] = [None] * num_questions
+
+    fetch_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    index_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    answer_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    errors: List[BaseException] = []
+    stop = threading.Event()
+
+    def run_stage(target, output_queue: Optional[queue.Queue], num_consumers: int = 1):
+        def wrapper():
+            try:
+                target()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                logging.exception('Streaming pipeline stage failed')
+            finally:
+                if output_queue is not None:
+                    for _ in range(num_consumers):
+                        output_queue.put(_DONE)
+        return wrapper
+
+    def keyword_stage():
+        if keywords is not None:
+            for i, keyword_list in enumerate(keywords[:num_questions]):
+                fetch_queue.put((i, keyword_list))
+            return
+        for i, keyword_list in generate_keywords_batch(kw_model, kw_prompts, concurrency=kw_concurrency, cache=llm_cache, system_prompt=kw_system_prompt, keep_alive=keep_alive, num_ctx=num_ctx):
+            if stop.is_set():
+                return
+            print(f'Keywords for question {i}: {", ".join(keyword_list)}')
+            if on_keywords is not None:
+                on_keywords(i, keyword_list)
+            fetch_queue.put((i, keyword_list))
+
+    session = create_session(pool_size=fetch_concurrency)
+    limiter = TokenBucket(rate=requests_per_second, capacity=max(1.0, requests_per_second))
+    fetchers_left = [fetch_concurrency]
+    fetchers_lock = threading.Lock()
+
+    def fetch_stage():
+        try:
+            done = False
+            while not done and not stop.is_set():
+                first = fetch_queue.get()
+                if first is _DONE:
+                    break
+                # Look up the keywords of every question that is already waiting with one batched query
+                ready, done = _drain(fetch_queue, first, max_items=wiki_batch_size)
+                for i, keyword_list in ready:
+                    result_keywords[i] = keyword_list
+                all_keywords = [keyword for _, keyword_list in ready for keyword in keyword_list]
+                download_web_pages_by_keywords(keywords=all_keywords, out_dir=doc_dir, concurrency=1, base_url=wiki_url, batch_size=wiki_batch_size, session=session, limiter=limiter, wiki_dump=wiki_dump)
+                for i, _ in ready:
+                    index_queue.put(i)
+        finally:
+            # Only the last fetcher to finish ends the index stage's input
+            with fetchers_lock:
+                fetchers_left[0] -= 1
+                if fetchers_left[0] == 0:
+                    index_queue.put(_DONE)
+
+    def get_sources(ready: List[int]) -> Optional[List[List[str]]]:
+        return [[get_keyword_file_name(keyword) for keyword in result_keywords[i]] for i in ready] if scope_to_keywords else None
+
+    def retrieve_and_pack(ready: List[int], manifest: Dict[str, Dict]) -> None:
+        scored_contexts = retrieve_scored_chunks_batch([questions[i] for i in ready], k=k, retriever=retriever, mode=retrieval_mode, rrf_k=rrf_k,
+                                                       sources=get_sources(ready), min_scope_chunks=min_scope_chunks, manifest=manifest)
+        for i, scored_chunks in zip(ready, scored_contexts):
+            if on_context is not None:
+                on_context(i, scored_chunks)
+            with metrics.timer('pack'):
+                context, num_tokens = pack_context(scored_chunks, max_context_tokens, count_tokens)
+            logging.debug(f'Context for question {i}: {num_tokens} tokens')
+            answer_prompts[i] = make_answer_prompt(i, context)
+            answer_queue.put(i)
+
+    def index_and_retrieve_stage():
+        # Questions whose retrieval depends on the rest of the corpus, retrieved once everything is indexed
+        deferred: List[int] = []
+        # Updated in place by every micro-batch; the stores and the manifest are only written at the end
+        manifest = load_index_manifest(retriever)
+        done = False
+        while not done and not stop.is_set():
+            first = index_queue.get()
+            if first is _DONE:
+                break
+            ready, done = _drain(index_queue, first, max_items=64)
+            filenames = [get_keyword_file_name(keyword) for i in ready for keyword in result_keywords[i]]
+            index_documents(doc_dir=doc_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap, chunker=chunker, batch_size=embed_batch_size, retriever=retriever, filenames=filenames,
+                            manifest=manifest, persist=False)
+            if retrieval_mode != 'vector' or not scope_to_keywords:
+                deferred += ready
+                continue
+            min_chunks = min_scope_chunks if min_scope_chunks is not None else k
+            num_chunks = count_scope_chunks(retriever, get_sources(ready), manifest)
+            deferred += [i for i, count in zip(ready, num_chunks) if count < min_chunks]
+            ready = [i for i, count in zip(ready, num_chunks) if count >= min_chunks]
+            if ready:
+                retrieve_and_pack(ready, manifest)
+        if stop.is_set():
+            return
+        # Index the rest of doc_dir like batch mode does, and write the index once
+        index_documents(doc_dir=doc_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap, chunker=chunker, batch_size=embed_batch_size, retriever=retriever, manifest=manifest)
+        if deferred:
+            logging.info(f'Retrieving {len(deferred)} questions that need the whole index')
+            retrieve_and_pack(deferred, manifest)
+
+    chat_models = get_answer_chat_models(answer_model, answer_mode, reasoning_tokens, timeout=answer_timeout, seed=answer_seed, temperature=answer_temperature, keep_alive=keep_alive, num_ctx=num_ctx)
+
+    def answer_stage():
+        while not stop.is_set():
+            i = answer_queue.get()
+            if i is _DONE:
+                break
+            answer_responses[i] = answer_with_retry(chat_models, answer_prompts[i], max_retries=answer_retries, cache=llm_cache, system_prompt=answer_system_prompt)
+            if on_answer is not None:
+                on_answer(i, answer_prompts[i], answer_responses[i])
+            logging.info(f'Answered question {i} ({sum(response is not None for response in answer_responses)}/{num_questions})')
+
+    threads = [threading.Thread(target=run_stage(keyword_stage, fetch_queue, num_consumers=fetch_concurrency), daemon=True)]
+    threads += [threading.Thread(target=run_stage(fetch_stage, None), daemon=True) for _ in range(fetch_concurrency)]
+    threads.append(threading.Thread(target=run_stage(index_and_retrieve_stage, answer_queue, num_consumers=answer_concurrency), daemon=True))
+    threads += [threading.Thread(target=run_stage(answer_stage, None), daemon=True) for _ in range(answer_concurrency)]
+    for thread in threads:
+        thread.start()
+
+    # A failed stage sets `stop`; upstream stages may then be blocked on a full queue, so don't wait for them
+    while any(thread.is_alive() for thread in threads) and not stop.is_set():
+        for thread in threads:
+            thread.join(timeout=0.5)
+    session.close()
+    if errors:
+        raise errors[0]
+
+    return result_keywords, answer_prompts, answer_responses
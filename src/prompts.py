@@ -1,16 +1,81 @@
-from typing import List
+from typing import List, Optional
+
+# 'inline' interleaves the instructions with the question. 'prefix' moves every static instruction
+# into a system message, so all prompts of a stage start with the same tokens and Ollama can reuse
+# the KV cache of that prefix instead of evaluating it again for every question.
+PROMPT_LAYOUTS = ['inline', 'prefix']
+
+# 'free' lets the model reason for as long as it wants and parses the 'Answer: X' of its last line.
+# 'constrained' asks for the letter only and restricts the output to {"answer": "<A-E>"} with a JSON schema.
+# 'reasoning' caps the step-by-step reasoning at a number of tokens, then asks for the letter in a
+# second, constrained turn, so a cut-off reasoning still ends with a parseable answer.
+ANSWER_MODES = ['free', 'constrained', 'reasoning']
+
+KEYWORD_SYSTEM_PROMPT = """you are a tasked with answering multiple choice question about a scientific topic. I can provide you with a bunch of text from wikipedia articles, but you need to give me a keyword to search for.
+It has to be only one keyword, and it has to be the most relevant keyword. pick a keyword about the whole subject of the question that way you get very relevant context to use.
+The user sends the question (and maybe its possible answers). Reply with what keyword do you need me to search for you to answer the question.
+IMPORTANT: DO NOT EXPLAIN OR CHAT, ONLY RESPOND WITH A SINGLE KEYWORD THAT IS LIKELY A WIKIPEDIA ARTICLE. give keywords that would be a page on wikipedia, so name of people, physical phenomena, etc.
+Good Examples: Newton, Gravity, Black hole
+Bad Examples: Number of stars in the universe, What is gravity
+"""
+
+ANSWER_SYSTEM_PROMPT = """Given a question, context, and choices, carefully analyze each choice to determine which one is correct. Break down the problem step by step.
+
+Very important notes:
+- Start by reading the question carefully. analyze what the question is asking for yourself before going through the choices.
+- Carefully consider the relationship or concept described in the question and context.
+- Evaluate each choice against the context and the question, one by one.
+- Check if each choice is correct, partially correct, or incorrect based on the context and the information provided.
+- Provide a final answer after considering all choices.
+
+It's ok to talk and think about the problem but the last line of your answer should be the string 'Answer:' followed by either A, B, C, D, or E.
+"""
+
+
+CONSTRAINED_ANSWER_SYSTEM_PROMPT = """Given a question, context, and choices, determine which choice is correct based on the context and the information provided.
+Do not explain. Reply only with JSON of the form {"answer": "X"} where X is A, B, C, D, or E.
+"""
+
+# Second turn of the 'reasoning' mode, sent after the model's (possibly cut off) reasoning
+FINAL_ANSWER_PROMPT = """Based on your analysis above, which choice is correct? Reply only with JSON of the form {"answer": "X"} where X is A, B, C, D, or E."""
+
+
+def get_keyword_system_prompt(layout: str = 'inline') -> Optional[str]:
+    '''Returns the system message of the keyword prompts, None for the inline layout.'''
+    return KEYWORD_SYSTEM_PROMPT if layout == 'prefix' else None
 
-def get_keyword_generation_prompt(question: str, choices: List[str]=[]) -> str:
+
+def get_answer_system_prompt(layout: str = 'inline', answer_mode: str = 'free') -> Optional[str]:
+    '''Returns the system message of the answer prompts, None for the inline layout.'''
+    if layout != 'prefix':
+        return None
+    return CONSTRAINED_ANSWER_SYSTEM_PROMPT if answer_mode == 'constrained' else ANSWER_SYSTEM_PROMPT
+
+
+def get_keyword_generation_prompt(question: str, choices: List[str]=[], layout: str = 'inline') -> str:
     '''Generates a prompt for the keyword generation model. The output of the model when passed this prompt should hopefully be a comma separated list of keywords.
 
     Args:
         question (str): The question to answer.
         choices (List[str]): The possible answers for the question. Can be empty.
+        layout (str): One of PROMPT_LAYOUTS. With 'prefix' only the question is returned and the instructions are sent as get_keyword_system_prompt().
 
     Returns:
         str: The prompt for the keyword generation model.
     '''
 
+    if layout == 'prefix':
+        prompt = f"here is the question: {question}\n"
+        if len(choices) == 5:
+            prompt += f"""and here are the possible answers:
+A) {choices[0]}
+B) {choices[1]}
+C) {choices[2]}
+D) {choices[3]}
+E) {choices[4]}
+"""
+        return prompt
+
     # If we have 5 choices, we use this version of the prompt that includes the choices in keyword generation.
     if len(choices) == 5:
         return f"""you are a tasked with answering multiple choice question about a scientific topic. I can provide you with a bunch of text from wikipedia articles, but you need to give me a keyword to search for.
@@ -112,13 +177,15 @@ Choice E) {choices[4]}
 Answer:
 """
 
-def get_answer_prompt(question: str, choices: List[str], context: str) -> str:
+def get_answer_prompt(question: str, choices: List[str], context: str, layout: str = 'inline', answer_mode: str = 'free') -> str:
     '''Generates a prompt for the answering model.
     
     Args:
         question (str): The question to answer.
         choices (List[str]): The possible choices for the question.
         context (str): The context from which to generate the answer.
+        layout (str): One of PROMPT_LAYOUTS. With 'prefix' only the context, question and choices are returned and the instructions are sent as get_answer_system_prompt().
+        answer_mode (str): One of ANSWER_MODES. 'constrained' asks for the JSON answer only, the other modes for step-by-step reasoning.
     
     Returns:
         str: The prompt for the answering model.
@@ -127,6 +194,36 @@ def get_answer_prompt(question: str, choices: List[str], context: str) -> str:
     if len(choices) != 5:
         raise ValueError("choices must be of length 5")
 
+    if layout == 'prefix':
+        return f"""Context: {context}
+
+Question: {question}
+
+Choices:
+Choice A) {choices[0]}
+Choice B) {choices[1]}
+Choice C) {choices[2]}
+Choice D) {choices[3]}
+Choice E) {choices[4]}
+"""
+
+    if answer_mode == 'constrained':
+        return f"""Given the following question, context, and choices, determine which choice is correct based on the context and the information provided.
+
+Context: {context}
+
+Question: {question}
+
+Choices:
+Choice A) {choices[0]}
+Choice B) {choices[1]}
+Choice C) {choices[2]}
+Choice D) {choices[3]}
+Choice E) {choices[4]}
+
+Do not explain. Reply only with JSON of the form {{"answer": "X"}} where X is A, B, C, D, or E.
+"""
+
     return f"""Given the following question, context, and choices, carefully analyze each choice to determine which one is correct. Break down the problem step by step:
 
 Context: {context}
@@ -1,82 +1,1002 @@
-from typing import List
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
+from abc import ABC, abstractmethod
+import hashlib
+import json
+import logging
 import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
 
-from langchain_community.document_loaders import TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
-from chromadb.config import Settings
 
 
 from .models import EMBEDDING_MODEL_NAME
-print("Initializing Chroma DB...")
-embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL_NAME)
-client_settings = Settings(
-    is_persistent=True,
-    anonymized_telemetry=False  # Disable telemetry
-)
-vector_db = Chroma(collection_name='rag-db', persist_directory='rag_db', embedding_function=embedding_model, client_settings=client_settings)
+from .utils import percentile
+from .metrics import metrics
+from .cache import CachedEmbeddings, EmbeddingCache
+from .corpus import Corpus, get_document_title, open_corpus
+from .chunking import get_chunk_spans, iter_chunk_spans
+PERSIST_DIRECTORY = 'rag_db'
+VECTOR_STORE_BACKENDS = ['chroma', 'numpy']
+# 'vector': embedding similarity, 'bm25': lexical only (no embedding call), 'hybrid': both fused with reciprocal rank fusion
+RETRIEVAL_MODES = ['vector', 'hybrid', 'bm25']
+
+
+class ScoredChunk(NamedTuple):
+    '''A retrieved chunk. Unpacks like the old (text, score) pairs via `text, score, *_ = chunk`.'''
+    text: str
+    score: float
+    id: str
 
 def load_documents(doc_dir: str) -> List[str]:
     '''Loads the documents from the specified directory.
 
     Args:
-        doc_dir (str): The directory containing the documents.
+        doc_dir (str): The directory containing the documents. See corpus.open_corpus.
 
     Returns:
         List[str]: The documents.
     '''
+    return [document for _, document in open_corpus(doc_dir).iter_documents()]
 
-    documents = []
-    for filename in os.listdir(doc_dir):
-        if filename.endswith(".txt"):
-            path = os.path.join(doc_dir, filename)
-            loader = TextLoader(path, encoding="utf-8")
-            docs = loader.load()
-            for doc in docs:
-                documents.append(doc.page_content)
-    return documents
 
-
-def chunk_document(document: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[str]:
-    '''Divides the document into smaller chunks using langchain RecursiveTextSplitter.
+def chunk_document(document: str, chunk_size: int = 1000, chunk_overlap: int = 200, chunker: str = 'recursive') -> List[str]:
+    '''Divides the document into smaller chunks. The 'recursive' chunker gives the chunks of langchain's RecursiveCharacterTextSplitter.
 
     Args:
         document (str): The document to chunk.
         chunk_size (int, optional): The size of each chunk.
         chunk_overlap (int, optional): The overlap between chunks.
+        chunker (str, optional): One of chunking.CHUNKERS.
 
     Returns:
         List[str]: The chunked documents.
     '''
+    return [document[start:end] for start, end in get_chunk_spans(document, chunk_size, chunk_overlap, chunker)]
+
+
+class VectorStore(ABC):
+    '''Interface of the vector stores the chunks are indexed in.
+
+    Embeddings are computed by the caller; a store only keeps (id, text, embedding, metadata) rows
+    and answers top-k similarity queries. Query results are ScoredChunk (text, score, id) tuples,
+    best first.
+    '''
+
+    def __init__(self, persist_directory: str, manifest_path: str):
+        self.persist_directory = persist_directory
+        self.manifest_path = manifest_path
+
+    @abstractmethod
+    def add(self, ids: List[str], texts: List[str], embeddings: List[List[float]], metadatas: Optional[List[Dict]] = None) -> None:
+        '''Adds rows to the store. Rows with an existing id are overwritten.'''
+
+    @abstractmethod
+    def delete(self, ids: List[str]) -> None:
+        '''Removes the rows with the given ids.'''
+
+    @abstractmethod
+    def count(self) -> int:
+        '''Returns the number of rows in the store.'''
+
+    @abstractmethod
+    def reset(self) -> None:
+        '''Removes all rows.'''
+
+    @abstractmethod
+    def query_batch(self, embeddings: List[List[float]], k: int, sources: Optional[List[Optional[List[str]]]] = None) -> List[List[ScoredChunk]]:
+        '''Returns the top-k rows for every query embedding.
+
+        If sources is given, query i only considers rows whose 'source' metadata is in sources[i]
+        (all rows if sources[i] is None).
+        '''
+
+    def query(self, embedding: List[float], k: int, sources: Optional[List[str]] = None) -> List[ScoredChunk]:
+        '''Returns the top-k rows for a single query embedding.'''
+        return self.query_batch([embedding], k, None if sources is None else [sources])[0]
+
+    def persist(self) -> None:
+        '''Writes pending changes to persist_directory.'''
+
+
+def get_chroma_client_settings():
+    from chromadb.config import Settings
+    return Settings(
+        is_persistent=True,
+        anonymized_telemetry=False  # Disable telemetry
+    )
+
+
+class ChromaVectorStore(VectorStore):
+    '''Vector store backed by a persistent Chroma collection (HNSW index + SQLite).
+
+    Several collections can live in the same persist directory; each one has its own manifest.
+    '''
+
+    def __init__(self, persist_directory: str, collection_name: str):
+        super().__init__(persist_directory, os.path.join(persist_directory, 'manifests', collection_name + '.json'))
+        from langchain_chroma import Chroma
+
+        print(f"Initializing Chroma DB collection '{collection_name}'...")
+        self.collection_name = collection_name
+        self.chroma = Chroma(collection_name=collection_name, persist_directory=persist_directory, client_settings=get_chroma_client_settings())
+
+    def add(self, ids, texts, embeddings, metadatas=None):
+        self.chroma._collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.chroma.delete(ids=ids)
+
+    def count(self):
+        return self.chroma._collection.count()
+
+    def reset(self):
+        self.chroma.reset_collection()
+
+    def _query(self, embeddings, k, where=None):
+        results = self.chroma._collection.query(query_embeddings=embeddings, n_results=k, where=where, include=['documents', 'distances'])
+        # Chroma returns squared L2 distances, which for normalized embeddings is 2 - 2 * cosine similarity
+        return [
+            [ScoredChunk(document, 1 - distance / 2, id) for document, distance, id in zip(documents, distances, ids)]
+            for documents, distances, ids in zip(results['documents'], results['distances'], results['ids'])
+        ]
+
+    def query_batch(self, embeddings, k, sources=None):
+        if sources is None:
+            sources = [None] * len(embeddings)
+        results = [None] * len(embeddings)
+        # Unscoped queries go out as one batch; each scoped query needs its own metadata filter
+        unscoped = [i for i, query_sources in enumerate(sources) if query_sources is None]
+        if unscoped:
+            for i, result in zip(unscoped, self._query([embeddings[i] for i in unscoped], k)):
+                results[i] = result
+        for i, query_sources in enumerate(sources):
+            if query_sources is not None:
+                results[i] = self._query([embeddings[i]], k, where={'source': {'$in': list(query_sources)}})[0] if query_sources else []
+        return results
+
+
+class NumpyVectorStore(VectorStore):
+    '''Exact brute-force vector store kept as one contiguous float32 matrix of normalized rows.
+
+    Top-k is a single matrix multiply plus argpartition, which for a few thousand chunks is faster
+    than an approximate index. The matrix is saved as embeddings.npy and memory-mapped on load;
+    ids, texts and metadata are saved next to it in rows.json.
+    '''
+
+    def __init__(self, persist_directory: str):
+        super().__init__(persist_directory, os.path.join(persist_directory, 'manifest.json'))
+        self.matrix_path = os.path.join(persist_directory, 'embeddings.npy')
+        self.rows_path = os.path.join(persist_directory, 'rows.json')
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[Dict] = []
+        self.matrix: Optional[np.ndarray] = None
+        if os.path.exists(self.matrix_path) and os.path.exists(self.rows_path):
+            self.matrix = np.load(self.matrix_path, mmap_mode='r')
+            with open(self.rows_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+            self.ids, self.texts, self.metadatas = rows['ids'], rows['texts'], rows['metadatas']
+        self.id_to_row = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._pending: List[np.ndarray] = []
+        self._source_rows: Optional[Dict[str, List[int]]] = None
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def _materialize(self) -> np.ndarray:
+        '''Concatenates pending rows into the matrix. Copies a memory-mapped matrix into memory only when it changes.'''
+        if self._pending:
+            parts = ([self.matrix] if self.matrix is not None else []) + self._pending
+            self.matrix = np.ascontiguousarray(np.vstack(parts), dtype=np.float32)
+            self._pending = []
+        return self.matrix
+
+    def add(self, ids, texts, embeddings, metadatas=None):
+        vectors = self._normalize(embeddings)
+        metadatas = metadatas if metadatas is not None else [{} for _ in ids]
+        new_rows = []
+        for chunk_id, text, vector, metadata in zip(ids, texts, vectors, metadatas):
+            if chunk_id in self.id_to_row:
+                row = self.id_to_row[chunk_id]
+                matrix = self._materialize()
+                if not matrix.flags.writeable:
+                    self.matrix = matrix = np.array(matrix)
+                matrix[row] = vector
+                self.texts[row] = text
+                self.metadatas[row] = metadata
+                continue
+            self.id_to_row[chunk_id] = len(self.ids)
+            self.ids.append(chunk_id)
+            self.texts.append(text)
+            self.metadatas.append(metadata)
+            new_rows.append(vector)
+        if new_rows:
+            self._pending.append(np.vstack(new_rows))
+        self._source_rows = None
+
+    def delete(self, ids):
+        rows = {self.id_to_row[chunk_id] for chunk_id in ids if chunk_id in self.id_to_row}
+        if not rows:
+            return
+        matrix = self._materialize()
+        keep = [row for row in range(len(self.ids)) if row not in rows]
+        self.matrix = np.ascontiguousarray(matrix[keep])
+        self.ids = [self.ids[row] for row in keep]
+        self.texts = [self.texts[row] for row in keep]
+        self.metadatas = [self.metadatas[row] for row in keep]
+        self.id_to_row = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._source_rows = None
+
+    def count(self):
+        return len(self.ids)
+
+    def reset(self):
+        self.ids, self.texts, self.metadatas = [], [], []
+        self.id_to_row = {}
+        self.matrix = None
+        self._pending = []
+        self._source_rows = None
+
+    def _get_rows_of_sources(self, sources: List[str]) -> np.ndarray:
+        if self._source_rows is None:
+            self._source_rows = {}
+            for row, metadata in enumerate(self.metadatas):
+                self._source_rows.setdefault((metadata or {}).get('source'), []).append(row)
+        rows = [row for source in set(sources) for row in self._source_rows.get(source, [])]
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def _top_k(self, scores: np.ndarray, rows: np.ndarray, k: int) -> List[ScoredChunk]:
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            scores, rows = scores[top], rows[top]
+        order = np.argsort(-scores)
+        return [ScoredChunk(self.texts[row], float(scores[i]), self.ids[row]) for i, row in zip(order, rows[order])]
+
+    def query_batch(self, embeddings, k, sources=None):
+        matrix = self._materialize()
+        if matrix is None or len(self.ids) == 0:
+            return [[] for _ in embeddings]
+        queries = self._normalize(embeddings)
+        if sources is None:
+            sources = [None] * len(embeddings)
+        results = [None] * len(embeddings)
+
+        # Unscoped queries are scored against the whole matrix with one multiply
+        unscoped = [i for i, query_sources in enumerate(sources) if query_sources is None]
+        if unscoped:
+            all_rows = np.arange(len(self.ids))
+            for i, query_scores in zip(unscoped, queries[unscoped] @ matrix.T):
+                results[i] = self._top_k(query_scores, all_rows, k)
+        # Scoped queries only touch the rows of their sources
+        for i, query_sources in enumerate(sources):
+            if query_sources is not None:
+                rows = self._get_rows_of_sources(query_sources)
+                results[i] = self._top_k(matrix[rows] @ queries[i], rows, k) if len(rows) else []
+        return results
+
+    def persist(self):
+        os.makedirs(self.persist_directory, exist_ok=True)
+        matrix = self._materialize()
+        if matrix is None:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        # Write to temp files and swap them in, so a crash never leaves a half-written index
+        np.save(self.matrix_path + '.tmp.npy', matrix)
+        with open(self.rows_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'texts': self.texts, 'metadatas': self.metadatas}, f)
+        os.replace(self.matrix_path + '.tmp.npy', self.matrix_path)
+        os.replace(self.rows_path + '.tmp', self.rows_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode='r')
+
+
+# Words too common to help lexical matching
+STOPWORDS = frozenset('''a an and are as at be by for from has have in is it its of on or that the this to was were which with
+what who whom whose when where why how not no can does do did than then there these those their they them he she his her
+also been being into over under more most such only other some any all each both about between after before during'''.split())
+
+
+def tokenize(text: str) -> List[str]:
+    '''Lowercased word tokens without stopwords, used by the BM25 index.'''
+    return [token for token in re.findall(r'\w+', text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    '''In-process BM25 inverted index over the chunks of a collection.
+
+    Postings are kept in CSR form: `offsets[t]:offsets[t + 1]` slices `doc_rows` and `term_freqs`
+    for term id t. Chunks added since the last persist() live in a small per-row list and are scored
+    directly; deletes only mark rows. persist() folds both into fresh CSR arrays without
+    re-tokenizing and saves them to postings.npz, with the vocabulary, ids, texts and sources in rows.json.
+    '''
+
+    def __init__(self, persist_directory: str, k1: float = 1.2, b: float = 0.75):
+        self.persist_directory = persist_directory
+        self.postings_path = os.path.join(persist_directory, 'postings.npz')
+        self.rows_path = os.path.join(persist_directory, 'rows.json')
+        self.k1 = k1
+        self.b = b
+        self.reset()
+        if os.path.exists(self.postings_path) and os.path.exists(self.rows_path):
+            with open(self.rows_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+            self.ids, self.texts, self.vocabulary = rows['ids'], rows['texts'], rows['vocabulary']
+            self.sources = rows.get('sources', [None] * len(self.ids))
+            self.term_to_id = {term: term_id for term_id, term in enumerate(self.vocabulary)}
+            self.id_to_row = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+            with np.load(self.postings_path) as postings:
+                self.offsets = postings['offsets']
+                self.doc_rows = postings['doc_rows']
+                self.term_freqs = postings['term_freqs']
+                self.doc_lengths = postings['doc_lengths']
+            self.deleted = np.zeros(len(self.ids), dtype=bool)
+            self.doc_freqs = np.diff(self.offsets).astype(np.int64)
+            self.total_length = int(self.doc_lengths.sum())
+
+    def reset(self) -> None:
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.sources: List[Optional[str]] = []
+        self.vocabulary: List[str] = []
+        self.term_to_id: Dict[str, int] = {}
+        self.id_to_row: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_rows = np.zeros(0, dtype=np.int32)
+        self.term_freqs = np.zeros(0, dtype=np.int32)
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        self.doc_freqs = np.zeros(0, dtype=np.int64)
+        self.deleted = np.zeros(0, dtype=bool)
+        self.total_length = 0
+        # Rows added since the last persist, as (row, term ids, term frequencies)
+        self._pending: List[Tuple[int, np.ndarray, np.ndarray]] = []
+
+    def _get_term_id(self, term: str) -> int:
+        if term not in self.term_to_id:
+            self.term_to_id[term] = len(self.vocabulary)
+            self.vocabulary.append(term)
+        return self.term_to_id[term]
+
+    def _add_doc_freqs(self, term_ids: np.ndarray, delta: int) -> None:
+        if len(self.vocabulary) > len(self.doc_freqs):
+            self.doc_freqs = np.concatenate([self.doc_freqs, np.zeros(len(self.vocabulary) - len(self.doc_freqs), dtype=np.int64)])
+        self.doc_freqs[term_ids] += delta
+
+    def add(self, ids: List[str], texts: List[str], sources: Optional[List[Optional[str]]] = None) -> None:
+        '''Adds chunks to the index. Chunks with an existing id are replaced.
+
+        Args:
+            ids (List[str]): Chunk ids, the same as in the vector store.
+            texts (List[str]): Chunk texts.
+            sources (List[str], optional): Source document of each chunk, used to scope queries.
+        '''
+        self.delete([chunk_id for chunk_id in ids if chunk_id in self.id_to_row])
+        if sources is None:
+            sources = [None] * len(ids)
+        new_lengths = []
+        for chunk_id, text, source in zip(ids, texts, sources):
+            counts: Dict[int, int] = {}
+            for token in tokenize(text):
+                term_id = self._get_term_id(token)
+                counts[term_id] = counts.get(term_id, 0) + 1
+            term_ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            term_freqs = np.fromiter(counts.values(), dtype=np.int32, count=len(counts))
+            row = len(self.ids)
+            self.id_to_row[chunk_id] = row
+            self.ids.append(chunk_id)
+            self.texts.append(text)
+            self.sources.append(source)
+            self._pending.append((row, term_ids, term_freqs))
+            self._add_doc_freqs(term_ids, 1)
+            new_lengths.append(int(term_freqs.sum()))
+            self.total_length += new_lengths[-1]
+        if new_lengths:
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.array(new_lengths, dtype=np.int32)])
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(new_lengths), dtype=bool)])
+
+    def delete(self, ids: List[str]) -> None:
+        '''Marks chunks as deleted. They are dropped from the postings on persist().'''
+        rows = [row for row in (self.id_to_row.pop(chunk_id, None) for chunk_id in ids) if row is not None]
+        if not rows:
+            return
+        rows = np.array(rows, dtype=np.int64)
+        self.deleted[rows] = True
+        self.total_length -= int(self.doc_lengths[rows].sum())
+
+        pending_rows = {row: term_ids for row, term_ids, _ in self._pending}
+        term_ids = [pending_rows[row] for row in rows.tolist() if row in pending_rows]
+        persisted_rows = np.array([row for row in rows.tolist() if row not in pending_rows], dtype=np.int64)
+        if len(persisted_rows) > 0:
+            # Term ids of the persisted rows: the terms whose posting lists contain them, found in one pass over the postings
+            positions = np.flatnonzero(np.isin(self.doc_rows, persisted_rows))
+            term_ids.append(np.searchsorted(self.offsets, positions, side='right') - 1)
+        if term_ids:
+            # A term shared by several deleted rows is counted once per row
+            self.doc_freqs -= np.bincount(np.concatenate(term_ids), minlength=len(self.doc_freqs))
+
+    def count(self) -> int:
+        return len(self.id_to_row)
+
+    def _get_coo(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Returns all postings (persisted and pending) as (term id, row, term frequency) arrays.'''
+        term_ids = [np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets))]
+        rows = [self.doc_rows]
+        term_freqs = [self.term_freqs]
+        for row, pending_term_ids, pending_term_freqs in self._pending:
+            term_ids.append(pending_term_ids)
+            rows.append(np.full(len(pending_term_ids), row, dtype=np.int32))
+            term_freqs.append(pending_term_freqs)
+        return np.concatenate(term_ids), np.concatenate(rows), np.concatenate(term_freqs)
+
+    def query_batch(self, questions: List[str], k: int, sources: Optional[List[Optional[List[str]]]] = None) -> List[List[ScoredChunk]]:
+        '''Returns the top-k chunks of every question by BM25 score. Needs no embedding model.
+
+        If sources is given, question i only considers chunks whose source is in sources[i] (all chunks if None).
+        '''
+        num_rows = len(self.ids)
+        num_docs = self.count()
+        if num_docs == 0:
+            return [[] for _ in questions]
+        average_length = max(self.total_length / num_docs, 1)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / average_length)
+        pending_postings: Dict[int, List[Tuple[int, int]]] = {}
+        for row, term_ids, term_freqs in self._pending:
+            for term_id, term_freq in zip(term_ids.tolist(), term_freqs.tolist()):
+                pending_postings.setdefault(term_id, []).append((row, term_freq))
+
+        if sources is None:
+            sources = [None] * len(questions)
+        source_rows: Dict[Optional[str], List[int]] = {}
+        if any(query_sources is not None for query_sources in sources):
+            for row, source in enumerate(self.sources):
+                source_rows.setdefault(source, []).append(row)
+
+        results = []
+        for question, query_sources in zip(questions, sources):
+            scores = np.zeros(num_rows, dtype=np.float32)
+            for term in set(tokenize(question)):
+                term_id = self.term_to_id.get(term)
+                if term_id is None or self.doc_freqs[term_id] <= 0:
+                    continue
+                doc_freq = self.doc_freqs[term_id]
+                idf = np.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+                # Terms first seen after the last persist have no persisted postings
+                start, end = (self.offsets[term_id], self.offsets[term_id + 1]) if term_id + 1 < len(self.offsets) else (0, 0)
+                rows, term_freqs = self.doc_rows[start:end], self.term_freqs[start:end]
+                if term_id in pending_postings:
+                    pending_rows, pending_term_freqs = zip(*pending_postings[term_id])
+                    rows = np.concatenate([rows, np.array(pending_rows, dtype=np.int32)])
+                    term_freqs = np.concatenate([term_freqs, np.array(pending_term_freqs, dtype=np.int32)])
+                scores[rows] += idf * term_freqs * (self.k1 + 1) / (term_freqs + length_norm[rows])
+            scores[self.deleted] = 0
+            if query_sources is not None:
+                allowed = np.zeros(num_rows, dtype=bool)
+                for source in set(query_sources):
+                    allowed[source_rows.get(source, [])] = True
+                scores[~allowed] = 0
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+            results.append([ScoredChunk(self.texts[row], float(scores[row]), self.ids[row]) for row in candidates])
+        return results
+
+    def persist(self) -> None:
+        '''Drops deleted rows, merges pending rows into the CSR postings and saves the index.'''
+        term_ids, rows, term_freqs = self._get_coo()
+        keep_rows = np.flatnonzero(~self.deleted)
+        new_row = np.full(len(self.ids), -1, dtype=np.int32)
+        new_row[keep_rows] = np.arange(len(keep_rows), dtype=np.int32)
+        keep = new_row[rows] >= 0
+        term_ids, rows, term_freqs = term_ids[keep], new_row[rows[keep]], term_freqs[keep]
+        order = np.lexsort((rows, term_ids))
+        self.doc_rows = rows[order].astype(np.int32)
+        self.term_freqs = term_freqs[order].astype(np.int32)
+        self.offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.vocabulary)), out=self.offsets[1:])
+        self.doc_freqs = np.diff(self.offsets).astype(np.int64)
+        self.ids = [self.ids[row] for row in keep_rows]
+        self.texts = [self.texts[row] for row in keep_rows]
+        self.sources = [self.sources[row] for row in keep_rows]
+        self.doc_lengths = self.doc_lengths[keep_rows]
+        self.deleted = np.zeros(len(self.ids), dtype=bool)
+        self.id_to_row = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._pending = []
+
+        os.makedirs(self.persist_directory, exist_ok=True)
+        # Write to temp files and swap them in, so a crash never leaves a half-written index
+        np.savez(self.postings_path + '.tmp.npz', offsets=self.offsets, doc_rows=self.doc_rows, term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+        with open(self.rows_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'texts': self.texts, 'sources': self.sources, 'vocabulary': self.vocabulary}, f)
+        os.replace(self.postings_path + '.tmp.npz', self.postings_path)
+        os.replace(self.rows_path + '.tmp', self.rows_path)
+
+
+def get_collection_name(embedding_model_name: str, chunk_size: Optional[int] = None, chunk_overlap: Optional[int] = None, chunker: Optional[str] = None) -> str:
+    '''Builds a collection name from the embedding model and chunk config, e.g. rag-nomic-embed-text-cs2000-co500.
+
+    Indexes built with different embedding models or chunk configs go to different collections,
+    so they can be compared side by side without mixing their chunks.
+    '''
+    name = f'rag-{embedding_model_name}'
+    if chunk_size is not None:
+        name += f'-cs{chunk_size}'
+    if chunk_overlap is not None:
+        name += f'-co{chunk_overlap}'
+    if chunker is not None and chunker != 'recursive':
+        name += f'-{chunker}'
+    # Chroma allows [a-zA-Z0-9._-] only
+    return re.sub(r'[^a-zA-Z0-9._-]', '-', name)
+
+
+class Retriever:
+    '''Embedding model, vector store and BM25 index built from the run config.
+
+    Nothing is constructed until first use, so importing this module or building a Retriever is
+    cheap, and runs that never retrieve never touch Ollama or the database.
+    '''
+
+    def __init__(self, embedding_model_name: str = EMBEDDING_MODEL_NAME, persist_directory: str = PERSIST_DIRECTORY, collection_name: Optional[str] = None, backend: str = 'chroma', chunk_size: Optional[int] = None, chunk_overlap: Optional[int] = None, chunker: Optional[str] = None, embedding_cache_dir: Optional[str] = None, keep_alive: Optional[int] = None):
+        '''
+        Args:
+            embedding_model_name (str, optional): Ollama model used to embed chunks and questions.
+            persist_directory (str, optional): Directory the vector stores are kept in.
+            collection_name (str, optional): Name of the collection. Derived from the embedding model and chunk config if not given.
+            backend (str, optional): One of VECTOR_STORE_BACKENDS.
+            chunk_size (int, optional): Chunk size, used to derive the collection name.
+            chunk_overlap (int, optional): Chunk overlap, used to derive the collection name.
+            chunker (str, optional): Chunker, used to derive the collection name.
+            embedding_cache_dir (str, optional): Directory of the EmbeddingCache shared by all collections. Texts embedded before, by any run or chunk config, are not sent to Ollama again. No cache if not given.
+            keep_alive (int, optional): Seconds Ollama keeps the embedding model loaded after each request. -1 keeps it loaded.
+        '''
+        if backend not in VECTOR_STORE_BACKENDS:
+            raise ValueError(f"Unknown vector store backend: {backend}. Choose from {VECTOR_STORE_BACKENDS}")
+        self.embedding_model_name = embedding_model_name
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name or get_collection_name(embedding_model_name, chunk_size, chunk_overlap, chunker)
+        self.backend = backend
+        self.embedding_cache_dir = embedding_cache_dir
+        self.keep_alive = keep_alive
+        self._embedding_model: Optional[Union[OllamaEmbeddings, CachedEmbeddings]] = None
+        self._query_embedding_model: Optional[Union[OllamaEmbeddings, CachedEmbeddings]] = None
+        self._vector_store: Optional[VectorStore] = None
+        self._lexical_index: Optional[BM25Index] = None
+        self._lock = threading.Lock()
+
+    @property
+    def embedding_model(self) -> Union[OllamaEmbeddings, CachedEmbeddings]:
+        with self._lock:
+            if self._embedding_model is None:
+                self._embedding_model = OllamaEmbeddings(model=self.embedding_model_name, keep_alive=self.keep_alive)
+                if self.embedding_cache_dir is not None:
+                    self._embedding_model = CachedEmbeddings(self._embedding_model, EmbeddingCache(self.embedding_cache_dir, self.embedding_model_name))
+            return self._embedding_model
+
+    @property
+    def query_embedding_model(self) -> Union[OllamaEmbeddings, CachedEmbeddings]:
+        '''The embedding model for questions. Shares the model and cache with embedding_model, but counts cache hits under the 'retrieve' stage.'''
+        embedding_model = self.embedding_model
+        with self._lock:
+            if self._query_embedding_model is None:
+                self._query_embedding_model = embedding_model
+                if isinstance(embedding_model, CachedEmbeddings):
+                    self._query_embedding_model = CachedEmbeddings(embedding_model.embedding_model, embedding_model.cache, stage='retrieve')
+            return self._query_embedding_model
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    return splitter.split_text(document)
+    @property
+    def vector_store(self) -> VectorStore:
+        with self._lock:
+            if self._vector_store is None:
+                if self.backend == 'chroma':
+                    self._vector_store = ChromaVectorStore(self.persist_directory, self.collection_name)
+                else:
+                    self._vector_store = NumpyVectorStore(os.path.join(self.persist_directory, 'numpy', self.collection_name))
+            return self._vector_store
 
+    @property
+    def lexical_index(self) -> BM25Index:
+        '''BM25 index over the same chunks as the vector store, kept in sync by index_documents.'''
+        with self._lock:
+            if self._lexical_index is None:
+                self._lexical_index = BM25Index(os.path.join(self.persist_directory, 'bm25', self.collection_name))
+            return self._lexical_index
 
-def store_chunks_in_db(chunks: List[str]) -> None:
+
+_default_retriever: Optional[Retriever] = None
+
+
+def get_default_retriever() -> Retriever:
+    '''Returns the retriever used when none is passed: EMBEDDING_MODEL_NAME with the 'rag-db' Chroma collection.'''
+    global _default_retriever
+    if _default_retriever is None:
+        _default_retriever = Retriever(collection_name='rag-db')
+    return _default_retriever
+
+
+def store_chunks_in_db(chunks: List[str], ids: Optional[List[str]] = None, metadatas: Optional[List[Dict]] = None, retriever: Optional[Retriever] = None) -> None:
     '''Stores chunks in the database.
 
     Args:
         chunks (List[str]): The chunks to store.
+        ids (List[str], optional): Stable ids of the chunks. Chunks with an existing id are overwritten instead of duplicated. Defaults to content hashes.
+        metadatas (List[Dict], optional): Metadata stored with each chunk.
+        retriever (Retriever, optional): Where to store the chunks. Defaults to get_default_retriever().
     '''
-    vector_db.add_texts(texts=chunks)
+    if retriever is None:
+        retriever = get_default_retriever()
+    if ids is None:
+        ids = [make_chunk_id('', chunk) for chunk in chunks]
+    embed_and_store_batch(retriever, chunks, ids, metadatas)
+
+
+def make_chunk_id(source: str, chunk: str) -> str:
+    '''Returns a stable content-hash id for a chunk of the given source file.'''
+    return hashlib.sha256(f'{source}\x00{chunk}'.encode('utf-8')).hexdigest()
+
+
+def load_manifest(manifest_path: str) -> Optional[Dict[str, Dict]]:
+    '''Loads the index manifest (file -> mtime, hash, chunk params, chunk ids). Returns None if there is none yet.'''
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict[str, Dict], manifest_path: str) -> None:
+    '''Atomically writes the index manifest.'''
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_index_manifest(retriever: Retriever, manifest_path: Optional[str] = None) -> Dict[str, Dict]:
+    '''Loads the manifest of the retriever's index. The vector store and BM25 index are reset if they can't be matched to it.
+
+    Args:
+        retriever (Retriever): The index the manifest belongs to.
+        manifest_path (str, optional): Where the manifest is stored. Defaults to the manifest path of the vector store.
+
+    Returns:
+        Dict[str, Dict]: The manifest, empty if the index was reset.
+    '''
+    vector_store = retriever.vector_store
+    lexical_index = retriever.lexical_index
+    manifest = load_manifest(manifest_path or vector_store.manifest_path)
+    if manifest is None:
+        # Chunks stored before the manifest existed have random ids and can't be tracked
+        if vector_store.count() > 0:
+            logging.info('No index manifest found, rebuilding the vector store from scratch...')
+            vector_store.reset()
+        lexical_index.reset()
+        return {}
+    if lexical_index.count() != sum(len(entry['chunk_ids']) for entry in manifest.values()):
+        # E.g. a collection built before the BM25 index existed
+        logging.info('BM25 index is out of sync with the vector store, rebuilding both from scratch...')
+        vector_store.reset()
+        lexical_index.reset()
+        return {}
+    return manifest
+
+
+def persist_index(retriever: Retriever, manifest: Dict[str, Dict], manifest_path: Optional[str] = None) -> None:
+    '''Writes the vector store, the BM25 index and then the manifest that describes them.'''
+    retriever.vector_store.persist()
+    retriever.lexical_index.persist()
+    save_manifest(manifest, manifest_path or retriever.vector_store.manifest_path)
+
+
+def embed_and_store_batch(retriever: Retriever, chunks: List[str], ids: List[str], metadatas: Optional[List[Dict]]) -> float:
+    '''Embeds a batch of chunks with one embedding request and writes it to the vector store with one call.
+
+    The chunks are added to the BM25 index too.
+
+    Args:
+        retriever (Retriever): Provides the embedding model and the store to write to.
+        chunks (List[str]): The chunks to store.
+        ids (List[str]): Stable ids of the chunks.
+        metadatas (List[Dict]): Metadata stored with each chunk.
+
+    Returns:
+        float: How long the embedding request took in seconds.
+    '''
+    start_time = time.perf_counter()
+    embeddings = retriever.embedding_model.embed_documents(chunks)
+    embed_latency = time.perf_counter() - start_time
+    metrics.record('embed', embed_latency, items=len(chunks))
+    with metrics.timer('store', items=len(chunks)):
+        retriever.vector_store.add(ids=ids, texts=chunks, embeddings=embeddings, metadatas=metadatas)
+    with metrics.timer('lexical_index', items=len(chunks)):
+        retriever.lexical_index.add(ids=ids, texts=chunks, sources=[metadata.get('source') for metadata in metadatas] if metadatas else None)
+    return embed_latency
+
+
+def index_documents(doc_dir: str, chunk_size: int = 1000, chunk_overlap: int = 200, chunker: str = 'recursive', chunk_processes: int = 1, manifest_path: Optional[str] = None, batch_size: int = 512, queue_size: int = 4, retriever: Optional[Retriever] = None, filenames: Optional[List[str]] = None,
+                    manifest: Optional[Dict[str, Dict]] = None, persist: bool = True) -> Dict[str, float]:
+    '''Incrementally chunks and stores the documents of doc_dir in the vector db and the BM25 index.
+
+    A manifest of (document, mtime, content hash, chunk params, chunk ids) is kept next to the vector store.
+    Only new or changed documents, or documents chunked with different params, are chunked and
+    embedded again; their old chunks are deleted first. Chunks of deleted files are dropped.
+    Chunk ids are content hashes, so re-adding a chunk never duplicates it.
+
+    Chunking runs in a producer thread that fills batches of `batch_size` chunks into a bounded
+    queue, while the calling thread embeds and stores one batch at a time.
+
+    Args:
+        doc_dir (str): The directory containing the documents. See corpus.open_corpus.
+        chunk_size (int, optional): The size of each chunk.
+        chunk_overlap (int, optional): The overlap between chunks.
+        chunker (str, optional): One of chunking.CHUNKERS.
+        chunk_processes (int, optional): Number of worker processes computing chunk boundaries.
+        manifest_path (str, optional): Where the manifest is stored. Defaults to the manifest path of the vector store.
+        batch_size (int, optional): Number of chunks embedded and written per request.
+        queue_size (int, optional): Number of chunked batches that may wait for the embedder.
+        retriever (Retriever, optional): Where to index the documents. Defaults to get_default_retriever().
+        filenames (List[str], optional): Only look at these documents of doc_dir. Chunks of deleted documents are not dropped in this mode.
+        manifest (Dict[str, Dict], optional): Manifest to update in place, from load_index_manifest. Loaded from manifest_path if not given.
+        persist (bool, optional): Write the stores and the manifest when done. Callers that index many small batches pass False
+            and a shared manifest, and call persist_index once at the end.
+
+    Returns:
+        Dict[str, float]: Number of documents that were indexed, unchanged and removed, the number of chunks added,
+            chunks/sec and the p50/p95/p99 embedding latency per batch in seconds.
+    '''
+    if retriever is None:
+        retriever = get_default_retriever()
+    vector_store = retriever.vector_store
+    lexical_index = retriever.lexical_index
+    if manifest is None:
+        manifest = load_index_manifest(retriever, manifest_path)
+
+    stats = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'chunks': 0}
+    chunk_params = {'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap}
+    if chunker != 'recursive':
+        # Manifests of the default chunker don't name it, so indexes built before it was configurable stay valid
+        chunk_params['chunker'] = chunker
+
+    # Find the documents that need to be (re)indexed
+    corpus = open_corpus(doc_dir)
+    full_scan = filenames is None
+    if full_scan:
+        filenames = corpus.names()
+    else:
+        filenames = sorted(set(filename for filename in filenames if filename in corpus))
+    to_index = []
+    for filename in filenames:
+        mtime = corpus.get_mtime(filename)
+        entry = manifest.get(filename)
+        if entry is not None and entry['mtime'] == mtime and entry['chunk_params'] == chunk_params:
+            stats['unchanged'] += 1
+            continue
+
+        content_hash = corpus.get_hash(filename)
+        if entry is not None and entry['hash'] == content_hash and entry['chunk_params'] == chunk_params:
+            # Only touched, content is the same
+            entry['mtime'] = mtime
+            stats['unchanged'] += 1
+            continue
+
+        if entry is not None and entry['chunk_ids']:
+            vector_store.delete(ids=entry['chunk_ids'])
+            lexical_index.delete(ids=entry['chunk_ids'])
+        manifest[filename] = {'mtime': mtime, 'hash': content_hash, 'chunk_params': chunk_params, 'chunk_ids': []}
+        to_index.append(filename)
+
+    # Drop chunks of documents that no longer exist
+    for filename in (set(manifest) - set(filenames) if full_scan else []):
+        if manifest[filename]['chunk_ids']:
+            vector_store.delete(ids=manifest[filename]['chunk_ids'])
+            lexical_index.delete(ids=manifest[filename]['chunk_ids'])
+        del manifest[filename]
+        stats['removed'] += 1
+
+    def produce_batches() -> None:
+        batch = ([], [], [])
+        try:
+            for filename, chunk_id, chunk, metadata in iter_document_chunks(corpus, to_index, chunk_size, chunk_overlap, chunker, processes=chunk_processes):
+                manifest[filename]['chunk_ids'].append(chunk_id)
+                batch[0].append(chunk)
+                batch[1].append(chunk_id)
+                batch[2].append(metadata)
+                if len(batch[0]) >= batch_size:
+                    batch_queue.put(batch)
+                    batch = ([], [], [])
+            if batch[0]:
+                batch_queue.put(batch)
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            batch_queue.put(None)
+
+    batch_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    producer_errors = []
+    producer = threading.Thread(target=produce_batches, daemon=True)
+    start_time = time.perf_counter()
+    producer.start()
+
+    embed_latencies = []
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        embed_latencies.append(embed_and_store_batch(retriever, *batch))
+        stats['chunks'] += len(batch[0])
+        logging.debug(f'Stored batch of {len(batch[0])} chunks (embedding took {embed_latencies[-1]:.2f}s)')
+    producer.join()
+    if producer_errors:
+        raise producer_errors[0]
+    elapsed = time.perf_counter() - start_time
+
+    stats['indexed'] = len(to_index)
+    stats['chunks_per_sec'] = stats['chunks'] / elapsed if elapsed > 0 else 0.0
+    for q in (50, 95, 99):
+        stats[f'embed_p{q}'] = percentile(embed_latencies, q)
+
+    if persist:
+        persist_index(retriever, manifest, manifest_path)
+    return stats
+
+
+def get_document_metadata(filename: str, document: str) -> Dict[str, str]:
+    '''Metadata stored with every chunk of a downloaded page.
+
+    Pages are saved as `title\n\ncontent` under the file name of the keyword they were fetched for,
+    so the source file, the normalized Wikipedia title and the (file name form of the) keyword are known.
+    '''
+    return {'source': filename, 'title': get_document_title(document), 'keyword': os.path.splitext(filename)[0]}
+
+
+def iter_document_chunks(corpus: Corpus, filenames: List[str], chunk_size: int, chunk_overlap: int, chunker: str = 'recursive', processes: int = 1) -> Iterator[Tuple[str, str, str, Dict[str, str]]]:
+    '''Lazily reads and chunks the given documents of a corpus.
+
+    Chunk boundaries are computed as spans (in a pool of `processes` worker processes if > 1) and
+    the chunk strings are only cut out of a document when it is its turn to be embedded.
+
+    Yields:
+        Tuple[str, str, str, Dict[str, str]]: (filename, chunk id, chunk, metadata) for every distinct chunk of every document.
+    '''
+    chunked_documents = iter_chunk_spans(corpus.iter_documents(filenames), chunk_size, chunk_overlap, chunker, processes=processes)
+    while True:
+        start_time = time.perf_counter()
+        chunked_document = next(chunked_documents, None)
+        if chunked_document is None:
+            break
+        filename, document, spans = chunked_document
+        chunks = list(dict.fromkeys(document[start:end] for start, end in spans))
+        metrics.record('chunk', time.perf_counter() - start_time, items=len(chunks))
+        metadata = get_document_metadata(filename, document)
+        for chunk in chunks:
+            yield filename, make_chunk_id(filename, chunk), chunk, dict(metadata)
 
     
-def retrieve_relevant_chunks(question: str, k: int = 3) -> List[str]:
+def retrieve_relevant_chunks(question: str, k: int = 3, retriever: Optional[Retriever] = None, mode: str = 'vector') -> List[str]:
     '''Retrieves the relevant chunks from the database using the specified embedding model.
 
     Args:
         question (str): The question to embed.
         k (int, optional): The number of chunks to retrieve.
+        retriever (Retriever, optional): The embedding model and store to search with. Defaults to get_default_retriever().
+        mode (str, optional): One of RETRIEVAL_MODES. See retrieve_scored_chunks_batch.
 
     Returns:
         List[str]: The relevant chunks.
     '''
-    retrieved_results = vector_db.similarity_search(query=question, k=k)
+    if retriever is None:
+        retriever = get_default_retriever()
+    if mode != 'vector':
+        return [chunk for chunk, *_ in retrieve_scored_chunks_batch([question], k=k, retriever=retriever, mode=mode)[0]]
+    with metrics.timer('retrieve'):
+        retrieved_results = retriever.vector_store.query(retriever.query_embedding_model.embed_query(question), k=k)
     relevant_chunks: List[str] = []
-    for result in retrieved_results:
-        relevant_chunks.append(result.page_content)
+    for chunk, *_ in retrieved_results:
+        relevant_chunks.append(chunk)
     return relevant_chunks
 
+
+def fuse_rankings(rankings: List[List[ScoredChunk]], k: int, rrf_k: int = 60) -> List[ScoredChunk]:
+    '''Reciprocal rank fusion: every ranking adds 1 / (rrf_k + rank) to the score of its chunks.
+
+    Only ranks are used, so BM25 and cosine scores don't need to be on the same scale.
+    '''
+    fused: Dict[str, float] = {}
+    chunks: Dict[str, ScoredChunk] = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking):
+            fused[chunk.id] = fused.get(chunk.id, 0.0) + 1 / (rrf_k + rank + 1)
+            chunks.setdefault(chunk.id, chunk)
+    best_ids = sorted(fused, key=lambda chunk_id: fused[chunk_id], reverse=True)[:k]
+    return [ScoredChunk(chunks[chunk_id].text, fused[chunk_id], chunk_id) for chunk_id in best_ids]
+
+
+def count_scope_chunks(retriever: Retriever, sources: List[Optional[List[str]]], manifest: Optional[Dict[str, Dict]] = None) -> List[Optional[int]]:
+    '''Returns the number of indexed chunks of every question's sources (None for unscoped questions).
+
+    Counts from `manifest` if given (e.g. one that index_documents updates without persisting), else from the saved manifest.
+    '''
+    if manifest is None:
+        manifest = load_manifest(retriever.vector_store.manifest_path) or {}
+    return [None if question_sources is None else sum(len(manifest.get(source, {}).get('chunk_ids', [])) for source in set(question_sources))
+            for question_sources in sources]
+
+
+def scope_sources(retriever: Retriever, sources: List[Optional[List[str]]], min_chunks: int, manifest: Optional[Dict[str, Dict]] = None) -> List[Optional[List[str]]]:
+    '''Drops the scope (None = search everything) of questions whose documents have fewer than min_chunks chunks in the index. See count_scope_chunks.'''
+    scoped = []
+    for question_sources, num_chunks in zip(sources, count_scope_chunks(retriever, sources, manifest)):
+        if question_sources is not None and num_chunks < min_chunks:
+            question_sources = None
+        metrics.add('retrieve', 'scoped' if question_sources is not None else 'global')
+        scoped.append(question_sources)
+    return scoped
+
+
+def retrieve_scored_chunks_batch(questions: List[str], k: int = 3, batch_size: int = 256, retriever: Optional[Retriever] = None, mode: str = 'vector', rrf_k: int = 60, num_candidates: Optional[int] = None,
+                                 sources: Optional[List[Optional[List[str]]]] = None, min_scope_chunks: Optional[int] = None, manifest: Optional[Dict[str, Dict]] = None) -> List[List[ScoredChunk]]:
+    '''Retrieves the relevant chunks and their similarity scores for many questions at once.
+
+    All questions of a batch are embedded with one embedding request and the vector store is
+    queried with the whole embedding matrix in one call.
+
+    Args:
+        questions (List[str]): The questions to embed.
+        k (int, optional): The number of chunks to retrieve per question.
+        batch_size (int, optional): Number of questions embedded per request.
+        retriever (Retriever, optional): The embedding model and store to search with. Defaults to get_default_retriever().
+        mode (str, optional): 'vector' ranks by embedding similarity, 'bm25' by the BM25 index (no embedding request),
+            'hybrid' fuses the top num_candidates of both with fuse_rankings.
+        rrf_k (int, optional): Rank offset of reciprocal rank fusion. Larger values flatten the weight of the top ranks.
+        num_candidates (int, optional): Chunks taken from each ranking before fusing. Defaults to 4 * k.
+        sources (List[List[str]], optional): Source files of each question (the pages fetched for its keywords). A question only
+            searches the chunks of its own sources, unless they have fewer than min_scope_chunks chunks, then it searches everything.
+        min_scope_chunks (int, optional): Smallest scoped candidate set. Defaults to k.
+        manifest (Dict[str, Dict], optional): Index manifest the scoped chunks are counted in. Defaults to the saved one.
+
+    Returns:
+        List[List[ScoredChunk]]: (chunk, score, id) tuples of each question, best first, in the same order as questions.
+            Scores are cosine similarities, BM25 scores or fused scores depending on the mode.
+    '''
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}. Choose from {RETRIEVAL_MODES}")
+    if retriever is None:
+        retriever = get_default_retriever()
+    if num_candidates is None:
+        num_candidates = 4 * k
+    if sources is not None:
+        sources = scope_sources(retriever, sources, min_scope_chunks if min_scope_chunks is not None else k, manifest)
+    scored_chunks: List[List[ScoredChunk]] = []
+    for i in range(0, len(questions), batch_size):
+        batch = questions[i:i + batch_size]
+        batch_sources = sources[i:i + batch_size] if sources is not None else None
+        with metrics.timer('retrieve', items=len(batch)):
+            if mode == 'bm25':
+                scored_chunks.extend(retriever.lexical_index.query_batch(batch, k=k, sources=batch_sources))
+                continue
+            embeddings = retriever.query_embedding_model.embed_documents(batch)
+            if mode == 'vector':
+                scored_chunks.extend(retriever.vector_store.query_batch(embeddings, k=k, sources=batch_sources))
+                continue
+            vector_results = retriever.vector_store.query_batch(embeddings, k=num_candidates, sources=batch_sources)
+            lexical_results = retriever.lexical_index.query_batch(batch, k=num_candidates, sources=batch_sources)
+            scored_chunks.extend(fuse_rankings([vector, lexical], k=k, rrf_k=rrf_k) for vector, lexical in zip(vector_results, lexical_results))
+    return scored_chunks
+
+
+def retrieve_relevant_chunks_batch(questions: List[str], k: int = 3, batch_size: int = 256, retriever: Optional[Retriever] = None, mode: str = 'vector') -> List[List[str]]:
+    '''Retrieves the relevant chunks for many questions at once. See retrieve_scored_chunks_batch.
+
+    Returns:
+        List[List[str]]: The relevant chunks of each question, in the same order as questions.
+    '''
+    return [
+        [chunk for chunk, *_ in results]
+        for results in retrieve_scored_chunks_batch(questions, k=k, batch_size=batch_size, retriever=retriever, mode=mode)
+    ]
@@ -1,42 +1,56 @@
-from typing import List
-import random
+from typing import List, Optional
+import json
+import logging
 import re
 
-def extract_choice_from_response(model_response: str) -> int:
+def percentile(values: List[float], q: float) -> float:
+    '''Returns the q-th percentile (0-100) of values using linear interpolation. 0.0 for an empty list.'''
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def extract_choice_from_json(model_response: str) -> Optional[str]:
+    '''Returns X if the response ends with the JSON object {"answer": "X"} of a constrained answer, else None.'''
+    start = model_response.rfind('{')
+    if start == -1:
+        return None
+    try:
+        answer = json.loads(model_response[start:])
+    except ValueError:
+        return None
+    if isinstance(answer, dict) and answer.get('answer') in ('A', 'B', 'C', 'D', 'E'):
+        return answer['answer']
+    return None
+
+def extract_choice_from_response(model_response: str) -> Optional[str]:
     '''Extracts the answered choice from the model response.
 
     Args:
-        model_response (str): The response from the model.
+        model_response (str): The response from the model, either ending with the choice or with a JSON answer (see extract_choice_from_json).
 
     Returns:
-        int: The answered choice. 0:A, 1:B, 2:C, 3:D, 4:E
-    
-    Raises:
-        ValueError: If the model response does not start with 'Answer:' or if the model response does not include A, B, C, D, or E at the end.
+        Optional[str]: The answered choice (A, B, C, D or E), or None if the response does not end with one.
+            Unparseable responses are counted as parse failures and scored as wrong, instead of being
+            replaced by a random choice, so repeated runs of the same responses give the same accuracy.
     '''
 
     # strip the response
     model_response = model_response.strip()
+    json_choice = extract_choice_from_json(model_response)
+    if json_choice is not None:
+        return json_choice
     model_response = model_response.replace('*', '') # bold and italics
 
     # take the last character
-    last_char = model_response[-1]
-    last_char.upper()
-    if last_char == 'A':
-        return 'A'
-    elif last_char == 'B':
-        return 'B'
-    elif last_char == 'C':
-        return 'C'
-    elif last_char == 'D':
-        return 'D'
-    elif last_char == 'E':
-        return 'E'
-    else:
-        print("bad response!", last_char)
-        # answer randomly
-        return random.choice(['A', 'B', 'C', 'D', 'E'])
-        # raise ValueError("Model response does not include A, B, C, D, or E at the end.")
+    last_char = model_response[-1:]
+    if last_char in ('A', 'B', 'C', 'D', 'E'):
+        return last_char
+    logging.warning(f'Could not extract a choice from the response ending with {model_response[-40:]!r}')
+    return None
 
 # Used during testing DO NOT USE
 def extract_answered_choice_old(model_response: str) -> int:
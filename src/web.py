@@ -1,17 +1,121 @@
 
-import os
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import logging
+import threading
 import requests
 import time
 
-def fetch_wikipedia_summary(keyword, lang='en', verbose=False):
+from .corpus import open_corpus
+from .metrics import metrics
+
+USER_AGENT = 'scientific-qa-rag/1.0 (https://github.com/Gholamrezadar/scientific-qa-rag)'
+MAX_TITLES_PER_QUERY = 50  # MediaWiki limit for `titles` without apihighlimits
+
+
+class WikipediaAPIError(requests.RequestException):
+    '''A query that wikipedia answered with an error status or an error body. Says nothing about whether the pages exist.'''
+
+
+class TokenBucket:
+    '''Thread-safe token bucket used to keep all fetch workers within one shared request budget.'''
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        '''
+        Args:
+            rate (float): Tokens (requests) added per second.
+            capacity (float, optional): Maximum number of tokens that can be saved up for a burst.
+        '''
+        if rate <= 0:
+            raise ValueError(f"The request rate must be above 0, got {rate}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''Blocks until a token is available and consumes it.'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_session(pool_size: int = 4) -> requests.Session:
+    '''Creates an HTTP session with keep-alive connections shared by all fetch workers.'''
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_wikipedia_base_url(lang: str = 'en') -> str:
+    return f"https://{lang}.wikipedia.org"
+
+
+def request_with_retry(session: requests.Session, url: str, params: Optional[Dict] = None, limiter: Optional[TokenBucket] = None, max_retries: int = 3, retry_backoff: float = 1.0) -> requests.Response:
+    '''GETs a url, retrying with exponential backoff on 429, 5xx and connection errors.
+
+    Args:
+        session (requests.Session): The session to send the request with.
+        url (str): The url to fetch.
+        params (Dict, optional): Query parameters.
+        limiter (TokenBucket, optional): Rate limiter that every attempt (including retries) has to pass.
+        max_retries (int, optional): How many times to retry after the first failed attempt.
+        retry_backoff (float, optional): Seconds to wait before the first retry. Doubles after every failure. A Retry-After header takes precedence.
+
+    Returns:
+        requests.Response: The response.
+
+    Raises:
+        requests.RequestException: If the last attempt failed with a connection error, 429 or 5xx.
+    '''
+    delay = retry_backoff
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        response = None
+        try:
+            response = session.get(url, params=params, timeout=30)
+            metrics.add('fetch', 'http_requests')
+            metrics.add('fetch', 'http_bytes', len(response.content))
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            return response
+        except requests.RequestException:
+            if attempt == max_retries:
+                raise
+
+        wait = delay
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            wait = float(response.headers['Retry-After'])
+        time.sleep(wait)
+        delay *= 2
+
+
+def fetch_wikipedia_summary(keyword, lang='en', verbose=False, session: Optional[requests.Session] = None, limiter: Optional[TokenBucket] = None, base_url: Optional[str] = None):
     # bad because some keywords actually have both - and _ in them
     # keyword = keyword.replace(' ', '_')
     # keyword = keyword.replace('-', '_')
 
-    url = f"https://{lang}.wikipedia.org/api/rest_v1/page/summary/{keyword}"
-    response = requests.get(url)
-    
+    if session is None:
+        session = create_session()
+    if base_url is None:
+        base_url = get_wikipedia_base_url(lang)
+
+    url = f"{base_url}/api/rest_v1/page/summary/{quote(keyword, safe='')}"
+    response = request_with_retry(session, url, limiter=limiter)
+
     if response.status_code == 200:
         data = response.json()
         if verbose:
@@ -33,8 +137,13 @@ def process_wikipedia_content(content: str) -> str:
     content = '\n'.join(content_lines)
     return content
 
-def fetch_wikipedia_content(keyword, lang='en'):
-    url = f"https://{lang}.wikipedia.org/w/api.php"
+def fetch_wikipedia_content(keyword, lang='en', session: Optional[requests.Session] = None, limiter: Optional[TokenBucket] = None, base_url: Optional[str] = None):
+    if session is None:
+        session = create_session()
+    if base_url is None:
+        base_url = get_wikipedia_base_url(lang)
+
+    url = f"{base_url}/w/api.php"
     params = {
         "action": "query",
         "format": "json",
@@ -42,15 +151,18 @@ def fetch_wikipedia_content(keyword, lang='en'):
         "explaintext": True,
         "titles": keyword
     }
-    response = requests.get(url, params=params)
+    response = request_with_retry(session, url, params=params, limiter=limiter)
     if response.status_code == 200:
         pages = response.json().get("query", {}).get("pages", {})
 
         if len(pages) == 0:
             print("No pages found.")
             return None
-        
+
         page = list(pages.values())[0]
+        if page.get("extract") is None:
+            print("No pages found.")
+            return None
         return process_wikipedia_content(page.get("extract"))
     else:
         print("Failed to fetch data:", response.status_code)
@@ -66,28 +178,197 @@ def convert_keyword_to_valid_filename(keyword: str) -> str:
     keyword = keyword.lower()
     return keyword
 
-def download_web_pages_by_keywords(keywords: List[str], out_dir: str = None):
+def get_keyword_file_name(keyword: str) -> str:
+    '''Returns the name of the file the page of a keyword is saved to.'''
+    return convert_keyword_to_valid_filename(keyword) + '.txt'
+
+def load_not_found_keywords(out_dir: str) -> Set[str]:
+    '''Loads the negative cache of keywords that previously returned 404 from wikipedia.'''
+    return open_corpus(out_dir).load_not_found()
+
+def fetch_wikipedia_pages_batch(keywords: List[str], lang: str = 'en', session: Optional[requests.Session] = None, limiter: Optional[TokenBucket] = None, base_url: Optional[str] = None) -> Dict[str, Optional[Tuple[str, str]]]:
+    '''Resolves and downloads up to 50 keywords with a single MediaWiki query.
+
+    The wikitext of the latest revision of every page is requested and converted to plain text with
+    wikidump.wikitext_to_plaintext. Unlike TextExtracts, which returns a single whole-page extract
+    per response, the revisions API returns the content of all 50 pages in one response (unless it
+    exceeds the API's result size, then the `continue` token is followed). Title normalization and
+    redirects are resolved in the same response and mapped back to the original keywords.
+
+    Args:
+        keywords (List[str]): The keywords to look up. At most MAX_TITLES_PER_QUERY.
+        lang (str, optional): Wikipedia language.
+        session (requests.Session, optional): The session to send the requests with.
+        limiter (TokenBucket, optional): Rate limiter shared with other workers.
+        base_url (str, optional): Overrides the wikipedia host.
+
+    Returns:
+        Dict[str, Optional[Tuple[str, str]]]: keyword -> (page title, processed content), or None if wikipedia reported
+            its page as missing or invalid. Keywords whose page was neither returned nor reported missing are left out.
+
+    Raises:
+        WikipediaAPIError: If wikipedia answered with a non-200 status or an error, so the keywords may still exist.
+    '''
+    if len(keywords) > MAX_TITLES_PER_QUERY:
+        raise ValueError(f"At most {MAX_TITLES_PER_QUERY} keywords can be fetched in one batch.")
+    # wikidump imports this module, so it can only be imported once both are loaded
+    from .wikidump import wikitext_to_plaintext
+    if session is None:
+        session = create_session()
+    if base_url is None:
+        base_url = get_wikipedia_base_url(lang)
+
+    # '|' separates titles in the query, so such keywords can't be looked up
+    valid_keywords = [keyword for keyword in keywords if '|' not in keyword]
+    results: Dict[str, Optional[Tuple[str, str]]] = {keyword: None for keyword in keywords}
+    if len(valid_keywords) == 0:
+        return results
+
+    url = f"{base_url}/w/api.php"
+    params = {
+        "action": "query",
+        "format": "json",
+        "formatversion": 2,
+        "prop": "revisions",
+        "rvprop": "content",
+        "rvslots": "main",
+        "redirects": True,
+        "titles": "|".join(valid_keywords),
+    }
+    renames: Dict[str, str] = {}
+    wikitexts: Dict[str, str] = {}
+    missing_titles: Set[str] = set()
+    while True:
+        response = request_with_retry(session, url, params=params, limiter=limiter)
+        if response.status_code != 200:
+            logging.warning(f"Failed to fetch data: {response.status_code}")
+            raise WikipediaAPIError(f"Wikipedia answered with status {response.status_code}", response=response)
+        data = response.json()
+        if data.get("error"):
+            error = data["error"]
+            logging.warning(f"Wikipedia API error: {error.get('code')} ({error.get('info')})")
+            raise WikipediaAPIError(f"Wikipedia API error: {error.get('code')}", response=response)
+        query = data.get("query", {})
+        for item in query.get("normalized", []) + query.get("redirects", []):
+            renames[item["from"]] = item["to"]
+        for page in query.get("pages", []):
+            if page.get("missing") or page.get("invalid"):
+                missing_titles.add(page.get("title"))
+            elif page.get("revisions"):
+                content = page["revisions"][0].get("slots", {}).get("main", {}).get("content")
+                if content is not None:
+                    wikitexts[page["title"]] = content
+        if "continue" not in data:
+            break
+        params.update(data["continue"])
+
+    for keyword in valid_keywords:
+        # Follow normalization and (possibly chained) redirects back to the final page title
+        title = keyword
+        seen = set()
+        while title in renames and title not in seen:
+            seen.add(title)
+            title = renames[title]
+        if title in wikitexts:
+            results[keyword] = (title, wikitext_to_plaintext(wikitexts[title]))
+        elif title not in missing_titles and keyword not in missing_titles:
+            # Neither content nor a missing page (e.g. cut short by continuation), so it may still exist
+            del results[keyword]
+    return results
+
+def download_web_pages_by_keywords(keywords: List[str], out_dir: str = None, concurrency: int = 4, requests_per_second: float = 2.0, lang: str = 'en', base_url: Optional[str] = None, retry_not_found: bool = False, batch_size: int = MAX_TITLES_PER_QUERY, session: Optional[requests.Session] = None, limiter: Optional[TokenBucket] = None, wiki_dump: Optional[str] = None):
+    '''Downloads the wikipedia page of every keyword into the corpus of out_dir, one document per keyword.
+
+    Keywords are looked up in batches with fetch_wikipedia_pages_batch, and batches are fetched by
+    a pool of workers sharing one keep-alive session. A token bucket keeps the total request rate
+    of all workers under requests_per_second. Keywords whose page wikipedia reports as missing are
+    remembered in the corpus and skipped on later runs. Requests hitting 429/5xx or connection
+    errors are retried with backoff, and keywords of a batch that still fails are not remembered.
+
+    With wiki_dump, the pages are looked up in a local wikipedia dump store instead (see
+    wikidump.build_dump_store) and no request is sent. Keywords missing from the dump are not
+    remembered, since the dump may only be a subset of wikipedia.
+
+    Args:
+        keywords (List[str]): The keywords to search for. Duplicates are only fetched once.
+        out_dir (str): The document directory to write the pages to. See corpus.open_corpus.
+        concurrency (int, optional): Number of batches fetched at the same time.
+        requests_per_second (float, optional): Politeness budget shared by all workers.
+        lang (str, optional): Wikipedia language.
+        base_url (str, optional): Overrides the wikipedia host, e.g. to point at a local stub server.
+        retry_not_found (bool, optional): Ignore the negative cache and try missing keywords again.
+        batch_size (int, optional): Number of keywords resolved per query (at most 50).
+        session (requests.Session, optional): Session to reuse across calls. A new one is created (and closed) if not given.
+        limiter (TokenBucket, optional): Rate limiter to share across calls. Overrides requests_per_second.
+        wiki_dump (str, optional): Path of a wikipedia dump store to read the pages from instead of wikipedia.
+    '''
     if out_dir is None:
         raise ValueError("out_dir must be specified.")
-    
-    for keyword in keywords:
-        valid_file_name = convert_keyword_to_valid_filename(keyword)
-        out_file_path = os.path.join(out_dir, valid_file_name + '.txt')
-        if os.path.exists(out_file_path):
+    corpus = open_corpus(out_dir)
+    dump = None
+    if wiki_dump is not None:
+        from .wikidump import open_wiki_dump
+        dump = open_wiki_dump(wiki_dump)
+    batch_size = max(1, min(batch_size, MAX_TITLES_PER_QUERY))
+
+    not_found = set() if retry_not_found else corpus.load_not_found()
+    not_found_lock = threading.Lock()
+
+    unique_keywords = list(dict.fromkeys(keyword.strip() for keyword in keywords if keyword.strip() != ''))
+    pending_keywords = []
+    for keyword in unique_keywords:
+        if get_keyword_file_name(keyword) in corpus:
             print(f"-- Skipping `{keyword}` because it already exists.")
-            continue
-
-        # print(f"Looking for keyword `{keyword}`...")
-        title = fetch_wikipedia_summary(keyword)
-        content = fetch_wikipedia_content(title)
-        time.sleep(2)
-        if title is None or content is None:
-            print( f"-- Skipping `{keyword}` because it could not be found on Wikipedia.")
-            continue
-        
-        with open(out_file_path, 'w', encoding="utf8") as f:
-            f.write(title)
-            f.write('\n\n')
-            f.write(content)
-        print(f"-- Saved {keyword} to {out_file_path}\n")
-    
+        elif keyword in not_found:
+            print(f"-- Skipping `{keyword}` because it was not found on Wikipedia before.")
+        else:
+            pending_keywords.append(keyword)
+
+    owns_session = session is None
+    if session is None:
+        session = create_session(pool_size=concurrency)
+    if limiter is None:
+        limiter = TokenBucket(rate=requests_per_second, capacity=max(1.0, requests_per_second))
+
+    def download(batch: List[str]) -> None:
+        try:
+            with metrics.timer('fetch', items=len(batch)):
+                if dump is not None:
+                    pages = dump.fetch_pages_batch(batch)
+                else:
+                    pages = fetch_wikipedia_pages_batch(batch, lang=lang, session=session, limiter=limiter, base_url=base_url)
+        except requests.RequestException as e:
+            # Transient failure, don't remember these keywords as missing
+            print(f"-- Skipping {len(batch)} keywords because the request failed: {e}")
+            return
+
+        missing = []
+        for keyword, page in pages.items():
+            if page is None:
+                print( f"-- Skipping `{keyword}` because it could not be found on Wikipedia.")
+                missing.append(keyword)
+                continue
+
+            title, content = page
+            file_name = get_keyword_file_name(keyword)
+            corpus.write(file_name, title + '\n\n' + content)
+            print(f"-- Saved {keyword} as {file_name}\n")
+            metrics.add('fetch', 'pages_saved')
+
+        unresolved = [keyword for keyword in batch if keyword not in pages]
+        if unresolved:
+            print(f"-- Skipping {len(unresolved)} keywords because wikipedia returned no page for them.")
+
+        if missing:
+            metrics.add('fetch', 'not_found', len(missing))
+            if dump is not None:
+                return
+            with not_found_lock:
+                not_found.update(missing)
+            corpus.add_not_found(missing)
+
+    batches = [pending_keywords[i:i + batch_size] for i in range(0, len(pending_keywords), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(download, batches))
+    if owns_session:
+        session.close()
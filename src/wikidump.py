@@ -0,0 +1,288 @@
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import bz2
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from .corpus import compress_text, decompress_text, get_default_codec
+from .web import process_wikipedia_content
+
+ARTICLE_NAMESPACE = 0
+# Pages whose text is wiki markup for layout, not prose
+DROPPED_TAGS = ('ref', 'gallery', 'timeline', 'imagemap', 'score', 'graph', 'templatedata')
+
+
+class DumpPage(NamedTuple):
+    '''A page of a MediaWiki XML dump. `redirect` is the target title for redirect pages.'''
+    title: str
+    namespace: int
+    redirect: Optional[str]
+    text: str
+
+
+def normalize_title(title: str) -> str:
+    '''Normalizes a title like MediaWiki does: underscores are spaces, runs of spaces collapse and the first letter is upper case.'''
+    title = re.sub(r'[\s_]+', ' ', title).strip()
+    return title[:1].upper() + title[1:]
+
+
+def iter_dump_pages(dump_path: str) -> Iterator[DumpPage]:
+    '''Streams the pages of a MediaWiki XML dump (pages-articles.xml, optionally .bz2 compressed).
+
+    The dump is parsed incrementally and every page element is dropped as soon as it was read,
+    so memory use does not grow with the size of the dump.
+
+    Args:
+        dump_path (str): Path of the dump.
+
+    Yields:
+        DumpPage: The pages in dump order. Only the latest revision of each page is read.
+    '''
+    opener = bz2.open if dump_path.endswith('.bz2') else open
+    with opener(dump_path, 'rb') as f:
+        root = None
+        for event, element in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                continue
+            if element.tag.rsplit('}', 1)[-1] != 'page':
+                continue
+            title, namespace, redirect, text = '', ARTICLE_NAMESPACE, None, ''
+            for child in element.iter():
+                tag = child.tag.rsplit('}', 1)[-1]
+                if tag == 'title':
+                    title = child.text or ''
+                elif tag == 'ns':
+                    namespace = int(child.text or 0)
+                elif tag == 'redirect':
+                    redirect = child.get('title')
+                elif tag == 'text':
+                    text = child.text or ''
+            yield DumpPage(title, namespace, redirect, text)
+            # Drop the finished page from the tree
+            root.clear()
+
+
+def _remove_nested(text: str, pattern: str, max_passes: int = 10) -> str:
+    '''Removes the innermost matches of a pattern until nothing is left to remove (nested templates, tables, files).'''
+    for _ in range(max_passes):
+        text, count = re.subn(pattern, '', text, flags=re.DOTALL)
+        if count == 0:
+            break
+    return text
+
+
+def wikitext_to_plaintext(text: str) -> str:
+    '''Converts the wiki markup of an article to plain text resembling the TextExtracts plaintext the API returns.
+
+    Templates, tables, references, files, categories and comments are dropped, links are replaced by
+    their labels, and section headings are kept as `== Heading ==`. This is a fast regex-based
+    approximation, not a full parser.
+    '''
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
+    for tag in DROPPED_TAGS:
+        text = re.sub(rf'<{tag}\b[^>]*/>', '', text, flags=re.IGNORECASE)
+        text = re.sub(rf'<{tag}\b[^>]*>.*?</{tag}\s*>', '', text, flags=re.IGNORECASE | re.DOTALL)
+    text = _remove_nested(text, r'\{\{(?:(?!\{\{|\}\}).)*\}\}')
+    text = _remove_nested(text, r'\{\|(?:(?!\{\||\|\}).)*\|\}')
+    text = _remove_nested(text, r'\[\[(?:File|Image|Media|Category):(?:(?!\[\[|\]\]).)*\]\]')
+    # Interlanguage links
+    text = re.sub(r'\[\[[a-z]{2,3}(?:-[a-z]+)?:[^\[\]]*\]\]', '', text)
+    text = re.sub(r'\[\[(?:[^\[\]|]*\|)?([^\[\]]*)\]\]', r'\1', text)
+    text = re.sub(r'\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]', r'\1', text)
+    text = re.sub(r"'{2,5}", '', text)
+    text = re.sub(r'</?[a-zA-Z][^>]*>', '', text)
+    text = re.sub(r'__[A-Z]+__', '', text)
+    text = re.sub(r'^[*#:;]+\s*', '', text, flags=re.MULTILINE)
+    text = html.unescape(text).replace('\xa0', ' ')
+    return process_wikipedia_content(text)
+
+
+def _convert_page(page: DumpPage) -> Tuple[str, Optional[str], Optional[str]]:
+    '''(title, redirect target, plain text) of a page. Runs in the worker processes of build_dump_store.'''
+    if page.redirect is not None:
+        return normalize_title(page.title), normalize_title(page.redirect.split('#', 1)[0]), None
+    return normalize_title(page.title), None, wikitext_to_plaintext(page.text)
+
+
+def _convert_pages(pages: List[DumpPage]) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    return [_convert_page(page) for page in pages]
+
+
+class WikiDumpStore:
+    '''Article and redirect tables of a wikipedia dump in one SQLite file.
+
+    Articles are stored as compressed plain text keyed by their normalized title, and redirects
+    as title -> target. Pages are looked up the way the MediaWiki query API resolves `titles`:
+    normalization first, then (possibly chained) redirects.
+    '''
+
+    def __init__(self, path: str, mmap_size: int = 1 << 30):
+        '''
+        Args:
+            path (str): Path of the SQLite file. The parent directory is created if needed.
+            mmap_size (int, optional): Bytes of the file SQLite may memory-map for reads.
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.codec = get_default_codec()
+
+        # Shared by the download workers
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS articles (title TEXT PRIMARY KEY, codec INTEGER NOT NULL, data BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS redirects (title TEXT PRIMARY KEY, target TEXT NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+    def add(self, articles: List[Tuple[str, str]], redirects: List[Tuple[str, str]]) -> None:
+        '''Adds (title, plain text) articles and (title, target) redirects in one transaction.'''
+        rows = [(title, self.codec, compress_text(text, self.codec)) for title, text in articles]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO articles (title, codec, data) VALUES (?, ?, ?)', rows)
+            self._conn.executemany('INSERT OR REPLACE INTO redirects (title, target) VALUES (?, ?)', redirects)
+            self._conn.commit()
+
+    def count(self) -> Tuple[int, int]:
+        '''Returns the number of articles and redirects.'''
+        with self._lock:
+            return (self._conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0],
+                    self._conn.execute('SELECT COUNT(*) FROM redirects').fetchone()[0])
+
+    def resolve(self, title: str) -> str:
+        '''Follows the redirects of a normalized title to the final title.'''
+        seen = set()
+        with self._lock:
+            while title not in seen:
+                seen.add(title)
+                row = self._conn.execute('SELECT target FROM redirects WHERE title = ?', (title,)).fetchone()
+                if row is None:
+                    break
+                title = row[0]
+        return title
+
+    def get_article(self, title: str) -> Optional[str]:
+        '''Returns the plain text of an article by its exact (normalized) title, without following redirects.'''
+        with self._lock:
+            row = self._conn.execute('SELECT codec, data FROM articles WHERE title = ?', (title,)).fetchone()
+        return None if row is None else decompress_text(*row)
+
+    def fetch_pages_batch(self, keywords: List[str]) -> Dict[str, Optional[Tuple[str, str]]]:
+        '''Looks up keywords like web.fetch_wikipedia_pages_batch, from the dump instead of the API.
+
+        Returns:
+            Dict[str, Optional[Tuple[str, str]]]: keyword -> (page title, processed content), or None if the dump has no such page.
+        '''
+        results: Dict[str, Optional[Tuple[str, str]]] = {}
+        for keyword in keywords:
+            title = self.resolve(normalize_title(keyword))
+            content = self.get_article(title) if title else None
+            results[keyword] = None if content is None else (title, content)
+        return results
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def build_dump_store(dump_path: str, store_path: str, processes: int = 1, batch_size: int = 1000, limit: Optional[int] = None) -> Dict[str, float]:
+    '''Ingests a MediaWiki XML dump into a WikiDumpStore.
+
+    Pages are streamed from the dump and converted to plain text in batches. With processes > 1,
+    batches are converted by a pool of worker processes while the next ones are parsed, and at most
+    2 * processes batches are in flight, so memory use stays bounded. Only articles (namespace 0)
+    and their redirects are kept. Ingesting into an existing store adds to it.
+
+    Args:
+        dump_path (str): Path of the dump (pages-articles.xml or .xml.bz2).
+        store_path (str): Path of the store to write.
+        processes (int, optional): Number of worker processes converting wiki markup.
+        batch_size (int, optional): Pages converted and written per batch.
+        limit (int, optional): Stop after this many pages, e.g. to try a dump out.
+
+    Returns:
+        Dict[str, float]: Number of articles, redirects and skipped pages, the elapsed time and pages/sec.
+    '''
+    store = WikiDumpStore(store_path)
+    stats = {'articles': 0, 'redirects': 0, 'skipped': 0}
+    start_time = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    in_flight: deque = deque()
+
+    def write_batch(converted: List[Tuple[str, Optional[str], Optional[str]]]) -> None:
+        articles = [(title, text) for title, target, text in converted if target is None and text]
+        redirects = [(title, target) for title, target, _ in converted if target is not None]
+        store.add(articles, redirects)
+        stats['articles'] += len(articles)
+        stats['redirects'] += len(redirects)
+        stats['skipped'] += len(converted) - len(articles) - len(redirects)
+
+    def submit_batch(batch: List[DumpPage]) -> None:
+        if executor is None:
+            write_batch(_convert_pages(batch))
+            return
+        in_flight.append(executor.submit(_convert_pages, batch))
+        if len(in_flight) >= 2 * processes:
+            write_batch(in_flight.popleft().result())
+
+    try:
+        batch: List[DumpPage] = []
+        num_pages = 0
+        for page in iter_dump_pages(dump_path):
+            if limit is not None and num_pages >= limit:
+                break
+            num_pages += 1
+            if page.namespace != ARTICLE_NAMESPACE:
+                stats['skipped'] += 1
+                continue
+            batch.append(page)
+            if len(batch) >= batch_size:
+                submit_batch(batch)
+                batch = []
+                if num_pages % (batch_size * 10) < batch_size:
+                    logging.info(f'Ingested {num_pages} pages ({stats["articles"]} articles, {stats["redirects"]} redirects, {num_pages / (time.perf_counter() - start_time):.0f} pages/s)')
+        if batch:
+            submit_batch(batch)
+        while in_flight:
+            write_batch(in_flight.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    store.set_meta('source', os.path.abspath(dump_path))
+    store.close()
+    stats['seconds'] = time.perf_counter() - start_time
+    stats['pages_per_sec'] = num_pages / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+_stores: Dict[str, WikiDumpStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_wiki_dump(store_path: str) -> WikiDumpStore:
+    '''Returns the WikiDumpStore of a path, shared by every caller in the process.'''
+    key = os.path.abspath(store_path)
+    with _stores_lock:
+        if key not in _stores:
+            if not os.path.exists(store_path):
+                raise FileNotFoundError(f'No wikipedia dump store at "{store_path}", build one with other/ingest_wiki_dump.py')
+            _stores[key] = WikiDumpStore(store_path)
+        return _stores[key]